@@ -153,9 +153,10 @@ def get_container_sas_url(block_blob_client,
     return container_sas_url
 
 
-def create_pool(batch_service_client, pool_id, vm_size, imageName, versions, auto_scale_formula):
+def create_pool(batch_service_client, pool_id, vm_size, imageName, versions, auto_scale_formula, inter_node_communication=False):
     """
     Creates a pool of compute nodes with the specified OS settings.
+    Distributed training tasks need inter_node_communication.
 
     :param batch_service_client: A Batch service client.
     :type batch_service_client: `azure.batch.BatchServiceClient`
@@ -181,7 +182,8 @@ def create_pool(batch_service_client, pool_id, vm_size, imageName, versions, aut
         application_package_references=[batchmodels.ApplicationPackageReference(
             application_id="browsecloudtrainer", version=version) for version in versions],
         auto_scale_evaluation_interval=timedelta(
-            minutes=5)  # the smallest evaluation interval
+            minutes=5),  # the smallest evaluation interval
+        enable_inter_node_communication=inter_node_communication
 
     )
 
@@ -238,6 +240,38 @@ def add_training_task(batch_service_client, job_id, command, displayName, contai
     batch_service_client.task.add_collection(job_id, tasks)
 
 
+def add_distributed_training_task(batch_service_client, job_id, command, coordination_command, displayName, instances):
+    """
+    Adds a multi-instance task to the specified job: coordination_command starts on each of instances nodes,
+    and command runs on the primary one of them once they all have.
+
+    :param batch_service_client: A Batch service client.
+    :type batch_service_client: `azure.batch.BatchServiceClient`
+    :param str jobId: The ID of the job to which to add the tasks.
+    :param command: commandLine of the coordinator, e.g. generateCountingGridsFromAzure.py with a number of workers
+    :param coordination_command: commandLine that starts a worker in the background, e.g. distributedCountingGridsWorker.py
+    :param displayName display name of task
+    :param instances number of nodes, each running one worker
+    """
+
+    GUID = str(uuid.uuid4())[:63]
+
+    autouser = batchmodels.AutoUserSpecification(
+        scope='task', elevation_level='admin')
+    userId = batchmodels.UserIdentity(auto_user=autouser)
+
+    batch_service_client.task.add(job_id, batch.models.TaskAddParameter(
+        id='{}'.format(GUID),
+        command_line=command,
+        display_name=displayName,
+        user_identity=userId,
+        multi_instance_settings=batchmodels.MultiInstanceSettings(
+            number_of_instances=instances,
+            coordination_command_line=coordination_command
+        )
+    ))
+
+
 def wait_for_tasks_to_complete(batch_service_client, job_id, timeout):
     """
     Returns when all tasks in the specified job reach the Completed state.
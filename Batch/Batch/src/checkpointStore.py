@@ -0,0 +1,51 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+import shutil
+
+
+class CheckpointStore():
+    '''
+    Keeps training checkpoints off the Batch node, so a preempted task can resume where it stopped.
+    Checkpoints are stored as a blob in container_name, or in local_directory instead when it is given.
+    '''
+
+    def __init__(self, blob_client, container_name, blob_name="checkpoint.npz", local_directory=None):
+        self.blob_client = blob_client
+        self.container_name = container_name
+        self.blob_name = blob_name
+        self.local_directory = local_directory
+
+    def restore(self, file_path):
+        '''
+        Copies the stored checkpoint to file_path. Returns False if there is none.
+        '''
+        if self.local_directory is not None:
+            stored_path = os.path.join(self.local_directory, self.blob_name)
+            if not os.path.exists(stored_path):
+                return False
+            shutil.copyfile(stored_path, file_path)
+            return True
+        if not self.blob_client.exists(self.container_name, self.blob_name):
+            return False
+        self.blob_client.get_blob_to_path(self.container_name, self.blob_name, file_path)
+        return True
+
+    def save(self, file_path):
+        if self.local_directory is not None:
+            os.makedirs(self.local_directory, exist_ok=True)
+            stored_path = os.path.join(self.local_directory, self.blob_name)
+            shutil.copyfile(file_path, stored_path + ".tmp")
+            os.replace(stored_path + ".tmp", stored_path)
+        else:
+            self.blob_client.create_container(self.container_name)
+            self.blob_client.create_blob_from_path(self.container_name, self.blob_name, file_path)
+
+    def clear(self):
+        if self.local_directory is not None:
+            stored_path = os.path.join(self.local_directory, self.blob_name)
+            if os.path.exists(stored_path):
+                os.remove(stored_path)
+        elif self.blob_client.exists(self.container_name, self.blob_name):
+            self.blob_client.delete_blob(self.container_name, self.blob_name)
@@ -60,6 +60,7 @@ if __name__ == '__main__':
     IMAGE_NAME = ""
     SCALING_FORMULA = ""
     VERSIONS = []
+    INTER_NODE_COMMUNICATION = False
     TENANT_ID = ""
     CLIENT_ID = ""
 
@@ -69,6 +70,8 @@ if __name__ == '__main__':
         CLIENT_ID = dataMeta["CLIENT_ID_DEPLOYMENT_AND_TESTING"]
         _BATCH_ACCOUNT_NAME = dataMeta["_BATCH_ACCOUNT_NAME"]
         _BATCH_ACCOUNT_URL = dataMeta["_BATCH_ACCOUNT_URL"]
+        # Needed by distributed training tasks
+        INTER_NODE_COMMUNICATION = dataMeta.get("INTER_NODE_COMMUNICATION", False)
 
         if dataMeta['ENV'] == 'DEV':
             JOB_ID = dataMeta['JOB_ID_DEV']
@@ -105,7 +108,7 @@ if __name__ == '__main__':
         # tasks.
 
         create_pool(batch_client, POOL_ID, POOL_VM_SIZE,
-                    IMAGE_NAME, VERSIONS, SCALING_FORMULA)
+                    IMAGE_NAME, VERSIONS, SCALING_FORMULA, INTER_NODE_COMMUNICATION)
 
         # Create the job that will run the tasks.
         create_job(batch_client, JOB_ID, POOL_ID)
@@ -0,0 +1,34 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import json
+import os
+import sys
+import traceback
+from CountingGridsPy.models.DistributedEStep import run_worker
+sys.path.append("../../..")
+
+
+# CLI: python distributedCountingGridsWorker.py <output_containername>
+#
+# Runs on every node of a multi-instance training task, as its coordination command. It connects to the
+# generateCountingGridsFromAzure.py task on the primary node, receives a shard of the documents from it,
+# and runs the E-step on that shard every iteration until training ends.
+if __name__ == "__main__":
+    try:
+        if len(sys.argv) != 2:
+            raise ValueError("Please give valid command-line arguments.")
+        jobId = sys.argv[1]
+
+        with open('metadata.json', 'r') as fMeta:
+            DISTRIBUTED_PORT = int(json.load(fMeta).get("DISTRIBUTED_PORT", 6001))
+        # Batch sets this to "<ip>:<port>" of the primary node of a multi-instance task
+        COORDINATOR_HOST = os.environ["AZ_BATCH_MASTER_NODE"].split(":")[0]
+
+        # The coordinator only starts listening once it has cleaned the data
+        run_worker((COORDINATOR_HOST, DISTRIBUTED_PORT), authkey=jobId.encode(), retry_seconds=10)
+    except Exception:
+        print("Worker failed.")
+        print(traceback.format_exc())
+    else:
+        print("Worker succeeded.")
@@ -3,16 +3,17 @@
 
 import hashlib
 import json
-import datetime
 import pandas as pd
 import os
 import numpy as np
 from CountingGridsPy.models import CountingGridModel
+from CountingGridsPy.models.DistributedEStep import SocketTransport
 import traceback
 from browseCloudServiceAuthorizer import BrowseCloudServiceAuthorizer
 from countingGridsHeartBeater import CountingGridsHeartBeater
 from jobStatus import JobStatus
 from batchJob import BatchJob
+from checkpointStore import CheckpointStore
 import azure.storage.blob as azureblob
 from browseCloudAzureUtilities import upload_file_to_container, download_file_from_container
 import matplotlib.pyplot as plt
@@ -22,9 +23,12 @@ sys.path.append("../../..")
 
 
 # CLI: python generateCountingGridsFromAzure.py <input_containername> <extent_size_of_grid_hyperparameter>
-# <window_size_of_grid_hyperparameter> <engine_type> <inputfile_type> <inputfile_name> <output_containername>
+# <window_size_of_grid_hyperparameter> <engine_type> <inputfile_type> <inputfile_name> <output_containername> [<workers>]
 #
 # Example CLI: python generateCountingGridsFromAzure.py trainingdata 24 5 numpyEngine simpleInput dictionaryVerySmallSample.txt bighash
+#
+# With <workers>, this is the primary task of a multi-instance task (see add_distributed_training_task): the numpy engine
+# sends a shard of the documents to each of the <workers> distributedCountingGridsWorker.py of the task and runs EM across them.
 
 # Assumes: input_containername and output_containername must be <64 characters long.
 if __name__ == "__main__":
@@ -35,7 +39,7 @@ if __name__ == "__main__":
         # ---------------------------------------------------------------------------------------
 
         errStr = "Please give valid command-line arguments."
-        if len(sys.argv) != 8:
+        if len(sys.argv) not in (8, 9):
             raise ValueError(errStr)
 
         containerNameIn = sys.argv[1]
@@ -45,14 +49,17 @@ if __name__ == "__main__":
         inputfile_type = sys.argv[5]
         blobName = sys.argv[6]
         containerNameOut = sys.argv[7]
-        if engine_type != "numpyEngine" and engine_type != "matlabEngine":
+        WORKERS = int(sys.argv[8]) if len(sys.argv) == 9 else 0
+        if engine_type not in ("numpyEngine", "matlabEngine", "torchEngine"):
             raise ValueError(
-                "The {0} engine does not exist. Please use 'matlabEngine' or 'numpyEngine'.".format(engine_type))
+                "The {0} engine does not exist. Please use 'matlabEngine', 'numpyEngine' or 'torchEngine'.".format(engine_type))
         engine_type = engine_type[:-6]  # 6 characters in the word "Engine"
         if inputfile_type != "metadataInput" and inputfile_type != "simpleInput":
             raise ValueError(
                 "The {0} input type does not exist. Please use 'simpleInput' or 'metadataInput'.".format(inputfile_type))
         inputfile_type = inputfile_type[:-5]  # remove "Input"
+        if WORKERS > 0 and engine_type != "numpy":
+            raise ValueError("Only the numpyEngine trains on workers.")
 
         # ---------------------------------------------------------------------------------------
         # Authentication
@@ -71,6 +78,14 @@ if __name__ == "__main__":
             AUTH_URL = dataMeta["AUTH_URL"]
             _STORAGE_ACCOUNT_NAME_IN = dataMeta["_STORAGE_ACCOUNT_NAME_TRAININGDATA"]
             _STORAGE_ACCOUNT_KEY_OUT = dataMeta["_STORAGE_ACCOUNT_NAME_MODELS"]
+            # Optional local directory that stands in for blob storage when keeping checkpoints
+            LOCAL_CHECKPOINT_DIRECTORY = dataMeta.get("LOCAL_CHECKPOINT_DIRECTORY")
+            DISTRIBUTED_PORT = int(dataMeta.get("DISTRIBUTED_PORT", 6001))
+            # 1 skips the layered stage
+            LAYERS = int(dataMeta.get("LAYERS", 2))
+            # Optional wall-clock limit of training, and number of iterations between uploads of rough artifacts
+            TIME_BUDGET_SECONDS = dataMeta.get("TIME_BUDGET_SECONDS")
+            PREVIEW_EVERY = dataMeta.get("PREVIEW_EVERY")
             if dataMeta['ENV'] == 'DEV':
                 # TODO: Use key vault and certificate
                 # to retreive that information instead of temp file for keys.
@@ -109,12 +124,26 @@ if __name__ == "__main__":
         HEART_BEATER = CountingGridsHeartBeater(
             SERVICE_URL, BATCH_JOB, SERVICE_AUTHORIZER)
 
+        # Deterministic, so a task restarted after preemption finds the files of its previous attempt
         DIRECTORY_SUFFIX = hashlib.sha3_256(
-            (docId+blobName+str(datetime.datetime.now())).encode()).hexdigest()
+            (docId+blobName+jobId).encode()).hexdigest()
         DIRECTORY_DATA = blobName.split(".")[0] + "_" + DIRECTORY_SUFFIX
+        CHECKPOINT_DIRECTORY = DIRECTORY_DATA + "/checkpoints"
 
         if not os.path.isdir(DIRECTORY_DATA):
             os.mkdir(DIRECTORY_DATA)
+        if not os.path.isdir(CHECKPOINT_DIRECTORY):
+            os.mkdir(CHECKPOINT_DIRECTORY)
+
+        # Checkpoints are kept in the output container until the model files are uploaded
+        CHECKPOINT_STORE = CheckpointStore(
+            azureblob.BlockBlobService(
+                account_name=_STORAGE_ACCOUNT_NAME_OUT,
+                account_key=_STORAGE_ACCOUNT_KEY_OUT),
+            containerNameOut,
+            local_directory=LOCAL_CHECKPOINT_DIRECTORY)
+        if CHECKPOINT_STORE.restore(CHECKPOINT_DIRECTORY + "/checkpoint.npz"):
+            print("Resuming training from a checkpoint.")
 
         '''
         Algorithm:
@@ -126,13 +155,15 @@ if __name__ == "__main__":
         Changes between this and dumpCountingGrids.py:
         1. DIRECTORY_DIR must be unique.
         2. Fetching and writing to Azure. Idea is to fetch into directory and then write it to Azure
+        3. Training checkpoints to Azure, and resumes from the latest one after a preemption.
         '''
         blob_client = azureblob.BlockBlobService(
             account_name=_STORAGE_ACCOUNT_NAME_IN,
             account_key=_STORAGE_ACCOUNT_KEY_IN)
 
-        download_file_from_container(
-            blob_client, containerNameIn, DIRECTORY_DATA+"/"+blobName, blobName)
+        if not os.path.exists(DIRECTORY_DATA+"/"+blobName):
+            download_file_from_container(
+                blob_client, containerNameIn, DIRECTORY_DATA+"/"+blobName, blobName)
 
         FILE_NAME = DIRECTORY_DATA + "\\" + blobName
 
@@ -171,11 +202,25 @@ if __name__ == "__main__":
         # ---------------------------------------------------------------------------------------
         # Learning
         # ---------------------------------------------------------------------------------------
+        def upload_preview(files):
+            # The rough artifacts go to the output container while training, so that the service can show them early
+            preview_client = azureblob.BlockBlobService(
+                account_name=_STORAGE_ACCOUNT_NAME_OUT,
+                account_key=_STORAGE_ACCOUNT_KEY_OUT)
+            preview_client.create_container(containerNameOut)
+            for preview_file in files:
+                upload_file_to_container(preview_client, containerNameOut, preview_file)
+
         engine = CGEngineWrapper(
-            extent_size=EXTENT_SIZE, window_size=WINDOW_SIZE, heartBeaters=[HEART_BEATER])
+            extent_size=EXTENT_SIZE, window_size=WINDOW_SIZE, layers=LAYERS, heartBeaters=[HEART_BEATER],
+            checkpoint_directory=CHECKPOINT_DIRECTORY, checkpoint_seconds=300, on_checkpoint=CHECKPOINT_STORE.save,
+            time_budget=None if TIME_BUDGET_SECONDS is None else float(TIME_BUDGET_SECONDS),
+            preview_every=None if PREVIEW_EVERY is None else int(PREVIEW_EVERY), on_preview=upload_preview)
         HEART_BEATER.next()
         vocabulary = None
         if not os.path.exists(DIRECTORY_DATA + LEARNED_GRID_FILE_NAME):
+            if WORKERS > 0:
+                engine.transport = SocketTransport(WORKERS, ("", DISTRIBUTED_PORT), authkey=jobId.encode())
             vocabulary, keep = engine.fit(
                 DIRECTORY_DATA, CLEAN_DATA_FILE_NAME, cleaner.labelsS, MIN_FREQUENCY, keep, engine=engine_type)
         else:
@@ -189,7 +234,8 @@ if __name__ == "__main__":
         LINK_FILE_NAME = ""
         bcag = BrowseCloudArtifactGenerator(DIRECTORY_DATA)
         bcag.read(LEARNED_GRID_FILE_NAME)
-        bcag.write_docmap(engine.wd_size, engine=engine_type)
+        # The torch engine writes the same matrices as the numpy engine
+        bcag.write_docmap(engine.wd_size, engine="matlab" if engine_type == "matlab" else "numpy")
         bcag.write_counts()
         bcag.write_vocabulary(vocabulary)
         bcag.write_top_pi()
@@ -214,6 +260,7 @@ if __name__ == "__main__":
             if not modelfile.endswith(blobName):
                 upload_file_to_container(
                     blob_client, containerNameOut, modelfile)
+        CHECKPOINT_STORE.clear()
     except Exception as e:
         HEART_BEATER.done(success=False) if HEART_BEATER is not None else False
         print("Script failed.")
@@ -1,10 +1,11 @@
 from .morphologicalTightener import MorphologicalTightener
 from .slidingWindowTrainer import SlidingWindowTrainer
 from .browseCloudArtifactGenerator import BrowseCloudArtifactGenerator
+from .previewHeartBeater import PreviewHeartBeater
 from .cgEngineWrapper import CGEngineWrapper
 from .nlpCleaner import NLPCleaner
 from .pipelineTimer import PipelineTimer
 
 
 __all__ = ['MorphologicalTightener', 'BrowseCloudArtifactGenerator',
-           'CGEngineWrapper', 'NLPCleaner', 'PipelineTimer', 'SlidingWindowTrainer']
+           'CGEngineWrapper', 'NLPCleaner', 'PipelineTimer', 'SlidingWindowTrainer', 'PreviewHeartBeater']
@@ -3,6 +3,7 @@
 
 import numpy as np
 import scipy.io as io
+import scipy.sparse
 import pandas as pd
 import matplotlib.pyplot as plt
 from CountingGridsPy.EngineToBrowseCloudPipeline import MorphologicalTightener
@@ -14,15 +15,26 @@ class BrowseCloudArtifactGenerator(object):
 
     def read(self, LEARNED_GRID_FILE_NAME):
         MAT = io.loadmat(self.DIRECTORY_DATA + LEARNED_GRID_FILE_NAME)
+        self.set_matrices(MAT)
+        del MAT
+
+    def set_matrices(self, MAT):
+        '''
+        Takes the learned matrices from a dict like the one saved in CountingGridDataMatrices.mat, e.g. the one
+        returned by CountingGridModel.cg_layers or single_layer. Without counts_to_show, write_counts is unavailable.
+        '''
         self.pi2_idf = MAT['pi2_idf']
-        self.counts_to_show = MAT['counts_to_show']  # COUNTS MATRIX
-        if type(self.counts_to_show) is not np.ndarray:
+        self.counts_to_show = MAT.get('counts_to_show')  # COUNTS MATRIX
+        if self.counts_to_show is not None and type(self.counts_to_show) is not np.ndarray:
             try:
                 self.counts_to_show = self.counts_to_show.toarray()
             except Exception as e:
                 raise ValueError(e)
         # MAPPING AFTER LAYERS CODE Q( Location | Document ) TxE
+        # A sparse T x P matrix when the numpy engine kept only the top locations of each document
         self.ql2 = MAT['ql2']
+        if scipy.sparse.issparse(self.ql2):
+            self.ql2 = scipy.sparse.csr_matrix(self.ql2)
         # ARRAY WITH THE LAYER NUMBER FOR EACH DOCUMENT,  argmax over the layers
         self.id_layer = MAT['id_layer'][0]
         # LAYERED PI WEIGHTED BY IDF. E1xE2xZxLA
@@ -33,7 +45,6 @@ class BrowseCloudArtifactGenerator(object):
         except Exception as e:
             # Not implemented in matlab version
             self.indices_to_show = np.array(range(MAT['ql2'].shape[0])) + 1
-        del MAT
 
         cgsz = np.zeros(2)
         cgsz[0], cgsz[1], self.Z = self.pi2_idf.shape
@@ -127,11 +138,34 @@ class BrowseCloudArtifactGenerator(object):
         with open(self.DIRECTORY_DATA + '/keep.txt', 'w') as the_file:
             the_file.writelines("\n".join([str(int(x)) for x in keep]))
 
+    def dense_ql2(self):
+        '''
+        ql2 as a dense array, also when it was saved as a sparse T x P matrix.
+        '''
+        if scipy.sparse.issparse(self.ql2):
+            return np.reshape(self.ql2.toarray(), (self.ql2.shape[0], self.cgsz[0], self.cgsz[1]))
+        return self.ql2
+
+    def ql2_batch(self, start, end, engine="numpy"):
+        '''
+        Dense E1 x E2 x (end - start) slice of ql2 for the documents start to end.
+        '''
+        if engine == "matlab":
+            return self.ql2[:, :, start:end]
+        elif engine == "numpy":
+            if scipy.sparse.issparse(self.ql2):
+                batch = np.reshape(self.ql2[start:end].toarray(), (-1, self.cgsz[0], self.cgsz[1]))
+            else:
+                batch = self.ql2[start:end]
+            return np.moveaxis(batch, 0, -1)
+        else:
+            raise ValueError("The {} engine does not exist.".format(engine))
+
     def read_docmap(self, fileName, engine="numpy"):
         if not (engine == "numpy" or engine == "matlab"):
             raise ValueError("The {} engine does not exist.".format(engine))
 
-        self.ql2 = np.zeros(self.ql2.shape)
+        self.ql2 = np.zeros(self.dense_ql2().shape)
 
         with open(self.DIRECTORY_DATA + fileName) as f:
             for line in f:
@@ -153,27 +187,34 @@ class BrowseCloudArtifactGenerator(object):
                         self.ql2[t, e1Index, e2Index] = qVal
                     i += 1
 
-    def write_docmap(self, wd_size, engine="numpy"):
-        docToGridMapping = np.copy(self.ql2)
-
-        if engine == "matlab":
-            pass
-        elif engine == "numpy":
-            docToGridMapping = np.moveaxis(docToGridMapping, 0, -1)
-        else:
+    def write_docmap(self, wd_size, engine="numpy", batch_size=1000):
+        if not (engine == "numpy" or engine == "matlab"):
             raise ValueError("The {} engine does not exist.".format(engine))
+        T = self.ql2.shape[2] if engine == "matlab" else self.ql2.shape[0]
 
         thr = 0.01
         mask = np.zeros(self.cgsz)
         mask[:wd_size, :wd_size] = 1
-        qlSmooth = np.real(np.fft.ifft2(np.fft.fft2(docToGridMapping, axes=(
-            0, 1)) * np.fft.fft2(np.expand_dims(mask, 2), axes=(0, 1)), axes=(0, 1)))
+        fftMask = np.fft.fft2(np.expand_dims(mask, 2), axes=(0, 1))
+        # Smooth batch_size documents at a time, collecting the documents above the threshold for each cell
+        cellIds = [[[] for c in self.indexC] for r in self.indexR]
+        cellVals = [[[] for c in self.indexC] for r in self.indexR]
+        for start in range(0, T, batch_size):
+            docToGridMapping = self.ql2_batch(start, start + batch_size, engine)
+            qlSmooth = np.real(np.fft.ifft2(np.fft.fft2(docToGridMapping, axes=(
+                0, 1)) * fftMask, axes=(0, 1)))
+            for r in self.indexR:
+                for c in self.indexC:
+                    ids = np.where(qlSmooth[r, c, :] > thr)[0]
+                    cellIds[r][c].append(ids + start)
+                    cellVals[r][c].append(qlSmooth[r, c, ids])
+
         tmp = list()
         with open(self.DIRECTORY_DATA + '/docmap.txt', 'w') as f:
             for r in self.indexR:
                 for c in self.indexC:
-                    ids = np.where(qlSmooth[r, c, :] > thr)[0]
-                    vals = qlSmooth[r, c, ids]
+                    ids = np.concatenate(cellIds[r][c])
+                    vals = np.concatenate(cellVals[r][c])
                     lay = self.id_layer[ids]
 
                     tmp.append("row:" + ("%1d" % (r+1)) + "\tcol:" + ("%1d" % (c+1)) + "\t" + "\t".join(
@@ -281,7 +322,7 @@ class BrowseCloudArtifactGenerator(object):
                         "Invalid RGB color for BrowseCloud input. Must be between 0 and 1 and only 3 dimensions are given.")
         elif feature_map is not None:
             colors = [0 for d in range(len(self.indexR)*len(self.indexC))]
-            docToGridMapping = np.copy(self.ql2)
+            docToGridMapping = np.copy(self.dense_ql2())
             if engine == "matlab":
                 pass
             elif engine == "numpy":
@@ -1,8 +1,11 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
-from CountingGridsPy.models import CountingGridModel
-from CountingGridsPy.EngineToBrowseCloudPipeline import SlidingWindowTrainer
+from CountingGridsPy.models import CountingGridModel, CountingGridModelWithGPU
+from CountingGridsPy.models.CountingGridModel import top_k_posterior
+from CountingGridsPy.models.HyperparameterSweep import HyperparameterSweep
+from CountingGridsPy.models.MemmapCounts import save_counts, load_counts
+from CountingGridsPy.EngineToBrowseCloudPipeline import SlidingWindowTrainer, PreviewHeartBeater
 from scipy import io
 import pandas as pd
 import numpy as np
@@ -12,11 +15,64 @@ from sklearn.feature_extraction.text import CountVectorizer
 
 
 class CGEngineWrapper(object):
-    def __init__(self, extent_size=32, window_size=5, layers=2, heartBeaters=None):
+    # The top_k of out-of-core training when none is given, so that q is sparse
+    MEMMAP_TOP_K = 64
+
+    def __init__(
+        self, extent_size=32, window_size=5, layers=2, heartBeaters=None,
+        max_iter=100, tol=1e-5, patience=3, dtype=np.float64, mode="batch", batch_size=1000,
+        processes=None, top_k=None, device=None,
+        checkpoint_directory=None, checkpoint_every=None, checkpoint_seconds=None, on_checkpoint=None,
+        restarts=1, coarse_levels=0, accelerate=False, chunk_size=None, memmap_directory=None, transport=None,
+        time_budget=None, preview_every=None, on_preview=None
+    ):
         self.cg_size = extent_size
         self.wd_size = window_size
         self.no_layers = layers
         self.heartBeaters = heartBeaters
+        # Training stops after max_iter iterations, or earlier once the log-likelihood has converged.
+        self.max_iter = max_iter
+        self.tol = tol
+        self.patience = patience
+        # Floating point type of the numpy engine. float32 halves memory use.
+        self.dtype = dtype
+        # "batch" for full EM, or "online" for minibatch EM over batch_size documents at a time.
+        self.mode = mode
+        self.batch_size = batch_size
+        # Number of worker processes that share the batch E-step. None runs it in this process.
+        self.processes = processes
+        # Keep only the top_k most likely locations of each document in q. None keeps all of them.
+        self.top_k = top_k
+        # Torch device of the torch engine, e.g. "cpu" or "cuda:0". None picks the GPU when there is one.
+        # On the CPU, processes sets the number of torch threads.
+        self.device = device
+        # The numpy engine checkpoints to checkpoint_directory every checkpoint_every iterations or checkpoint_seconds seconds,
+        # and resumes from the checkpoint there if one exists. on_checkpoint is called with the path of every checkpoint.
+        self.checkpoint_directory = checkpoint_directory
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_seconds = checkpoint_seconds
+        self.on_checkpoint = on_checkpoint
+        # The numpy engine keeps the best of this many randomly initialized fits, run processes at a time.
+        self.restarts = restarts
+        # The numpy engine starts large grids from a grid with half the extent and window, coarse_levels times over.
+        self.coarse_levels = coarse_levels
+        # Speeds up batch EM in the numpy engine with SQUAREM extrapolation of pi.
+        self.accelerate = accelerate
+        # The batch E-step of the numpy engine runs chunk_size documents at a time, so its memory use does not grow with the corpus.
+        self.chunk_size = chunk_size
+        # If given, the numpy engine writes the counts to memory-mapped .npy files in memmap_directory and trains from there,
+        # chunk_size (or batch_size) documents at a time, so the counts need not fit in memory during training.
+        # q is then kept sparse, with top_k (MEMMAP_TOP_K by default) locations per document, and layers must be 1,
+        # since the layered model holds dense T x P arrays in memory.
+        self.memmap_directory = memmap_directory
+        # If given, the numpy engine runs batch EM across the workers of transport, see models/DistributedEStep.py.
+        self.transport = transport
+        # The numpy engine stops training after time_budget seconds, and writes the artifacts of the grid reached by then.
+        self.time_budget = time_budget
+        # If given, the numpy engine writes a preview of top_pi.txt and docmap.txt every preview_every iterations,
+        # and calls on_preview with their paths. See PreviewHeartBeater.
+        self.preview_every = preview_every
+        self.on_preview = on_preview
 
     def ready_the_matlab_engine(self, X, labels_filtered, DIRECTORY_DATA):
         m, n = X.shape
@@ -29,7 +85,7 @@ class CGEngineWrapper(object):
             io.savemat(DIRECTORY_DATA + '/labels.mat',
                        {'labels': labels_filtered})
 
-    def __fitCountVectorizor(self, DIRECTORY_DATA, CLEAN_DATA_FILE_NAME, labels, MIN_FREQUENCY):
+    def __fitCountVectorizor(self, DIRECTORY_DATA, CLEAN_DATA_FILE_NAME, labels, MIN_FREQUENCY, vocabulary=None):
         df = pd.read_table(DIRECTORY_DATA + CLEAN_DATA_FILE_NAME)
         df = df[df.columns[1:]]
         TEXT = df['pos_filtered'].tolist()
@@ -42,7 +98,7 @@ class CGEngineWrapper(object):
         df = df.ix[id_grid].reset_index(drop=True)
         self.labelsS = np.array(
             labels)[id_grid] if labels is not None else None
-        vect = CountVectorizer(decode_error="ignore", min_df=MIN_FREQUENCY)
+        vect = CountVectorizer(decode_error="ignore", min_df=MIN_FREQUENCY, vocabulary=vocabulary)
         X = vect.fit_transform(df['pos_filtered'].tolist())
         return (vect, X, addl_keep)
 
@@ -58,13 +114,25 @@ class CGEngineWrapper(object):
     def incremental_fit(
         self, DIRECTORY_DATA, CLEAN_DATA_FILE_NAME, labels,
         MIN_FREQUENCY, keep, engine, initial_max_iter=100,
-        w=2000, s=1000, runInitialTrain=True
+        w=2000, s=1000, runInitialTrain=True, incremental=False, warm_iterations=3, write_every=1, times=None
     ):
+        '''
+        Learns a grid for every window of w documents, moving s documents at a time.
+        If incremental is True, every window is learned from the previous one with warm_iterations EM iterations over
+        the documents that entered it, and only every write_every-th window is written; see IncrementalSlidingTrainer.
+        If times, the time of every document read, is given, w and s are time spans instead, e.g. "7D" and "1D", and
+        the windows are learned incrementally and resumed on reruns; see TimeSlidingTrainer.
+        '''
+        vocabulary = None
+        if times is not None:
+            # A resumed grid keeps the words it was learned with
+            vocabulary = SlidingWindowTrainer.saved_vocabulary(DIRECTORY_DATA)
         vect, X, addl_keep = self.__fitCountVectorizor(
             DIRECTORY_DATA,
             CLEAN_DATA_FILE_NAME,
             labels,
-            MIN_FREQUENCY
+            MIN_FREQUENCY,
+            vocabulary
         )
 
         if engine != "numpy":
@@ -72,18 +140,37 @@ class CGEngineWrapper(object):
 
         extent = np.array([self.cg_size, self.cg_size])
         window = np.array([self.wd_size, self.wd_size])
-        model = CountingGridModel(extent, window)
+        model = CountingGridModel(extent, window, dtype=self.dtype)
+
+        if times is not None:
+            SlidingWindowTrainer.TimeSlidingTrainer(
+                pd.to_datetime(np.array(times)[addl_keep]).values, pd.Timedelta(w).to_timedelta64(), pd.Timedelta(s).to_timedelta64(),
+                model, X, DIRECTORY_DATA, initial_max_iter=initial_max_iter, warm_iterations=warm_iterations,
+                layers=self.no_layers, runInitialTrain=runInitialTrain, vocabulary=vect.get_feature_names(),
+                noise=.00001, tol=self.tol, patience=self.patience
+            )
+            return (vect.get_feature_names(), np.array(keep) & np.array(addl_keep))
+
+        if incremental:
+            SlidingWindowTrainer.IncrementalSlidingTrainer(
+                w, s, model, X, DIRECTORY_DATA, initial_max_iter=initial_max_iter, warm_iterations=warm_iterations,
+                layers=self.no_layers, runInitialTrain=runInitialTrain, write_every=write_every,
+                noise=.00001, tol=self.tol, patience=self.patience
+            )
+            return (vect.get_feature_names(), np.array(keep) & np.array(addl_keep))
 
         T = X.shape[0]
         training_max_iter_vec = [1 for x in range(int(np.ceil((T-w)/s)) + 1)]
         train = model.fit
         kwargs = {
-            "data": X.toarray(),
+            "data": X,
             "max_iter": initial_max_iter,
             "returnSumSquareDifferencesOfPi": False,
             "layers": self.no_layers,
             "noise": .00001,
-            "output_directory": DIRECTORY_DATA
+            "output_directory": DIRECTORY_DATA,
+            "tol": self.tol,
+            "patience": self.patience
         }
 
         print("Iteration vectors:")
@@ -102,6 +189,30 @@ class CGEngineWrapper(object):
 
         return (vect.get_feature_names(), np.array(keep) & np.array(addl_keep))
 
+    def read_vocabulary(self, DIRECTORY_DATA, VOCABULARY_FILE_NAME="/vocabulary.txt"):
+        '''
+        Reads the vocabulary written by BrowseCloudArtifactGenerator.write_vocabulary, in id order.
+        '''
+        vocabulary = []
+        with open(DIRECTORY_DATA + VOCABULARY_FILE_NAME, encoding="utf-8") as f:
+            for line in f:
+                wordId, word = line.rstrip("\n").split("\t", 1)
+                assert(int(wordId) == len(vocabulary) + 1)
+                vocabulary.append(word)
+        return vocabulary
+
+    def fold_in(self, DIRECTORY_DATA, texts, LEARNED_GRID_FILE_NAME="/CountingGridDataMatrices.mat", batch_size=10000):
+        '''
+        Maps new documents onto an already trained grid without retraining it.
+        texts must be cleaned like the training data, e.g. the 'pos_filtered' column written by NLPCleaner.
+        Returns q( location | document ), len(texts) x E1 x E2.
+        '''
+        vect = CountVectorizer(decode_error="ignore", vocabulary=self.read_vocabulary(DIRECTORY_DATA))
+        X = vect.transform(texts)
+        window = np.array([self.wd_size, self.wd_size])
+        model = CountingGridModel.from_file(DIRECTORY_DATA + LEARNED_GRID_FILE_NAME, window, dtype=self.dtype)
+        return model.transform(X, batch_size=batch_size)
+
     def fit(self, DIRECTORY_DATA, CLEAN_DATA_FILE_NAME, labels, MIN_FREQUENCY, keep, engine):
         vect, X, addl_keep = self.__fitCountVectorizor(
             DIRECTORY_DATA,
@@ -117,19 +228,121 @@ class CGEngineWrapper(object):
         elif engine == "numpy":
             extent = np.array([self.cg_size, self.cg_size])
             window = np.array([self.wd_size, self.wd_size])
-            model = CountingGridModel(extent, window)
+            model = CountingGridModel(extent, window, dtype=self.dtype)
+            chunk_size = self.chunk_size
+            top_k = self.top_k
+            if self.memmap_directory is not None:
+                if self.no_layers > 1:
+                    raise ValueError("Out-of-core training needs layers=1: the layered model holds dense T x P arrays in memory.")
+                top_k = self.MEMMAP_TOP_K if top_k is None else top_k
+                save_counts(X, self.memmap_directory, self.dtype)
+                X = load_counts(self.memmap_directory)
+                chunk_size = self.batch_size if chunk_size is None else chunk_size
+            heartBeaters = self.heartBeaters
+            if self.preview_every is not None:
+                heartBeaters = list(heartBeaters or []) + [PreviewHeartBeater(
+                    DIRECTORY_DATA, X, self.wd_size, self.preview_every, vect.get_feature_names(), self.on_preview
+                )]
             model.fit(
-                X.toarray(),
-                max_iter=100,
+                X,
+                max_iter=self.max_iter,
                 returnSumSquareDifferencesOfPi=False,
                 layers=self.no_layers,
                 noise=.00000001,
                 output_directory=DIRECTORY_DATA,
-                heartBeaters=self.heartBeaters
+                heartBeaters=heartBeaters,
+                tol=self.tol,
+                patience=self.patience,
+                workspace=True,
+                mode=self.mode,
+                batch_size=self.batch_size,
+                processes=self.processes,
+                top_k=top_k,
+                checkpoint_directory=self.checkpoint_directory,
+                checkpoint_every=self.checkpoint_every,
+                checkpoint_seconds=self.checkpoint_seconds,
+                resume=True,
+                on_checkpoint=self.on_checkpoint,
+                restarts=self.restarts,
+                coarse_levels=self.coarse_levels,
+                accelerate=self.accelerate,
+                chunk_size=chunk_size,
+                transport=self.transport,
+                time_budget=self.time_budget
             )
+            if self.accelerate:
+                print("SQUAREM saved about " + str(int(round(model.squarem_iterations_saved))) + " EM iterations.")
         elif engine == "torch":
-            raise ValueError("Not implemented yet.")
+            extent = np.array([self.cg_size, self.cg_size])
+            window = np.array([self.wd_size, self.wd_size])
+            model = CountingGridModelWithGPU(extent, window, device=self.device)
+            model.fit(
+                X,
+                max_iter=self.max_iter,
+                layers=self.no_layers,
+                noise=.00000001,
+                output_directory=DIRECTORY_DATA,
+                heartBeaters=self.heartBeaters,
+                threads=self.processes
+            )
         else:
             raise ValueError("The {} engine does not exist.".format(engine))
 
         return (vect.get_feature_names(), np.array(keep) & np.array(addl_keep))
+
+    def sweep(self, DIRECTORY_DATA, CLEAN_DATA_FILE_NAME, labels, MIN_FREQUENCY, keep, configurations, held_out=0.1, write_all=False):
+        '''
+        Vectorizes the documents once and fits every (extent, window, layers) configuration with the numpy engine,
+        self.processes at a time, scoring each on the log-likelihood of a random held_out fraction of the documents.
+        The learned matrices of the best configuration, or of all of them if write_all is True, go into a subdirectory
+        of DIRECTORY_DATA each, and every score into sweep.tsv.
+        Returns the vocabulary, keep, the results of HyperparameterSweep.run and the ones written, best first,
+        with their subdirectory under "directory".
+        '''
+        vect, X, addl_keep = self.__fitCountVectorizor(
+            DIRECTORY_DATA,
+            CLEAN_DATA_FILE_NAME,
+            labels,
+            MIN_FREQUENCY
+        )
+        X = sp.sparse.csr_matrix(X, dtype=self.dtype)
+
+        with HyperparameterSweep(X, held_out, self.dtype, self.processes) as sweep:
+            results = sweep.run(
+                configurations, self.max_iter, tol=self.tol, patience=self.patience, workspace=True, top_k=self.top_k
+            )
+        T_held_out = max(1, int(round(held_out * X.shape[0])))
+        pd.DataFrame({
+            "extent": [" x ".join(str(e) for e in result["extent"]) for result in results],
+            "window": [" x ".join(str(w) for w in result["window"]) for result in results],
+            "layers": [result["layers"] for result in results],
+            "held_out_log_likelihood": [result["score"] for result in results],
+            "per_document": [result["score"] / T_held_out for result in results]
+        }).to_csv(DIRECTORY_DATA + "/sweep.tsv", sep="\t", index=False)
+
+        best = HyperparameterSweep.best(results)
+        written = [best] + [result for result in results if result is not best and write_all]
+        for result in written:
+            result["directory"] = DIRECTORY_DATA + "/extent{}x{}_window{}x{}_layers{}".format(
+                result["extent"][0], result["extent"][1], result["window"][0], result["window"][1], result["layers"]
+            )
+            if not os.path.isdir(result["directory"]):
+                os.mkdir(result["directory"])
+            self.__write_grid(X, result, result["directory"])
+
+        return (vect.get_feature_names(), np.array(keep) & np.array(addl_keep), results, written)
+
+    def __write_grid(self, X, result, directory):
+        # The held-out documents are mapped onto the grid as well
+        model = CountingGridModel(result["extent"], result["window"], dtype=self.dtype)
+        model.pi = result["pi"]
+        model.h = model.compute_h(model.pi, model.window)
+        model.q = model.transform(X, self.batch_size)
+        if result["layers"] > 1:
+            # The layers that were scored, with all the documents placed in them
+            layercgdata = model.cg_layers(X, L=result["layers"], pi_la=result["pi_la"])
+        else:
+            layercgdata = model.single_layer(X)
+        if self.top_k is not None:
+            layercgdata["ql2"] = top_k_posterior(layercgdata["ql2"], self.top_k)
+        io.savemat(directory + "/CountingGridDataMatrices.mat", layercgdata)
@@ -12,14 +12,16 @@ from CountingGridsPy.models import CountingGridModel
 
 pTimer = PipelineTimer()
 # Example CLI: python dumpCountingGrids.py CountingGridInput_MarchSurvey 24 5 matlabEngine traditionalInput channelDump.csv
+# Example CLI: python dumpCountingGrids.py CountingGridInput_MarchSurvey 24 5 numpyEngine simpleInput channelDump.csv 1
 errStr = '''
 Please give a valid command-line arguments.
 Instructions found here: https://github.com/microsoft/browsecloud/wiki/Data-Pipeline-Documentation.
+The optional last argument is the number of layers, 2 by default. With 1 the layered stage is skipped.
 '''
 # ---------------------------------------------------------------------------------------
 # Input
 # ---------------------------------------------------------------------------------------
-if len(sys.argv) != 7:
+if len(sys.argv) not in (7, 8):
     print(((sys.argv)))
     raise ValueError(errStr)
 DIRECTORY_DATA = sys.argv[1]
@@ -28,9 +30,10 @@ WINDOW_SIZE = int(sys.argv[3])
 engine_type = sys.argv[4]
 inputfile_type = sys.argv[5]
 inputfile_name = sys.argv[6]
-if engine_type != "numpyEngine" and engine_type != "matlabEngine":
+LAYERS = int(sys.argv[7]) if len(sys.argv) == 8 else 2
+if engine_type not in ("numpyEngine", "matlabEngine", "torchEngine"):
     raise ValueError(
-        "The {0} engine does not exist. Please use 'matlabEngine' or 'numpyEngine'.".format(engine_type))
+        "The {0} engine does not exist. Please use 'matlabEngine', 'numpyEngine' or 'torchEngine'.".format(engine_type))
 engine_type = engine_type[:-6]  # 6 characters in the word "Engine"
 if inputfile_type != "metadataInput" and inputfile_type != "simpleInput":
     raise ValueError(
@@ -69,7 +72,7 @@ else:
 
 pTimer("Learning counting grid.")
 LEARNED_GRID_FILE_NAME = "/CountingGridDataMatrices.mat"
-engine = CGEngineWrapper(extent_size=EXTENT_SIZE, window_size=WINDOW_SIZE)
+engine = CGEngineWrapper(extent_size=EXTENT_SIZE, window_size=WINDOW_SIZE, layers=LAYERS)
 vocabulary = None
 
 # ---------------------------------------------------------------------------------------
@@ -89,7 +92,8 @@ pTimer("Generating counting grid artifacts.")
 LINK_FILE_NAME = ""
 bcag = BrowseCloudArtifactGenerator(DIRECTORY_DATA)
 bcag.read(LEARNED_GRID_FILE_NAME)
-bcag.write_docmap(engine.wd_size, engine=engine_type)
+# The torch engine writes the same matrices as the numpy engine
+bcag.write_docmap(engine.wd_size, engine="matlab" if engine_type == "matlab" else "numpy")
 bcag.write_counts()
 bcag.write_vocabulary(vocabulary)
 bcag.write_top_pi()
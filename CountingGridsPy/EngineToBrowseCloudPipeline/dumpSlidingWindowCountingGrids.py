@@ -12,6 +12,12 @@ from CountingGridsPy.models import CountingGridModel
 
 pTimer = PipelineTimer()
 # Example CLI: python dumpSlidingWindowCountingGrids.py CalculatorDataExperiment6 24 5 numpyEngine simpleTimeInput CalculatorUIFData.txt
+# Example CLI: python dumpSlidingWindowCountingGrids.py CalculatorDataExperiment6 24 5 numpyEngine simpleTimeInput CalculatorUIFData.txt 100
+# Example CLI: python dumpSlidingWindowCountingGrids.py CalculatorDataExperiment6 24 5 numpyEngine simpleTimeInput CalculatorUIFData.txt 7D 1D
+# Windows of 2000 documents move one document at a time, and only every WRITE_EVERY-th of them (100 by default, the
+# optional 7th argument) is written, since writing a window costs as much as its 2000 documents.
+# The last two arguments of the second example are optional: the span and step of windows over the time column instead.
+# With them, a rerun on the same file with new days appended resumes from the last window instead of starting over.
 errStr = '''
 Please give a valid command-line arguments.
 Instructions found here: https://github.com/microsoft/browsecloud/wiki/Data-Pipeline-Documentation.
@@ -21,7 +27,7 @@ Instructions found here: https://github.com/microsoft/browsecloud/wiki/Data-Pipe
 # Input
 # ---------------------------------------------------------------------------------------
 
-if len(sys.argv) != 7:
+if len(sys.argv) not in [7, 8, 9]:
     print(((sys.argv)))
     raise ValueError(errStr)
 DIRECTORY_DATA = sys.argv[1]
@@ -30,6 +36,8 @@ WINDOW_SIZE = int(sys.argv[3])
 engine_type = sys.argv[4]
 inputfile_type = sys.argv[5]
 inputfile_name = sys.argv[6]
+WRITE_EVERY = int(sys.argv[7]) if len(sys.argv) == 8 else 100
+SPAN, STEP = sys.argv[7:9] if len(sys.argv) == 9 else [None, None]
 if engine_type != "numpyEngine":
     raise ValueError("The {0} engine does not exist.".format(engine_type))
 engine_type = engine_type[:-6]  # 6 characters in the word "Engine"
@@ -54,13 +62,16 @@ correspondences = None
 CACHED_CORRESPONDENCES_FILE_NAME = "\cached_correspondences.tsv"
 pTimer("Reading data file.")
 df, keep = cleaner.read(FILE_NAME, inputfile_type, MIN_FREQUENCY, MIN_WORDS)
-if not (os.path.exists(DIRECTORY_DATA + CACHED_CORRESPONDENCES_FILE_NAME) and os.path.exists(DIRECTORY_DATA + CLEAN_DATA_FILE_NAME)):
+if not (os.path.exists(DIRECTORY_DATA + CACHED_CORRESPONDENCES_FILE_NAME) and os.path.exists(DIRECTORY_DATA + CLEAN_DATA_FILE_NAME)) or (
+    # New documents were appended since the data was cleaned
+    cleaner.cached_rows(DIRECTORY_DATA, CACHED_CORRESPONDENCES_FILE_NAME) != len(df)
+):
     pTimer("Starting data cleaning.")
     cleaner.handle_negation_tokens()
     cleaner.removePunctuation()
     correspondences = cleaner.lemmatize()
     cleaner.write_cached_correspondences(
-        DIRECTORY_DATA, CACHED_CORRESPONDENCES_FILE_NAME)
+        DIRECTORY_DATA, CACHED_CORRESPONDENCES_FILE_NAME, rows=len(df))
     cleaner.write(DIRECTORY_DATA, CLEAN_DATA_FILE_NAME)
 else:
     pTimer("Skipping data cleaning.")
@@ -75,9 +86,14 @@ try:
     # ---------------------------------------------------------------------------------------
     # Learning
     # ---------------------------------------------------------------------------------------
-    if not os.path.exists(DIRECTORY_DATA + LEARNED_GRID_FILE_NAME):
+    if SPAN is not None:
+        vocabulary, keep = engine.incremental_fit(DIRECTORY_DATA, CLEAN_DATA_FILE_NAME, cleaner.labelsS,
+                                                  MIN_FREQUENCY, keep, engine=engine_type, initial_max_iter=100, w=SPAN, s=STEP, runInitialTrain=True,
+                                                  times=df["time"].tolist())
+    elif not os.path.exists(DIRECTORY_DATA + LEARNED_GRID_FILE_NAME):
         vocabulary, keep = engine.incremental_fit(DIRECTORY_DATA, CLEAN_DATA_FILE_NAME, cleaner.labelsS,
-                                                  MIN_FREQUENCY, keep, engine=engine_type, initial_max_iter=100, w=2000, s=1, runInitialTrain=True)
+                                                  MIN_FREQUENCY, keep, engine=engine_type, initial_max_iter=100, w=2000, s=1, runInitialTrain=True,
+                                                  incremental=True, write_every=WRITE_EVERY)
     else:
         vocabulary, keep = engine.get_vocab(
             DIRECTORY_DATA, CLEAN_DATA_FILE_NAME, cleaner.labelsS, MIN_FREQUENCY, keep)
@@ -96,7 +112,11 @@ finally:
     for i, folder in enumerate(dataFolders):
         LINK_FILE_NAME = ""
         bcag = BrowseCloudArtifactGenerator(folder)
-        if os.path.exists(folder + LEARNED_GRID_FILE_NAME):
+        # Folders whose artifacts are newer than their grid were not retrained by a resumed run
+        if os.path.exists(folder + LEARNED_GRID_FILE_NAME) and not (
+            os.path.exists(folder + "/docmap.txt") and
+            os.path.getmtime(folder + "/docmap.txt") >= os.path.getmtime(folder + LEARNED_GRID_FILE_NAME)
+        ):
             bcag.read(LEARNED_GRID_FILE_NAME)
             bcag.write_docmap(engine.wd_size, engine=engine_type)
             bcag.write_counts()
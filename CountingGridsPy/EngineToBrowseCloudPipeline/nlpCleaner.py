@@ -190,11 +190,16 @@ class NLPCleaner(object):
         df.to_csv(DIRECTORY_DATA + CLEAN_DATA_FILE_NAME,
                   sep="\t", encoding="utf-8")
 
-    def write_cached_correspondences(self, DIRECTORY_DATA, CACHED_CORRESPONDENCES_FILE_NAME):
+    def write_cached_correspondences(self, DIRECTORY_DATA, CACHED_CORRESPONDENCES_FILE_NAME, rows=None):
+        '''
+        rows, e.g. the number of documents that were cleaned, is saved along with the correspondences; see cached_rows.
+        '''
         df = pd.DataFrame(columns=['lemma', 'words'])
         df['lemma'] = [lemma for lemma in self.corrispondences]
         df['words'] = [self.corrispondences[lemma]
                        for lemma in self.corrispondences]
+        if rows is not None:
+            df['rows'] = rows
         df.to_csv(DIRECTORY_DATA + CACHED_CORRESPONDENCES_FILE_NAME,
                   sep="\t", encoding="utf-8")
 
@@ -205,3 +210,11 @@ class NLPCleaner(object):
         for key, val in zip(df['lemma'], df['words']):
             correspondences[key] = val
         return correspondences
+
+    def cached_rows(self, DIRECTORY_DATA, CACHED_CORRESPONDENCES_FILE_NAME):
+        '''
+        The rows saved with the cached correspondences, or None. Only reads the first line of them.
+        '''
+        df = pd.read_csv(
+            DIRECTORY_DATA + CACHED_CORRESPONDENCES_FILE_NAME, sep="\t", encoding="utf-8", nrows=1)
+        return int(df['rows'][0]) if 'rows' in df and len(df) > 0 else None
@@ -0,0 +1,49 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+from CountingGridsPy.EngineToBrowseCloudPipeline import BrowseCloudArtifactGenerator
+
+
+class PreviewHeartBeater(object):
+    '''
+    A heart beater for CountingGridModel.fit that writes rough BrowseCloud artifacts of the grid while it trains:
+    top_pi.txt whenever the iteration count passes a multiple of every, and docmap.txt as well when the model's q comes
+    from its latest E-step (model.q_is_current), which online, pooled and streaming fits never have.
+    The final artifacts written after training replace them.
+    '''
+
+    def __init__(self, DIRECTORY_DATA, data, window_size, every=10, vocabulary=None, on_preview=None):
+        self.DIRECTORY_DATA = DIRECTORY_DATA
+        # The documents the model is trained on, for the inverse document frequencies of pi2_idf
+        self.data = data
+        self.window_size = window_size
+        self.every = every
+        # SQUAREM moves the iteration count forward by 3 or 4 at a time
+        self.last_preview = 0
+        # Written along with the first preview, since top_pi.txt refers to the words by id
+        self.vocabulary = vocabulary
+        # Called with the paths of the files of every preview, e.g. to upload them
+        self.on_preview = on_preview
+
+    def makeProgress(self, progress: int):
+        pass
+
+    def preview(self, model, iteration):
+        if iteration // self.every <= self.last_preview // self.every:
+            return
+        self.last_preview = iteration
+        matrices = model.single_layer(self.data)
+        del matrices["counts_to_show"]
+        bcag = BrowseCloudArtifactGenerator(self.DIRECTORY_DATA)
+        bcag.set_matrices(matrices)
+        bcag.write_top_pi()
+        files = [self.DIRECTORY_DATA + "/top_pi.txt"]
+        if model.q_is_current:
+            bcag.write_docmap(self.window_size)
+            files.append(self.DIRECTORY_DATA + "/docmap.txt")
+        if self.vocabulary is not None:
+            bcag.write_vocabulary(self.vocabulary)
+            files.append(self.DIRECTORY_DATA + "/vocabulary.txt")
+            self.vocabulary = None
+        if self.on_preview is not None:
+            self.on_preview(files)
@@ -3,9 +3,14 @@
 
 import numpy as np
 import os
+from scipy import io
+from CountingGridsPy.models.SlidingWindowEM import SlidingWindowEM
 
 
 class SlidingWindowTrainer():
+    # Where TimeSlidingTrainer keeps the state of its last window, in its output directory
+    STATE_FILE_NAME = "/sliding_window_state.npz"
+
     @staticmethod
     def SlidingTrainer(w: int, s: int, training_max_iter_vec: list, train, kwargs: dict, runInitialTrain=True):
         '''
@@ -20,7 +25,7 @@ class SlidingWindowTrainer():
         data = kwargs['data']
         root_dir = kwargs["output_directory"].replace(
             ".", "").replace("/", "").replace("\\", "")
-        T = len(data)
+        T = data.shape[0]
         assert(w < T)
         max_sliding_window_size = int(np.ceil((T-w)/s) + 1)
         assert(len(training_max_iter_vec) == max_sliding_window_size)
@@ -42,3 +47,154 @@ class SlidingWindowTrainer():
             last_index = min(last_index + s, T)
             first_index = min(first_index + s, T)
         assert(last_index >= T)
+
+    @staticmethod
+    def IncrementalSlidingTrainer(
+        w: int, s: int, model, data, output_directory: str, initial_max_iter=100, warm_iterations=3, layers=1,
+        runInitialTrain=True, write_every=1, **fit_kwargs
+    ):
+        '''
+        Assume: data is sorted by date
+        SlidingTrainer for a CountingGridModel, except that the windows are not retrained from scratch: SlidingWindowEM
+        moves the statistics of the previous window by the s documents that leave and enter it, and runs warm_iterations
+        EM iterations over the entering ones, so a step costs O(s) E-steps rather than O(w).
+        The grid starts from a fit to all of data if runInitialTrain is True (written to output_directory),
+        and from a fit to the first window otherwise.
+        The matrices of every write_every-th window and of the last one are written like fit writes them; that costs O(w).
+        '''
+        root_dir = output_directory.replace(
+            ".", "").replace("/", "").replace("\\", "")
+        T = data.shape[0]
+        assert(w < T)
+        print("Learning Initial Grid.")
+        if runInitialTrain:
+            model.fit(data, max_iter=initial_max_iter, layers=layers, output_directory=output_directory, **fit_kwargs)
+        else:
+            model.fit(data[:w], max_iter=initial_max_iter, writeOutput=False, **fit_kwargs)
+
+        window = SlidingWindowEM(model, data, w)
+        max_sliding_window_size = int(np.ceil((T-w)/s) + 1)
+        first_index = 0
+        last_index = min(w, T)
+        for i in range(max_sliding_window_size):
+            print("Learning grid window from first index: " +
+                  str(first_index) + " to second index: " + str(last_index))
+            window.slide(first_index, last_index, warm_iterations)
+            if i % write_every == 0 or i == max_sliding_window_size - 1:
+                directory = "./" + root_dir + "/iter" + str(i)
+                if not (os.path.exists(directory) and os.path.isdir(directory)):
+                    os.mkdir(directory)
+                SlidingWindowTrainer.write_window(model, window, layers, directory)
+
+            last_index = min(last_index + s, T)
+            first_index = min(first_index + s, T)
+        assert(last_index >= T)
+
+    @staticmethod
+    def write_window(model, window, layers, directory):
+        '''
+        Writes the CountingGridDataMatrices.mat of the current window of a SlidingWindowEM, layered if layers > 1.
+        '''
+        data = window.data[window.first:window.last]
+        model.q = window.window_q()
+        matrices = model.cg_layers(data, L=layers) if layers > 1 else model.single_layer(data)
+        io.savemat(directory + "/CountingGridDataMatrices.mat", matrices)
+
+    @staticmethod
+    def time_windows(times, span, step, origin=None):
+        '''
+        The windows of the documents whose times fall in [origin + k * step, origin + k * step + span), for k = 0, 1, ...
+        up to the first window that reaches past the last time. times are sorted numbers, or np.datetime64 with
+        np.timedelta64 span and step, and origin defaults to times[0]. Each window is found by binary search on times.
+        Windows with no documents, or with the same documents as the window before, are left out.
+        Returns the arrays k, first and last: window k holds the documents first to last - 1.
+        '''
+        times = np.asarray(times)
+        if np.any(times[1:] < times[:-1]):
+            raise ValueError("The documents must be sorted by time.")
+        origin = times[0] if origin is None else origin
+        k = np.arange(max(0, int(np.floor((times[-1] - origin - span) / step)) + 1) + 1)
+        starts = origin + k * step
+        first = np.searchsorted(times, starts, side="left")
+        last = np.searchsorted(times, starts + span, side="left")
+        changed = last > first
+        changed[1:] &= (first[1:] != first[:-1]) | (last[1:] != last[:-1])
+        return (k[changed], first[changed], last[changed])
+
+    @staticmethod
+    def saved_vocabulary(output_directory: str):
+        '''
+        The vocabulary saved with the state of TimeSlidingTrainer in output_directory, or None.
+        A resumed grid must count the words of the new documents with it.
+        '''
+        state_file_name = output_directory + SlidingWindowTrainer.STATE_FILE_NAME
+        if not os.path.exists(state_file_name):
+            return None
+        with np.load(state_file_name) as f:
+            return f["vocabulary"].tolist() if "vocabulary" in f.files else None
+
+    @staticmethod
+    def TimeSlidingTrainer(
+        times, span, step, model, data, output_directory: str, initial_max_iter=100, warm_iterations=3, layers=1,
+        runInitialTrain=True, origin=None, vocabulary=None, **fit_kwargs
+    ):
+        '''
+        Assume: data is sorted by date, and times holds the time of each document
+        IncrementalSlidingTrainer over the windows of time_windows(times, span, step, origin) rather than windows of
+        w documents; window k is written to output_directory/iter<k>.
+        After each window, its state is saved to output_directory/sliding_window_state.npz, along with vocabulary.
+        If that file exists, training resumes from it with neither the initial grid nor the windows already written,
+        so rerunning with the documents of a new day appended only trains and writes the windows that changed.
+        '''
+        root_dir = output_directory.replace(
+            ".", "").replace("/", "").replace("\\", "")
+        state_file_name = output_directory + SlidingWindowTrainer.STATE_FILE_NAME
+        times = np.asarray(times)
+        assert(len(times) == data.shape[0])
+        state = None
+        if os.path.exists(state_file_name):
+            with np.load(state_file_name) as f:
+                state = {key: f[key] for key in ["origin", "span", "step", "first", "last"]}
+            if state["span"] != span or state["step"] != step:
+                raise ValueError("The windows saved in {} have a different span or step.".format(state_file_name))
+            origin = state["origin"][()]
+        windows = SlidingWindowTrainer.time_windows(times, span, step, origin)
+        origin = times[0] if origin is None else origin
+        capacity = int(np.max(windows[2] - windows[1]))
+
+        done = -1
+        if state is not None:
+            print("Resuming from " + state_file_name + ".")
+            capacity = max(capacity, int(state["last"] - state["first"]))
+            model.initializePi(data)
+            window = SlidingWindowEM(model, data, capacity)
+            saved = window.resume(state_file_name)
+            if not np.array_equal(saved["times"], times[window.first:window.last]):
+                raise ValueError("The documents of the window saved in {} have changed.".format(state_file_name))
+            done = int(saved["window"])
+            if vocabulary is None and "vocabulary" in saved:
+                vocabulary = saved["vocabulary"]
+        else:
+            print("Learning Initial Grid.")
+            if runInitialTrain:
+                model.fit(data, max_iter=initial_max_iter, layers=layers, output_directory=output_directory, **fit_kwargs)
+            else:
+                model.fit(data[windows[1][0]:windows[2][0]], max_iter=initial_max_iter, writeOutput=False, **fit_kwargs)
+            window = SlidingWindowEM(model, data, capacity)
+
+        for k, first_index, last_index in zip(*windows):
+            # The last window written may have gained documents since
+            if k < done:
+                continue
+            print("Learning grid window " + str(k) + " from first index: " +
+                  str(first_index) + " to second index: " + str(last_index))
+            if not window.slide(first_index, last_index, warm_iterations):
+                continue
+            directory = "./" + root_dir + "/iter" + str(k)
+            if not (os.path.exists(directory) and os.path.isdir(directory)):
+                os.mkdir(directory)
+            SlidingWindowTrainer.write_window(model, window, layers, directory)
+            arrays = {"origin": origin, "span": span, "step": step, "window": k, "times": times[first_index:last_index]}
+            if vocabulary is not None:
+                arrays["vocabulary"] = np.array(vocabulary)
+            window.save(state_file_name, **arrays)
@@ -0,0 +1,100 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+from CountingGridsPy.EngineToBrowseCloudPipeline import BrowseCloudArtifactGenerator, CGEngineWrapper, NLPCleaner, PipelineTimer
+import itertools
+import sys
+import os
+
+pTimer = PipelineTimer()
+# Example CLI: python sweepCountingGrids.py CountingGridInput_MarchSurvey 16,24,32 3,5 2 simpleInput channelDump.csv
+# Example CLI: python sweepCountingGrids.py CountingGridInput_MarchSurvey 16,24,32 3,5 1,2 simpleInput channelDump.csv all
+errStr = '''
+Please give a valid command-line arguments.
+Like dumpCountingGrids.py, except that the extent sizes, window sizes and numbers of layers are comma-separated lists.
+Every combination is trained with the numpy engine, and the artifacts are written for the one with the highest
+held-out likelihood, or for all of them when the last argument is "all".
+'''
+# ---------------------------------------------------------------------------------------
+# Input
+# ---------------------------------------------------------------------------------------
+if len(sys.argv) not in (7, 8) or (len(sys.argv) == 8 and sys.argv[7] != "all"):
+    print(((sys.argv)))
+    raise ValueError(errStr)
+DIRECTORY_DATA = sys.argv[1]
+EXTENT_SIZES = [int(x) for x in sys.argv[2].split(",")]
+WINDOW_SIZES = [int(x) for x in sys.argv[3].split(",")]
+LAYERS = [int(x) for x in sys.argv[4].split(",")]
+inputfile_type = sys.argv[5]
+inputfile_name = sys.argv[6]
+WRITE_ALL = len(sys.argv) == 8
+if inputfile_type != "metadataInput" and inputfile_type != "simpleInput":
+    raise ValueError(
+        "The {0} input type does not exist. Please use 'simpleInput' or 'metadataInput'.".format(inputfile_type))
+inputfile_type = inputfile_type[:-5]  # remove "Input"
+CONFIGURATIONS = [
+    (extent, window, layers) for extent, window, layers in itertools.product(EXTENT_SIZES, WINDOW_SIZES, LAYERS) if window <= extent
+]
+if len(CONFIGURATIONS) == 0:
+    raise ValueError("Every window is larger than every extent.\n" + errStr)
+
+if not os.path.isdir(DIRECTORY_DATA):
+    raise ValueError(
+        "Undefined local directory where digital channel is dumped!\n" + errStr)
+
+FILE_NAME = DIRECTORY_DATA + "\\" + inputfile_name
+
+CLEAN_DATA_FILE_NAME, MIN_FREQUENCY, MIN_WORDS = ["\cg-processed.tsv", 2, 5]
+
+# ---------------------------------------------------------------------------------------
+# Data Cleaning, once for all the configurations
+# ---------------------------------------------------------------------------------------
+
+cleaner = NLPCleaner()
+correspondences = None
+CACHED_CORRESPONDENCES_FILE_NAME = "\cached_correspondences.tsv"
+pTimer("Reading data file.")
+df, keep = cleaner.read(FILE_NAME, inputfile_type, MIN_FREQUENCY, MIN_WORDS)
+if not (os.path.exists(DIRECTORY_DATA + CACHED_CORRESPONDENCES_FILE_NAME) and os.path.exists(DIRECTORY_DATA + CLEAN_DATA_FILE_NAME)):
+    pTimer("Starting data cleaning.")
+    cleaner.handle_negation_tokens()
+    cleaner.removePunctuation()
+    correspondences = cleaner.lemmatize()
+    cleaner.write_cached_correspondences(
+        DIRECTORY_DATA, CACHED_CORRESPONDENCES_FILE_NAME)
+    cleaner.write(DIRECTORY_DATA, CLEAN_DATA_FILE_NAME)
+else:
+    pTimer("Skipping data cleaning.")
+    correspondences = cleaner.read_cached_correspondences(
+        DIRECTORY_DATA, CACHED_CORRESPONDENCES_FILE_NAME)
+
+# ---------------------------------------------------------------------------------------
+# Learning
+# ---------------------------------------------------------------------------------------
+pTimer("Learning {} counting grids.".format(len(CONFIGURATIONS)))
+engine = CGEngineWrapper()
+vocabulary, keep, results, written = engine.sweep(
+    DIRECTORY_DATA, CLEAN_DATA_FILE_NAME, cleaner.labelsS, MIN_FREQUENCY, keep, CONFIGURATIONS, write_all=WRITE_ALL)
+for result in results:
+    print("extent {}, window {}, layers {}: held-out log-likelihood {}".format(
+        result["extent"][0], result["window"][0], result["layers"], result["score"]))
+
+# ---------------------------------------------------------------------------------------
+# Output
+# ---------------------------------------------------------------------------------------
+pTimer("Generating counting grid artifacts.")
+LEARNED_GRID_FILE_NAME = "/CountingGridDataMatrices.mat"
+for result in written:
+    bcag = BrowseCloudArtifactGenerator(result["directory"])
+    bcag.read(LEARNED_GRID_FILE_NAME)
+    bcag.write_docmap(result["window"][0], engine="numpy")
+    bcag.write_counts()
+    bcag.write_vocabulary(vocabulary)
+    bcag.write_top_pi()
+    bcag.write_top_pi_layers()
+    bcag.write_colors()  # write default blue colors
+    bcag.write_database(df, keep)
+    bcag.write_correspondences(correspondences, vocabulary)
+    bcag.write_keep(keep)
+
+pTimer("Done.")
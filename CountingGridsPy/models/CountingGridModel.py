@@ -1,11 +1,19 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
+import json
 import math
 import os
+import time
 import numpy as np
 import scipy.io
+import scipy.sparse
+import scipy.special
 import scipy.stats
+from CountingGridsPy.models import FusedKernels
+from CountingGridsPy.models.DistributedEStep import DistributedEStep
+from CountingGridsPy.models.ProcessPoolEStep import ProcessPoolEStep
+from CountingGridsPy.models.RandomRestarts import RandomRestarts
 
 np.random.seed(0)
 # Two functions for use by users of the library:
@@ -18,13 +26,128 @@ np.random.seed(0)
 # the probability of the data given the parameters and choice of window
 
 
+# data is a T x Z count matrix: either a dense ndarray or a scipy.sparse matrix.
+# Sparse matrices are kept in CSR form so that memory scales with the number of nonzeros.
+def dot_data_transpose(A, data, out=None):
+    '''
+    Computes A . data^T for a P x Z dense matrix A, returning a P x T ndarray.
+    out is only written to for dense data, so always use the returned array.
+    '''
+    if scipy.sparse.issparse(data):
+        return np.transpose(np.asarray(data.dot(np.transpose(A))))
+    return np.dot(A, np.transpose(data), out=out)
+
+
+def dot_data(A, data, out=None):
+    '''
+    Computes A . data for a P x T dense matrix A, returning a P x Z ndarray.
+    out is only written to for dense data, so always use the returned array.
+    '''
+    if scipy.sparse.issparse(data):
+        return np.transpose(np.asarray(data.T.dot(np.transpose(A))))
+    return np.dot(A, data, out=out)
+
+
+def top_k_posterior(q, k):
+    '''
+    Truncates q( location | document ), T x E1 x E2, to its k most likely locations per document.
+    Returns a T x P scipy.sparse.csr_matrix whose rows are renormalized to sum to one.
+    '''
+    T = q.shape[0]
+    P = int(np.prod(q.shape[1:]))
+    k = min(k, P)
+    q = np.reshape(np.moveaxis(q, 0, -1), (P, T))
+    indices = np.argpartition(q, P - k, axis=0)[P - k:]
+    values = np.take_along_axis(q, indices, axis=0)
+    values /= np.sum(values, axis=0)
+    return scipy.sparse.csr_matrix(
+        (np.transpose(values).flatten(), np.transpose(indices).flatten(), np.arange(0, T * k + 1, k)),
+        shape=(T, P)
+    )
+
+
+def inverse_document_frequency(data, dtype=np.float64):
+    '''
+    log(T / document frequency) of every feature of the T x Z documents, the weights of pi2_idf and pi_la_idf.
+    '''
+    eps = np.finfo(np.float64).eps
+    document_frequency = np.asarray((data > 0).sum(axis=0), dtype=np.float64).flatten()
+    return (np.log(data.shape[0] + eps) - np.log(document_frequency + eps)).astype(dtype)
+
+
+def toroidal_fill(out, a, shift=(0, 0)):
+    '''
+    Fills out with a tiled toroidally over the first two axes, without temporaries:
+    out[i, j] = a[(i - shift[0]) % E0, (j - shift[1]) % E1]
+    This is np.pad(a, ..., 'wrap') written into an existing buffer.
+    '''
+    def blocks(n, E, s):
+        i = 0
+        while i < n:
+            start = (i - s) % E
+            length = min(E - start, n - i)
+            yield slice(i, i + length), slice(start, start + length)
+            i += length
+
+    for out_rows, a_rows in blocks(out.shape[0], a.shape[0], shift[0]):
+        for out_cols, a_cols in blocks(out.shape[1], a.shape[1], shift[1]):
+            out[out_rows, out_cols] = a[a_rows, a_cols]
+
+
+def toroidal_upsample(a, extent):
+    '''
+    Resizes a over its first two axes to extent by linear interpolation on the torus,
+    so the last row and column blend into the first ones.
+    '''
+    for axis, E in enumerate(extent):
+        e = a.shape[axis]
+        x = (np.arange(E) + 0.5) * e / E - 0.5
+        lower = np.floor(x).astype(int)
+        weight = np.reshape(x - lower, [-1] + [1] * (a.ndim - axis - 1))
+        a = np.take(a, lower % e, axis=axis) * (1 - weight) + np.take(a, (lower + 1) % e, axis=axis) * weight
+    return a
+
+
+def window_sums_in_place(S, w0, w1, E0, E1, first=0):
+    '''
+    Turns the summed area table S into sums over w0 x w1 windows, in place.
+    Returns the E0 x E1 view whose [i, j] entry is
+    S[first+i+w0, first+j+w1] - S[first+i, first+j+w1] - S[first+i+w0, first+j] + S[first+i, first+j]
+    Rows and columns are differenced from the end, so each subtraction reads entries that are not yet modified.
+    '''
+    for r in range(first + E0 + w0 - 1, first + w0 - 1, -1):
+        np.subtract(S[r], S[r - w0], out=S[r])
+    rows = S[first + w0:first + w0 + E0]
+    for c in range(first + E1 + w1 - 1, first + w1 - 1, -1):
+        np.subtract(rows[:, c], rows[:, c - w1], out=rows[:, c])
+    return rows[:, first + w1:first + w1 + E1]
+
+
 class CountingGridModel():
-    def __init__(self, extent, window):
+    def __init__(self, extent, window, dtype=np.float64, seed=None, compiled=None):
         """
         extent is a 1-D array of size D in the paper.
         D is often 2, since it makes the model easily visualizable.
         window is a one-dimensional of size D in the paper.
+        dtype is the floating point type used for q, pi, h and the layered buffers.
+        float32 halves memory traffic; sums that are prone to cancellation are still accumulated in float64.
+        seed, if given, seeds a np.random.Generator of this model (self.rng).
+        Otherwise the model draws from the global np.random state.
+        compiled selects the fused numba kernels of FusedKernels.py for the E-step normalization and the window sums
+        of compute_h and the M-step. None uses them when numba is installed, and numpy otherwise.
+        A compiled model selects numba's fork-safe threading layer before any kernel runs, see
+        FusedKernels.use_fork_safe_threading_layer, since fit forks worker processes for processes > 1 and restarts > 1.
         """
+        if compiled and not FusedKernels.AVAILABLE:
+            raise ImportError("compiled=True needs numba.")
+        self.compiled = FusedKernels.AVAILABLE if compiled is None else compiled
+        if self.compiled:
+            FusedKernels.use_fork_safe_threading_layer()
+        self.seed = seed
+        self.rng = np.random if seed is None else np.random.default_rng(seed)
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.dtype(np.float32), np.dtype(np.float64)):
+            raise ValueError("The {} dtype is not supported. Please use float32 or float64.".format(self.dtype))
 
         # E in the paper
         self.extent = extent
@@ -43,238 +166,272 @@ class CountingGridModel():
 
         self.capacity = self.extent_volume / self.window_volume
 
-    # Assumes:  self.pi, self.q,self.extent are set properly
-    def cg_layers(self, data, L, noise=1e-10):
-        T, Z = data.shape
-        pi_la = np.zeros([self.extent[0], self.extent[1], Z, L])
-        h_la = np.zeros([self.extent[0], self.extent[1], Z, L])
-        
-        # Uses self variable from cg_layers namespace
-        def compute_h(pi, W):
-            PI = np.pad(pi, [(0, W[0]), (0, W[1]), (0, 0)],
-                        'wrap').cumsum(axis=0).cumsum(axis=1)
-            PI = np.pad(PI, [(1, 0), (1, 0), (0, 0)], 'constant')
-            w0 = W[0]
-            w1 = W[1]
-            cumsum_output = self.compute_h_noLoopFull(PI, w0, w1)
-            return np.moveaxis(np.moveaxis(cumsum_output[:-1, :-1, :], 2, 0)/np.sum(cumsum_output[:-1, :-1, :], axis=2), 0, -1)
-
-        # Modifies: h_la
-        def layer_compute_h(pi_la, h_la):
-            h = compute_h(pi_la[:, :, :, l], self.window)
-            h_la[:, :, :, l] = np.transpose(
-                np.transpose(h) / np.transpose(np.sum(h, axis=2))
-            )
+        # Scratch arrays reused across EM iterations. Only set while fit runs in workspace mode.
+        self.workspace = None
 
-        # Add noise to pi
-        for l in range(L):
-            pi_la[:, :, :, l] = (
-                self.pi + np.random.uniform(size=self.pi.shape)*noise
-            )
-            # Normalize
-            pi_la[:, :, :, l] = np.transpose(
-                np.transpose(pi_la[:, :, :, l]) /
-                np.transpose(np.sum(pi_la[:, :, :, l], axis=2))
-            )
-            layer_compute_h(pi_la, h_la)
-        P = np.prod(self.extent)
+    def buffer(self, name, shape, dtype=None):
+        '''
+        Returns an uninitialized scratch array.
+        In workspace mode the array is allocated once per fit and handed out again on later calls with the same name.
+        '''
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        shape = tuple(int(x) for x in shape)
+        if self.workspace is None:
+            return np.empty(shape, dtype=dtype)
+        array = self.workspace.get(name)
+        if array is None or array.shape != shape or array.dtype != dtype:
+            array = np.empty(shape, dtype=dtype)
+            self.workspace[name] = array
+        return array
 
-        # lq/lql is the log of q
-        # lq/lql is shaped as ([P,T])
-        # self.q is stored as TxE1xE2, which is why we
-        def normalize_q(lq):
-            lqlmax = np.amax(lql, axis=0)
-            precompute_lql_minus_max = lql - lqlmax
-            # qla has the same formula, essentially, but not in the log form
-            Lq = np.reshape(
-                precompute_lql_minus_max -
-                np.log(np.sum(np.exp(precompute_lql_minus_max), axis=0)),
-                [self.extent[0], self.extent[1], T]
-            )
-            return np.moveaxis(np.exp(Lq), 2, 0)
+    # Assumes:  self.pi, self.q,self.extent are set properly
+    def cg_layers(self, data, L, noise=1e-10, nmax=2, pi_la=None):
+        '''
+        Splits the learned grid into L layers.
+        nmax is the number of EM iterations. From the second one on, q is refined as well.
+        If pi_la (E1 x E2 x Z x L, e.g. from an earlier cg_layers) is given, the layers are held fixed at it: there is
+        no noise and no M-step, and the iterations only place the documents of data in the layers and on the grid.
+        The layers are stacked along the first axis, so each one is a contiguous pi-sized array and the window sums
+        and the M-step run one layer at a time over the same scratch buffers. Besides the L x P x T layer
+        log-likelihoods, the only layered arrays are pi_la and h_la, and pi_la_idf is written over h_la at the end.
+        pi_la and pi_la_idf are returned as E1 x E2 x Z x L views, ql2 as a view of q and counts_to_show as the
+        transpose of data, which shares its arrays.
+        '''
+        T, Z = data.shape
+        E0, E1 = self.extent
+        w0, w1 = self.window
+        P = E0 * E1
 
-        def update_summand(self, toroidal_F, M, N):
-            A = toroidal_F.cumsum(axis=0).cumsum(axis=1)
-            c = np.pad(
-                A,
-                pad_width=tuple([(1, 0) for x in list(self.extent)] + [(0, 0)]), mode='constant', constant_values=0
-            )
-            w0 = self.window[0]
-            w1 = self.window[1]
-            return (
-                c[slice(w0, toroidal_F.shape[0]+1), slice(w1, toroidal_F.shape[1]+1), :] -
-                c[slice(0, self.extent[0]), slice(w1, toroidal_F.shape[1] + 1), :] -
-                c[slice(w0, toroidal_F.shape[0]+1), slice(0, self.extent[1]), :] +
-                c[slice(0, self.extent[0]), slice(0, self.extent[1]), :]
-            )[slice(0, toroidal_F.shape[0]), slice(0, toroidal_F.shape[1]), :]
+        learn = pi_la is None
+        if learn:
+            # Add noise to pi
+            pi_la = np.empty([L, E0, E1, Z], dtype=self.dtype)
+            for l in range(L):
+                pi_la[l] = self.pi + self.rng.uniform(size=self.pi.shape)*noise
+            pi_la /= np.sum(pi_la, axis=3, keepdims=True)
+        else:
+            pi_la = np.array(np.moveaxis(pi_la, -1, 0), dtype=self.dtype)
+            if pi_la.shape != (L, E0, E1, Z):
+                raise ValueError("pi_la must be E1 x E2 x Z x L.")
 
         # Adding noise to q, which was not originally in the matlab code
-        self.q = self.q + 0.25*noise
-        lql = np.log(np.reshape(np.moveaxis(self.q, 0, -1), (P, T)))
-        self.q = normalize_q(lql)
-        qlsm = qlsm = np.fft.ifft2(np.fft.fft2(
-            np.reshape(self.q, (T, P))
-        )).real.astype(np.float64)
-        lql = np.log(np.reshape(np.moveaxis(self.q, 0, -1), (P, T)))
-
-        # Check the distribution properties of ql
-        '''
-        assert( np.all(np.isclose(np.sum(self.q,axis=0)[:,:],1 ) )==True)
-        assert(np.any((self.q) <0 ) == False)
-        '''
+        # ql is q laid out as [P, T], so the grid is np.reshape(ql, [E0, E1, T])
+        ql = np.reshape(np.moveaxis(self.q, 0, -1), [P, T]) + 0.25*noise
+        ql /= np.sum(ql, axis=0)
 
         alpha = 1e-10
-        miter = 1
 
         SCALING_FACTOR = 2.5
         # ~1/2 the average number of number of word per document, make this number smaller as the counting grid gets bigger
-        pseudocounts = np.mean(np.sum(data, axis=1)) / (P*SCALING_FACTOR)
+        pseudocounts = float(np.mean(np.asarray(data.sum(axis=1))) / (P*SCALING_FACTOR))
         # This is the posterior for each layer Q( Layer | document ).
-        qla = np.ones([L, T])
-        lqla = np.log(qla)
+        qla = np.ones([L, T], dtype=self.dtype)
 
-        plal = np.ones([L, P]) / L  # P(layer | position in counting grid)
-        dirichlet_prior = np.ones([L, Z])
+        plal = np.ones([L, P], dtype=self.dtype) / L  # P(layer | position in counting grid)
+        dirichlet_prior = np.ones([L, Z], dtype=self.dtype)
+        # Dirichlet prior. Does very little in practice, may be useful only in the early stages of learning... leave it.
+        tmpdirip = np.nan_to_num(dirichlet_prior - 1)
 
-        # Didn't implement the fft to smooth the posterior probabilities
-        # of picking a location, differing from previous code by choice.
-        every_iter = 1
-        nmax = 2  # maximum number of iterations
         start_ql = 1
 
-        minp = 1e-10
-        TOROID_ARGUMENTS = [(self.window[0], 0), (self.window[1], 0), (0, 0)]
-        eps = (np.finfo(h_la.dtype).eps)
-        for iter in range(nmax):
-            # assert( np.all(np.isclose(np.sum(np.reshape(np.transpose(self.q),(P,T)),axis=0),1 ) ))
-            # assert(np.any((self.q) <0 ) == False)
-            # assert(np.all(np.isclose(np.sum(qla,axis=0),1 )))
-            # assert(np.any((qla) <0 ) == False)
-
-            if iter >= start_ql:
-                lql = np.zeros([P, T])
+        # float64 machine epsilon regardless of dtype
+        eps = self.dtype.type(np.finfo(np.float64).eps)
+        plal_min = max(1e-100, np.finfo(self.dtype).tiny)
+
+        # The scratch arrays of compute_h and window_sums_ending_at are shared by all the layers
+        workspace, self.workspace = self.workspace, {}
+        try:
+            # Always the numpy implementation, since subclasses hand cg_layers numpy arrays.
+            h_la = np.empty([L, E0, E1, Z], dtype=self.dtype)
+            for l in range(L):
+                h_la[l] = CountingGridModel.compute_h(self, pi_la[l], self.window)
+
+            # log P(document | location, layer)
+            layer_log_likelihoods = np.empty([L, P, T], dtype=np.result_type(self.dtype, data.dtype))
+            for iter in range(nmax):
                 for l in range(L):
-                    tmp = np.reshape(np.log(eps + h_la[:, :, :, l]), [P, Z])
-                    # qla is the Q(layer) in the mean field posterior factorization, its structure is L,T
-                    lql = lql + np.dot(tmp, np.transpose(data))*qla[l, :]
-                    self.q = np.reshape(
-                        normalize_q(lql),
-                        [T, self.extent[0], self.extent[1]]
-                    )
+                    log_h = self.buffer("layer_scratch", [E0, E1, Z])
+                    np.log(np.add(h_la[l], alpha, out=log_h), out=log_h)
+                    layer_log_likelihoods[l] = dot_data_transpose(np.reshape(log_h, [P, Z]), data)
 
-                    # Didn't use the smoothened ql
-                    qlsm = np.fft.ifft2(np.fft.fft2(
-                        np.reshape(self.q, (T, P))
-                    )).real.astype(np.float64)
+                if iter >= start_ql:
+                    # qla is the Q(layer) in the mean field posterior factorization, its structure is L,T
+                    ql = np.einsum("lpt,lt->pt", layer_log_likelihoods, qla)
+                    ql -= np.amax(ql, axis=0)
+                    np.exp(ql, out=ql)
+                    ql /= np.sum(ql, axis=0)
 
-            # update Q(layer)
-            tmpq = np.reshape(np.moveaxis(np.copy(self.q), 0, -1), [P, T])
-            for l in range(L):
-                tmp = np.reshape(np.log(alpha + h_la[:, :, :, l]), [P, Z])
-                lqla[l, :] = np.sum(
-                    tmpq*(np.dot(tmp, np.transpose(data)) +
-                          np.reshape(np.transpose(np.log(plal[l, :])), [P, 1])),
-                    axis=0
+                # update Q(layer)
+                lqla = np.einsum("pt,lpt->lt", ql, layer_log_likelihoods) + np.dot(np.log(plal), ql)
+                lqlamax = np.amax(lqla, axis=0)
+                qla = np.exp(
+                    (lqla - lqlamax) - np.log(np.sum(np.exp((lqla - lqlamax)), axis=0))
                 )
 
-            lqlamax = np.amax(lqla, axis=0)
-            qla = np.exp(
-                (lqla - lqlamax) - np.log(np.sum(np.exp((lqla - lqlamax)), axis=0))
-            )
+                # M-STEP. Basically the normal CG M-Step, one layer at a time, each updating its pi_la and h_la in place.
+                # Weighting the columns of q by qla is the same as weighting the rows of data, without touching data
+                for l in range(L if learn else 0):
+                    QdotConH = np.reshape(dot_data(ql * qla[l, :], data), [E0, E1, Z])
+                    QdotConH += tmpdirip[l]
+                    QdotConH /= np.add(h_la[l], float(w0 * w1 * alpha), out=self.buffer("layer_scratch", [E0, E1, Z]))
+                    QH = self.window_sums_ending_at(QdotConH)
+                    del QdotConH
+
+                    un_pi = pi_la[l]
+                    un_pi += alpha
+                    un_pi *= QH
+                    un_pi += pseudocounts
+                    denom = np.sum(un_pi, axis=2, keepdims=True)
+                    np.divide(un_pi, denom, out=un_pi, where=denom != 0)
+                    un_pi[denom[:, :, 0] == 0] = 1.0/Z
+                    h_la[l] = CountingGridModel.compute_h(self, un_pi, self.window)
 
-            # M-STEP. Basically the normal CG M-Step, repeated #Layers times.
-            # Reimplemented it to include the dirichlet prior in the mix
+                # The matlab code smoothed q with ifft2(fft2(q)) here, which is q itself
+                A = np.sum(ql, axis=1)
+                if np.any(np.isclose(A, 0)):
+                    A += eps
+                plal = np.dot(qla, np.transpose(ql)) / A
+                plal[plal < plal_min] = plal_min
+                plal = plal / np.sum(plal, axis=0)  # sum over the layers
+            del layer_log_likelihoods
+
+            self.q = np.moveaxis(np.reshape(ql, [E0, E1, T]), 2, 0)
+
+            # h_la is not needed anymore
+            pi_la_idf = np.multiply(pi_la, inverse_document_frequency(data, self.dtype), out=h_la)
+            del h_la
+
+            id_layers = np.argmax(qla, axis=0) + 1
+            wg_ep = eps
+            mask = np.pad(np.ones(self.window), [
+                          (0, x) for x in self.extent-self.window], 'constant', constant_values=0)
+            # The window convolution is linear, so the q of a layer's documents are summed first
+            # and there is one FFT per layer rather than one per document.
+            layer_of_document = (id_layers - 1 == np.arange(L)[:, np.newaxis]).astype(np.float64)
+            q_by_layer = np.reshape(np.dot(layer_of_document, np.transpose(ql)), [L, E0, E1])
+            wg = np.fft.ifft2(np.fft.fft2(mask)*np.fft.fft2(q_by_layer)).real  # m x E structure
+
+            # This makes wg not a distribution.
+            wg = (wg / (np.sum(wg, axis=0, keepdims=True) + wg_ep)).astype(self.dtype)
+            # sum over the layers, one layer at a time
+            pi2_idf = np.zeros([E0, E1, Z], dtype=self.dtype)
             for l in range(L):
-                # Dirichlet prior. Does very little in practice, may be useful only in the early stages of learning... leave it.
-                tmpdirip = dirichlet_prior[l, :] - 1
-                tmpdirip[np.isnan(tmpdirip)] = 0
-
-                # Recall that self.q is T x E1 x E2 tensor
-                # Original Matlab code here for reference:
-                #
-                # nrm = bsxfun(@plus, reshape(tmpdirip,[1 1 Z]),
-                # reshape(  reshape( padarray( ql, W, 'circular','pre'),
-                # [prod(cg_size+W),T])*bsxfun( @times, WD, qla(l,:))', [ cg_size+W,Z ]));
-                first = np.reshape(np.pad(np.moveaxis(
-                    self.q, 0, -1), TOROID_ARGUMENTS, 'wrap'), [np.prod(self.extent+self.window), T])
-                # using transpose function make sense here because we're just swapping 2 Dimensions
-                D = np.dot(first, np.transpose(np.transpose(data) * qla[l, :]))
-                nrm = np.reshape(tmpdirip, [1, 1, Z]) + np.reshape(
-                    D, [self.extent[0]+self.window[0], self.extent[1]+self.window[1], Z])
-
-                QH = nrm / \
-                    np.pad(h_la[:, :, :, l] + np.prod(self.window) * alpha, TOROID_ARGUMENTS, 'wrap')
-                QH = QH[slice(1, self.extent[0]+self.window[0]),
-                        slice(1, self.extent[1]+self.window[1]), :]
-                QH = update_summand(self, QH, T, Z)
-                QH[QH < 0] = 0
-
-                un_pi = pseudocounts + QH*(pi_la[:, :, :, l]+alpha)
-                mask = np.sum(un_pi, 2) != 0
-                nmask = np.sum(un_pi, 2) == 0
-                M1 = np.transpose(np.transpose(
-                    un_pi)*np.transpose(mask.astype(np.float64)) / np.transpose(np.sum(un_pi, 2)))
-                M2 = np.ones([Z, self.extent[0], self.extent[1]]) * \
-                    (nmask).astype(np.float64)
-                pi_la[:, :, :, l] = M1 + np.moveaxis((1.0/Z) * M2, 0, 2)
-                layer_compute_h(pi_la, h_la)
-
-            qlsm = np.fft.ifft2(np.fft.fft2(np.reshape(
-                self.q, (T, P)))).real.astype(np.float64)
-            A = np.sum(qlsm, axis=0)
-            if np.any(np.isclose(A, 0)):
-                A += eps
-            plal = np.transpose(np.reshape(np.sum(np.reshape(np.moveaxis(
-                qlsm, 0, -1), [self.extent[0], self.extent[1], T, 1]) * np.reshape(np.transpose(qla), [1, 1, T, L]), axis=2), [P, L]))/A
-            plal[plal < 1e-100] = 1e-100
-            plal = plal / np.sum(plal, axis=0)  # sum over the layers
-
-        INVERSE_DOCUMENT_FREQUENCY = np.log(
-            data.shape[0] + eps) - np.log(np.sum((data > 0).astype(np.float64), axis=0) + eps)
-
-        pi_la_idf = np.zeros(pi_la.shape)
-        for l in range(L):
-            pi_la_idf[:, :, :, l] = pi_la[:, :, :, l] * \
-                INVERSE_DOCUMENT_FREQUENCY
-
-        id_layers = np.argmax(qla, axis=0) + 1
-        wg_ep = eps
-        mask = np.pad(np.ones(self.window), [
-                      (0, x) for x in self.extent-self.window], 'constant', constant_values=0)
-        wg = np.zeros([self.extent[0], self.extent[1], L])
-        for l in range(L):
-            idl = np.where(id_layers-1 == l)[0]  # id_layer in matlab format
-            for t in range(len(idl)):
-                wg[:, :, l] = wg[:, :, l] + np.fft.ifft2(np.fft.fft2(mask)*np.fft.fft2(
-                    self.q[idl[t], :, :])).real.astype(np.float64)  # m x E structure
-
-        # This makes wg not a distribution.
-        wg = np.transpose(np.transpose(
-            wg) / (np.sum(np.transpose(wg), axis=0) + wg_ep))
-        # sum over the layers
-        pi2_idf = np.sum(
-            pi_la_idf*np.reshape(wg, [self.extent[0], self.extent[1], 1, L]), axis=3)
+                pi2_idf += np.multiply(pi_la_idf[l], wg[l, :, :, np.newaxis], out=self.buffer("layer_scratch", [E0, E1, Z]))
+        finally:
+            self.workspace = workspace
 
         # Renormalize Pi after using inverse document frequency.
-        pi2_idf = np.transpose(np.transpose(pi2_idf) /
-                               np.transpose(np.sum(pi2_idf, axis=2)))
+        pi2_idf /= np.sum(pi2_idf, axis=2, keepdims=True)
 
         return {
-            "pi2_idf": pi2_idf, "pi_la_idf": pi_la_idf, "id_layer": [id_layers],
+            "pi2_idf": pi2_idf, "pi_la_idf": np.moveaxis(pi_la_idf, 0, -1), "id_layer": [id_layers],
             "ql2": self.q, "counts_to_show": np.transpose(data), "indices_to_show": [np.array(list(range(T))) + 1],
+            "pi": self.pi, "pi_la": np.moveaxis(pi_la, 0, -1)
+        }
+
+    def single_layer(self, data):
+        '''
+        The matrices of cg_layers for a single layer, read off pi and q without any layered EM, so that
+        BrowseCloudArtifactGenerator can read a grid trained with layers=1. Every document is in the one layer,
+        and pi2_idf is pi weighted by the inverse document frequencies and renormalized: the layer weights wg of
+        cg_layers are then the same at every location and cancel out. ql2 is self.q, dense or sparse, not a copy.
+        '''
+        T, Z = data.shape
+        E0, E1 = self.extent
+        pi_la = np.reshape(self.pi, [E0, E1, Z, 1])
+        pi_la_idf = pi_la * np.reshape(inverse_document_frequency(data, self.dtype), [Z, 1])
+        pi2_idf = pi_la_idf[:, :, :, 0] / np.sum(pi_la_idf[:, :, :, 0], axis=2, keepdims=True)
+        return {
+            "pi2_idf": pi2_idf, "pi_la_idf": pi_la_idf, "id_layer": [np.ones(T, dtype=int)],
+            "ql2": self.q, "counts_to_show": np.transpose(data), "indices_to_show": [np.arange(T) + 1],
             "pi": self.pi, "pi_la": pi_la
         }
 
     def fit(
         self, data, max_iter=100, returnSumSquareDifferencesOfPi=False,
         noise=.000001, learn_pi=True, pi=None, layers=1, output_directory="./",
-        heartBeaters=None, writeOutput=True
+        heartBeaters=None, writeOutput=True, tol=None, patience=1,
+        returnLogLikelihoods=False, workspace=False, mode="batch", batch_size=1000,
+        kappa=0.7, tau=1.0, processes=None, top_k=None, layer_iterations=2,
+        checkpoint_directory=None, checkpoint_every=None, checkpoint_seconds=None, resume=False, on_checkpoint=None,
+        restarts=1, restart_iterations=5, restart_tolerance=0.01, coarse_levels=0, coarse_max_iter=None,
+        accelerate=False, chunk_size=None, materialize_q=True, transport=None, time_budget=None
     ):
         """
         Implements variational expectation maximization for the Counting Grid model
-        Assumes: data is an m x n matrix
-        TO DO: return early if fitness converges. don't just run it for max iter.
+        Assumes: data is an m x n matrix, either a numpy array or a scipy.sparse matrix
+
+        The log-likelihood of the data is recorded each iteration in self.log_likelihoods.
+        If tol is given, training stops early once the relative change in log-likelihood
+        stays below tol for patience consecutive iterations.
+        If returnLogLikelihoods is True, returns (pi, log_likelihoods) instead of pi.
+        If workspace is True, the P x Z, P x T and padded scratch arrays are allocated once
+        and the EM iterations update them in place.
+
+        mode is either "batch" (full EM) or "online" (stochastic EM). In online mode every iteration
+        is a pass over the shuffled documents in minibatches of batch_size, and each minibatch's
+        QdotConH statistics are blended into running statistics with step size (step + tau)^-kappa.
+        If processes > 1, batch mode splits the documents into that many shards and runs the E-step
+        and QdotConH accumulation of each shard in its own worker process.
+        If top_k is given, q only keeps the top_k most likely locations of each document, as a sparse
+        T x P matrix computed batch_size documents at a time. The M-step then costs O(T * top_k),
+        and q (or ql2 when layers > 1) is saved sparse.
+        layer_iterations is the number of EM iterations of the layered model when layers > 1.
+        With layers=1 there is no layered model: self.layercgdata, and CountingGridDataMatrices.mat next to CGData.mat,
+        are the single_layer matrices of pi and q, whenever q and data are there.
+
+        If checkpoint_directory is given, pi, the iteration count, the log-likelihoods and the state of np.random
+        are saved to checkpoint_directory/checkpoint.npz every checkpoint_every iterations or checkpoint_seconds
+        seconds, whichever comes first (every iteration if neither is given). on_checkpoint, if given, is called
+        with the path of each checkpoint, e.g. to copy it somewhere safer.
+        If resume is True and checkpoint_directory holds a checkpoint, training picks up from it.
+
+        If restarts > 1 and pi is not given, that many fits from different random pi run in a pool of processes
+        (processes of them at once), each with a np.random.Generator spawned from self.seed. All of them run
+        restart_iterations iterations first. The ones whose log-likelihood is then more than restart_tolerance
+        (relative) below the best are dropped, and the fit with the best final log-likelihood is kept.
+
+        If coarse_levels > 0 and pi is not given, pi starts from a grid with half the extent and window, trained
+        for coarse_max_iter iterations (max_iter by default) and upsampled toroidally. That grid starts from a
+        coarser one in turn, coarse_levels times. Restarts run on the coarsest grid.
+
+        If accelerate is True, batch EM is sped up with SQUAREM: every cycle takes two EM steps from pi, extrapolates
+        pi along them, projects it back onto the simplex and takes an EM step from there. The extrapolated pi is
+        only kept if its log-likelihood is no worse than that of the first EM step; otherwise the cycle falls back
+        to plain EM. max_iter still counts EM steps (E-step and M-step pairs), and self.log_likelihoods still holds
+        the log-likelihood of every pi an E-step ran on, rejected ones included. self.squarem_iterations_saved estimates
+        how many EM steps the cycles saved, see squarem_cycle; iterations_saved measures it against a plain fit.
+
+        If chunk_size is given, the batch E-step runs chunk_size documents at a time and only adds each chunk's QdotConH
+        statistics to the M-step, so memory grows with chunk_size rather than with the number of documents.
+        q is then only computed once, chunk by chunk, from the final pi, and only if materialize_q is True or layers > 1;
+        otherwise self.q is None and CGData.mat only holds pi. chunk_size does not apply to the worker processes of processes > 1.
+        With the memory-mapped counts of MemmapCounts.load_counts as data, every iteration then reads the documents
+        from disk a chunk at a time, and training needs memory for pi and one chunk rather than for the corpus.
+        The q computed at the end still takes T x P floats unless top_k is given, and layers > 1 adds dense T x P arrays.
+
+        If transport is given (see DistributedEStep.py), batch EM runs data-parallel: every worker of the transport owns
+        a shard of the documents and sends back its QdotConH statistics, which are summed here before each M-step,
+        and the new h goes out to all of them. If data is given it is split into shards that are sent to the workers;
+        if data is None, the workers bring their own shards and layers must be 1. q is gathered from the workers at
+        the end if materialize_q is True or layers > 1.
+
+        If time_budget is given, training stops after the iteration during which time_budget seconds have passed since
+        fit was called, coarse levels and restarts included, and self.out_of_time is set. q, the layers and the output
+        are then computed from the pi reached so far, and a checkpoint is saved if checkpoint_directory is given,
+        so that a later fit with resume=True carries on from there.
+        heartBeaters get makeProgress(percentage) after every iteration, and preview(self, iteration) as well if
+        they have a preview method, e.g. to write rough artifacts of the grid while it is still training.
+        self.q_is_current tells previews whether self.q already comes from an E-step of this fit.
         """
+        deadline = None if time_budget is None else time.time() + time_budget
+        self.out_of_time = False
+        if mode not in ("batch", "online"):
+            raise ValueError("The {} fit mode does not exist. Please use 'batch' or 'online'.".format(mode))
+        if transport is not None and (mode == "online" or restarts > 1 or coarse_levels > 0 or (data is None and layers > 1)):
+            raise ValueError("Distributed fits are batch fits without restarts or coarse levels, and need data when layers > 1.")
+        if accelerate and mode == "online":
+            raise ValueError("accelerate is only available in batch mode.")
 
         if not os.path.exists(str(output_directory)):
             raise Exception(
@@ -287,53 +444,374 @@ class CountingGridModel():
 
         alpha = 1e-10
         SSDPi = []
-        data = data.astype(np.float64)
+        self.workspace = {} if workspace else None
+        if scipy.sparse.issparse(data):
+            data = scipy.sparse.csr_matrix(data, dtype=self.dtype)
+        elif data is not None:
+            data = data.astype(self.dtype)
+        pool = None
+        if transport is not None:
+            pool = DistributedEStep(transport, self.extent, self.window, self.dtype, top_k, batch_size, data)
+        if pi is None and coarse_levels > 0:
+            pi = self.coarse_to_fine_pi(
+                data, coarse_levels, max_iter if coarse_max_iter is None else coarse_max_iter,
+                mode=mode, batch_size=batch_size, kappa=kappa, tau=tau, processes=processes, top_k=top_k, tol=tol, patience=patience,
+                workspace=workspace, restarts=restarts, restart_iterations=restart_iterations, restart_tolerance=restart_tolerance,
+                chunk_size=chunk_size, materialize_q=False, time_budget=None if deadline is None else max(0.0, deadline - time.time())
+            )
+            self.out_of_time = self.coarse_out_of_time
         if pi is None:
-            self.initializePi(data)
+            # Only the shape of the documents is needed
+            self.initializePi(data if pool is None else pool)
         else:
-            self.pi = pi
-            
+            self.pi = np.asarray(pi, dtype=self.dtype)
+
         self.h = self.compute_h(self.pi, self.window)
         self.check_model()
         extentProduct = np.prod(self.extent)
-        T, _ = data.shape
-
-        pseudocounts = np.mean(np.sum(data, axis=1) / extentProduct) / 2.5
+        # The shape of the "QdotConH" buffer everywhere, so that workspace mode allocates it once
+        statistics_shape = (extentProduct, self.pi.shape[2])
+        if pool is None:
+            T, _ = data.shape
+            pseudocounts = float(np.mean(np.asarray(data.sum(axis=1), dtype=np.float64) / extentProduct) / 2.5)
+        else:
+            T, _ = pool.shape
+            pseudocounts = float(pool.total_counts / T / extentProduct / 2.5)
 
+        streaming = chunk_size is not None and mode == "batch" and transport is None
         # q is an m x dim(extent) structure
-        qshape = [len(data)]
+        qshape = [T]
         for v in self.extent:
             qshape.append(v)
-        self.q = np.zeros(tuple(qshape))
-        i = 0
-        while i < max_iter:
-            # E-Step
-            self.q = self.q_update(data)
+        self.q = None if streaming or pool is not None else np.zeros(tuple(qshape), dtype=self.dtype)
+        self.log_likelihoods = []
+        online = mode == "online" and learn_pi
+        if online:
+            running_QdotConH = np.zeros(self.pi.shape, dtype=self.dtype)
+            step = 0
 
-            # M-Step
-            if learn_pi:
-                if returnSumSquareDifferencesOfPi:
-                    pi = self.pi
+        checkpoint_file_name = None
+        start = 0
+        if checkpoint_directory is not None:
+            checkpoint_file_name = str(checkpoint_directory) + "/checkpoint.npz"
+            if resume and os.path.exists(checkpoint_file_name):
+                checkpoint = self.load_checkpoint(checkpoint_file_name, self.rng)
+                if checkpoint["pi"].shape != self.pi.shape:
+                    raise ValueError("The checkpoint in {} belongs to a different grid or vocabulary.".format(checkpoint_directory))
+                self.pi = checkpoint["pi"].astype(self.dtype)
+                self.h = self.compute_h(self.pi, self.window)
+                start = checkpoint["iteration"]
+                self.log_likelihoods = list(checkpoint["log_likelihoods"])
+                if online:
+                    running_QdotConH = checkpoint["running_QdotConH"].astype(self.dtype)
+                    step = checkpoint["step"]
+        if restarts > 1 and start == 0 and pi is None and learn_pi and max_iter > 0:
+            seed = self.seed if isinstance(self.seed, np.random.SeedSequence) else np.random.SeedSequence(self.seed)
+            with RandomRestarts(data, self.extent, self.window, self.dtype, processes) as restart_pool:
+                self.pi, self.log_likelihoods, self.rng = restart_pool.best(
+                    seed.spawn(restarts), max_iter, restart_iterations, restart_tolerance,
+                    mode=mode, batch_size=batch_size, kappa=kappa, tau=tau, top_k=top_k, tol=tol, patience=patience, workspace=workspace,
+                    chunk_size=chunk_size, materialize_q=False, deadline=deadline
+                )
+                self.restart_log_likelihoods = restart_pool.early_log_likelihoods
+                self.out_of_time = restart_pool.out_of_time
+            self.h = self.compute_h(self.pi, self.window)
+            # The winner has already been trained, up to max_iter or the deadline
+            start = max_iter
+            if self.out_of_time and checkpoint_file_name is not None:
+                self.save_checkpoint(checkpoint_file_name, len(self.log_likelihoods), self.log_likelihoods)
+                if on_checkpoint is not None:
+                    on_checkpoint(checkpoint_file_name)
+        last_checkpoint = time.time()
+        if pool is None and not online and processes is not None and processes > 1 and start < max_iter:
+            pool = ProcessPoolEStep(data, self.extent, self.window, self.dtype, processes, top_k, batch_size)
+
+        # Whether self.q comes from the latest E-step. Online, pooled and streaming E-steps never set it.
+        self.q_is_current = False
 
+        # One plain EM step from self.pi. Returns the log-likelihood of the pi it started from.
+        def em_step():
+            if pool is not None:
+                QdotConH, self.log_likelihood = pool.e_step(self.h, out=self.buffer("QdotConH", statistics_shape).reshape(self.pi.shape))
+                self.pi = self.pi_update_from_statistics(QdotConH, pseudocounts, alpha)
+            elif streaming:
+                self.pi = self.pi_update_from_statistics(self.streaming_statistics(data, chunk_size, top_k), pseudocounts, alpha)
+            else:
+                self.q = self.e_step(data, top_k, batch_size)
+                self.q_is_current = True
                 self.pi = self.pi_update(data, pseudocounts, alpha)
-                if returnSumSquareDifferencesOfPi:
-                    piHat = self.pi
-                    SSDPi.append(SSD(pi, piHat))
-                self.h = self.compute_h(self.pi, self.window)
-            i = i + 1
-            [(h.makeProgress(int(100*i/max_iter)) if h is not None else False)
-             for h in heartBeaters] if heartBeaters is not None else False
-        
+            self.h = self.compute_h(self.pi, self.window)
+            return self.log_likelihood
+
+        checkpointed = start
+        self.squarem_iterations_saved = 0.0
+        try:
+            i = start
+            while i < max_iter:
+                if accelerate and learn_pi and max_iter - i >= 4:
+                    # Each SQUAREM cycle takes 3 or 4 EM steps
+                    i = i + self.squarem_cycle(em_step)
+                else:
+                    if online:
+                        step = self.online_pass(data, running_QdotConH, step, batch_size, pseudocounts, alpha, kappa, tau, top_k)
+                    elif pool is not None:
+                        # E-Step, reduced over the shards of the workers
+                        QdotConH, self.log_likelihood = pool.e_step(self.h, out=self.buffer("QdotConH", statistics_shape).reshape(self.pi.shape))
+                    elif streaming:
+                        # E-Step, summed over the chunks of documents
+                        QdotConH = self.streaming_statistics(data, chunk_size, top_k)
+                    else:
+                        # E-Step
+                        self.q = self.e_step(data, top_k, batch_size)
+                        self.q_is_current = True
+                    self.log_likelihoods.append(self.log_likelihood)
+
+                    # M-Step
+                    if learn_pi and not online:
+                        if returnSumSquareDifferencesOfPi:
+                            pi = self.pi
+
+                        if pool is not None or streaming:
+                            self.pi = self.pi_update_from_statistics(QdotConH, pseudocounts, alpha)
+                        else:
+                            self.pi = self.pi_update(data, pseudocounts, alpha)
+                        if returnSumSquareDifferencesOfPi:
+                            piHat = self.pi
+                            SSDPi.append(SSD(pi, piHat))
+                        self.h = self.compute_h(self.pi, self.window)
+                    i = i + 1
+                [(h.makeProgress(int(100*i/max_iter)) if h is not None else False)
+                 for h in heartBeaters] if heartBeaters is not None else False
+                for h in heartBeaters if heartBeaters is not None else []:
+                    if h is not None and hasattr(h, "preview"):
+                        h.preview(self, i)
+                if checkpoint_file_name is not None and (
+                    (checkpoint_every is None and checkpoint_seconds is None) or
+                    (checkpoint_every is not None and i - checkpointed >= checkpoint_every) or
+                    (checkpoint_seconds is not None and time.time() - last_checkpoint >= checkpoint_seconds)
+                ):
+                    self.save_checkpoint(
+                        checkpoint_file_name, i, self.log_likelihoods,
+                        running_QdotConH if online else None, step if online else 0
+                    )
+                    last_checkpoint = time.time()
+                    checkpointed = i
+                    if on_checkpoint is not None:
+                        on_checkpoint(checkpoint_file_name)
+                if tol is not None and self.has_converged(self.log_likelihoods, tol, patience):
+                    break
+                if deadline is not None and time.time() >= deadline and i < max_iter:
+                    self.out_of_time = True
+                    if checkpoint_file_name is not None and checkpointed != i:
+                        self.save_checkpoint(
+                            checkpoint_file_name, i, self.log_likelihoods,
+                            running_QdotConH if online else None, step if online else 0
+                        )
+                        if on_checkpoint is not None:
+                            on_checkpoint(checkpoint_file_name)
+                    break
+            if streaming:
+                if materialize_q or layers > 1:
+                    # Only ever one chunk of the dense posterior besides q itself
+                    self.q = self.e_step(data, top_k, chunk_size) if top_k is not None else self.transform(data, chunk_size)
+            elif transport is not None:
+                if i == start:
+                    # The workers have no q yet
+                    pool.e_step(self.h)
+                self.q = pool.gather_q() if materialize_q or layers > 1 else None
+            elif online or (i == start and max_iter > 0):
+                # Minibatches only ever hold their own slice of q, and a fit resumed at max_iter has no q yet
+                self.q = self.e_step(data, top_k, batch_size)
+            elif pool is not None and max_iter > 0:
+                self.q = pool.gather_q()
+        finally:
+            if pool is not None:
+                pool.close()
+        # Release the scratch arrays. pi, h and q keep the buffers they were last written to.
+        self.workspace = None
+
+        self.layercgdata = None
         if layers > 1:
-            self.layercgdata = self.cg_layers(data, L=layers, noise=noise)
+            if scipy.sparse.issparse(self.q):
+                # The layered model refines a dense q
+                self.q = np.reshape(self.q.toarray(), tuple([T] + list(self.extent)))
+            self.layercgdata = self.cg_layers(data, L=layers, noise=noise, nmax=layer_iterations)
+            if top_k is not None:
+                self.layercgdata["ql2"] = top_k_posterior(self.layercgdata["ql2"], top_k)
+        elif self.q is not None and data is not None:
+            self.layercgdata = self.single_layer(data)
 
         if writeOutput:
-            if layers > 1:
+            if layers == 1:
+                scipy.io.savemat(str(output_directory) + "/CGData.mat", {"pi": self.pi} if self.q is None else {"pi": self.pi, "q": self.q})
+            if self.layercgdata is not None:
                 scipy.io.savemat(str(output_directory) + "/CountingGridDataMatrices.mat", self.layercgdata)
-            else:
-                scipy.io.savemat(str(output_directory) + "/CGData.mat", {"pi": self.pi, "q": self.q})
+        if returnLogLikelihoods:
+            return (self.pi, self.log_likelihoods)
         return self.pi
 
+    def streaming_statistics(self, data, chunk_size, top_k=None):
+        '''
+        The E-step and the QdotConH statistics of the M-step, chunk_size documents at a time.
+        Only one chunk's q exists at any time. Sets self.log_likelihood and returns the E1 x E2 x Z QdotConH.
+        '''
+        log_h = np.log(self.h, out=self.buffer("log_h", self.h.shape))
+        QdotConH = self.buffer("streamed_QdotConH", self.pi.shape)
+        QdotConH[...] = 0
+        log_likelihood = 0.0
+        for start in range(0, data.shape[0], chunk_size):
+            chunk = data[start:start + chunk_size]
+            QdotConH += self.q_dot_data(self.e_step(chunk, top_k, chunk_size, log_h=log_h), chunk)
+            log_likelihood += self.log_likelihood
+        self.log_likelihood = log_likelihood
+        return QdotConH
+
+    def squarem_cycle(self, em_step):
+        '''
+        One SQUAREM cycle (Varadhan and Roland, 2008) from self.pi, with em_step mapping self.pi to its EM update.
+        Appends the log-likelihood of every pi it runs an E-step on to self.log_likelihoods, and returns the number of EM steps taken.
+        Adds an estimate of the EM steps it saved to self.squarem_iterations_saved: an extrapolation with step length a goes
+        about 2|a| plain steps ahead, so a kept cycle saves 2|a| - 2 of them, and a rejected one wastes one.
+        '''
+        pi0 = np.copy(self.pi)
+        log_likelihood0 = em_step()
+        pi1 = np.copy(self.pi)
+        log_likelihood1 = em_step()
+        pi2 = np.copy(self.pi)
+
+        r = pi1 - pi0
+        v = pi2 - pi1 - r
+        v_norm = np.sqrt(np.sum(np.square(v, dtype=np.float64)))
+        # A step length of -1 is pi2 itself
+        step_length = min(-np.sqrt(np.sum(np.square(r, dtype=np.float64))) / v_norm, -1.0) if v_norm > 0 else -1.0
+        extrapolated = pi0 - (2 * step_length) * r + (step_length ** 2) * v
+        # Back onto the simplex, without going below the smallest probability EM produced
+        np.maximum(extrapolated, np.min(pi2), out=extrapolated)
+        extrapolated /= np.sum(extrapolated, axis=2, keepdims=True)
+
+        self.pi = extrapolated.astype(self.dtype, copy=False)
+        self.h = self.compute_h(self.pi, self.window)
+        log_likelihood = em_step()
+        self.log_likelihoods.extend([log_likelihood0, log_likelihood1, log_likelihood])
+        if log_likelihood >= log_likelihood1:
+            self.squarem_iterations_saved += -2 * step_length - 2
+            return 3
+
+        # Monotonicity safeguard: continue from the plain EM step instead
+        self.pi = pi2
+        self.h = self.compute_h(self.pi, self.window)
+        self.log_likelihoods.append(em_step())
+        self.squarem_iterations_saved -= 1
+        return 4
+
+    def coarse_to_fine_pi(self, data, coarse_levels, coarse_max_iter, **fit_kwargs):
+        '''
+        Fits a grid with half the extent and window (coarse_levels - 1 more levels down first), draws from self.rng,
+        and returns its pi upsampled toroidally to self.extent. fit_kwargs are passed on to every level.
+        Sets self.coarse_out_of_time if a level stopped at the deadline of a time_budget in fit_kwargs.
+        '''
+        extent = np.maximum(np.floor(np.asarray(self.extent) / 2 + 0.5), 1).astype(int)
+        window = np.minimum(np.maximum(np.floor(np.asarray(self.window) / 2 + 0.5), 1).astype(int), extent)
+        coarse = CountingGridModel(extent, window, dtype=self.dtype, seed=self.seed)
+        coarse.rng = self.rng
+        coarse.fit(
+            data, max_iter=coarse_max_iter, writeOutput=False, coarse_levels=coarse_levels - 1, coarse_max_iter=coarse_max_iter,
+            **fit_kwargs
+        )
+        self.rng = coarse.rng
+        self.coarse_log_likelihoods = coarse.log_likelihoods
+        self.coarse_out_of_time = coarse.out_of_time
+        pi = toroidal_upsample(coarse.pi, self.extent)
+        return pi / np.sum(pi, axis=2, keepdims=True)
+
+    def online_pass(self, data, running_QdotConH, step, batch_size, pseudocounts, alpha, kappa=0.7, tau=1.0, top_k=None):
+        '''
+        One pass of stochastic EM over the documents in shuffled minibatches.
+        Each minibatch's QdotConH, scaled up to the size of the corpus, is blended into running_QdotConH
+        (in place) with step size (step + tau)^-kappa before every M-step.
+        Sets self.log_likelihood to the sum of the minibatch log-likelihoods and returns the new step count.
+        '''
+        T = data.shape[0]
+        log_likelihood = 0.0
+        order = self.rng.permutation(T)
+        for start in range(0, T, batch_size):
+            batch = data[np.sort(order[start:start + batch_size])]
+            q = self.e_step(batch, top_k, batch_size)
+            log_likelihood += self.log_likelihood
+
+            QdotConH = self.q_dot_data(q, batch)
+            rho = 1.0 if step == 0 else (step + tau) ** -kappa
+            np.multiply(QdotConH, rho * T / batch.shape[0], out=QdotConH)
+            np.multiply(running_QdotConH, 1.0 - rho, out=running_QdotConH)
+            np.add(running_QdotConH, QdotConH, out=running_QdotConH)
+
+            self.pi = self.pi_update_from_statistics(running_QdotConH, pseudocounts, alpha)
+            self.h = self.compute_h(self.pi, self.window)
+            step += 1
+        self.log_likelihood = log_likelihood
+        return step
+
+    def save_checkpoint(self, file_name, iteration, log_likelihoods, running_QdotConH=None, step=0):
+        '''
+        Saves pi, the number of finished iterations, the log-likelihoods and the state of self.rng to file_name.
+        The file is written under a temporary name and then renamed, so an interrupted write never replaces a good checkpoint.
+        '''
+        arrays = {"pi": self.pi, "iteration": iteration, "log_likelihoods": np.array(log_likelihoods, dtype=np.float64)}
+        if self.rng is np.random:
+            _, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+            arrays.update({
+                "rng_keys": keys, "rng_position": position, "rng_has_gauss": has_gauss, "rng_cached_gaussian": cached_gaussian
+            })
+        else:
+            arrays["rng_state"] = json.dumps(self.rng.bit_generator.state)
+        if running_QdotConH is not None:
+            arrays["running_QdotConH"] = running_QdotConH
+            arrays["step"] = step
+        with open(file_name + ".tmp", "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(file_name + ".tmp", file_name)
+
+    @staticmethod
+    def load_checkpoint(file_name, rng=np.random):
+        '''
+        Reads a checkpoint written by save_checkpoint and restores the state of rng, either np.random or a np.random.Generator.
+        Returns a dict with pi, iteration and log_likelihoods, plus running_QdotConH and step for online fits.
+        '''
+        with np.load(file_name) as f:
+            checkpoint = {key: f[key] for key in f.files}
+        if "rng_state" in checkpoint:
+            rng.bit_generator.state = json.loads(str(checkpoint.pop("rng_state")))
+        else:
+            np.random.set_state((
+                "MT19937", checkpoint.pop("rng_keys"), int(checkpoint.pop("rng_position")),
+                int(checkpoint.pop("rng_has_gauss")), float(checkpoint.pop("rng_cached_gaussian"))
+            ))
+        checkpoint["iteration"] = int(checkpoint["iteration"])
+        if "step" in checkpoint:
+            checkpoint["step"] = int(checkpoint["step"])
+        return checkpoint
+
+    @staticmethod
+    def iterations_saved(plain_log_likelihoods, log_likelihoods):
+        '''
+        How many fewer EM steps a fit with log_likelihoods (e.g. an accelerated one) took than the plain fit with
+        plain_log_likelihoods to reach the best log-likelihood both of them reached.
+        '''
+        target = min(max(plain_log_likelihoods), max(log_likelihoods))
+        return int(np.argmax(np.asarray(plain_log_likelihoods) >= target)) - int(np.argmax(np.asarray(log_likelihoods) >= target))
+
+    @staticmethod
+    def has_converged(log_likelihoods, tol, patience=1):
+        '''
+        True if the relative change in log-likelihood was below tol for the last patience iterations.
+        '''
+        if len(log_likelihoods) <= patience:
+            return False
+        for previous, current in zip(log_likelihoods[-patience-1:-1], log_likelihoods[-patience:]):
+            if abs(current - previous) > tol * abs(previous):
+                return False
+        return True
+
     # assumptions that we need for the model to be valid
     def check_model(self):
         assert(len(self.extent) == len(self.window))
@@ -351,15 +829,25 @@ class CountingGridModel():
     def compute_h_noLoopFull(self, PI, w0, w1):
         return PI[w0:, w1:, :] - PI[:-w0, w1:, :] - PI[w0:, :-w1, :] + PI[:-w0, :-w1, :]
 
-    # no side effects
+    # no side effects, apart from reusing workspace buffers
     def compute_h(self, pi, W):
-        PI = np.pad(pi, [(0, W[0]), (0, W[1]), (0, 0)],
-                    'wrap').cumsum(axis=0).cumsum(axis=1)
-        PI = np.pad(PI, [(1, 0), (1, 0), (0, 0)], 'constant')
+        E0, E1, Z = pi.shape
         w0 = W[0]
         w1 = W[1]
-        cumsum_output = self.compute_h_noLoopFull(PI, w0, w1)
-        return np.moveaxis(np.moveaxis(cumsum_output[:-1, :-1, :], 2, 0)/np.sum(cumsum_output[:-1, :-1, :], axis=2), 0, -1)
+        if self.compiled:
+            return FusedKernels.toroidal_window_sums(pi, w0, w1, 0, 0, self.buffer("h", pi.shape), True)
+        # The summed area table is accumulated in float64: its four-way difference cancels badly in float32.
+        # Its first row and column are zero; the rest is pi padded toroidally at the end.
+        PI = self.buffer("summed_area_table", (E0 + w0 + 1, E1 + w1 + 1, Z), np.float64)
+        PI[0] = 0
+        PI[:, 0] = 0
+        toroidal_fill(PI[1:, 1:], pi)
+        np.cumsum(PI, axis=0, out=PI)
+        np.cumsum(PI, axis=1, out=PI)
+        cumsum_output = window_sums_in_place(PI, w0, w1, E0, E1)
+
+        denom = np.sum(cumsum_output, axis=2, keepdims=True, out=self.buffer("h_denominator", (E0, E1, 1), np.float64))
+        return np.divide(cumsum_output, denom, out=self.buffer("h", pi.shape))
 
     # How to initialize pi
     # Note that we don't want pi to be 0, since our update equations depend on a multiplication by pi
@@ -367,7 +855,7 @@ class CountingGridModel():
         if technique == "uniform":
             size = [x for x in self.extent]
             size.append(data.shape[1])
-            self.pi = np.random.random(size=tuple(size)).astype(np.float64)
+            self.pi = self.rng.random(size=tuple(size)).astype(self.dtype)
         else:
             raise ValueError("No initialize strategy given")
 
@@ -378,26 +866,72 @@ class CountingGridModel():
         Assumes: a two dimensional extent
         Recall: q is M x E tensor
         '''
+        return self.pi_update_from_statistics(self.q_dot_data(self.q, data), pseudocounts, alpha)
+
+    def q_dot_data(self, q, data):
+        '''
+        The sufficient statistics of the M-step: q( location | document ) summed against the word counts.
+        q is T x E1 x E2, or a sparse T x P matrix from q_update_top_k, and data is T x Z.
+        Returns an E1 x E2 x Z array.
+        '''
         T, Z = data.shape
-        W = self.window
+        E0, E1 = self.extent
+        if scipy.sparse.issparse(q):
+            QdotConH = q.T.dot(data)
+            if scipy.sparse.issparse(QdotConH):
+                QdotConH = QdotConH.toarray()
+            return np.asarray(QdotConH, dtype=self.dtype).reshape((E0, E1, Z))
         # QdotConH is called nrm in matlab engine, but padding is done beforehand in matlab
-        QdotConH = np.dot(np.moveaxis(self.q, 0, -1,), data)
-        QH = np.pad(QdotConH / (self.h + np.prod(self.window)*alpha),
-                    [(W[0], 0), (W[1], 0), (0, 0)], 'wrap').cumsum(axis=0).cumsum(axis=1)
-        w0 = W[0]
-        w1 = W[1]
-        QH = self.compute_h_noLoopFull(QH, w0, w1)
-        QH[QH < 0] = 0
-
-        un_pi = pseudocounts + QH*(self.pi+alpha)
-        mask = (np.sum(un_pi, axis=2) != 0).astype(np.float64)
-        not_mask = (np.sum(un_pi, axis=2) == 0).astype(np.float64)
-        denom = np.sum(un_pi, axis=2)
-        self.pi = np.transpose(np.transpose(mask)*(np.transpose(un_pi) / np.transpose(denom))) + \
-            (1.0/Z) * np.transpose(np.transpose(
-                np.ones([self.extent[0], self.extent[1], Z]))*np.transpose(not_mask))
+        return dot_data(
+            np.reshape(np.moveaxis(q, 0, -1), (E0 * E1, T)), data, out=self.buffer("QdotConH", (E0 * E1, Z))
+        ).reshape((E0, E1, Z))
+
+    def pi_update_from_statistics(self, QdotConH, pseudocounts, alpha):
+        '''
+        The M-step given the QdotConH statistics of q_dot_data. Reads self.pi and self.h, and returns the new pi.
+        QdotConH is overwritten unless it is a different array from the "QdotConH" buffer.
+        '''
+        E0, E1, Z = QdotConH.shape
+        w0, w1 = self.window
+        h_plus_alpha = np.add(self.h, float(w0 * w1 * alpha), out=self.buffer("scratch", self.h.shape))
+        QdotConH = np.divide(QdotConH, h_plus_alpha, out=self.buffer("QdotConH", (E0 * E1, Z)).reshape((E0, E1, Z)))
+
+        QH = self.window_sums_ending_at(QdotConH)
+
+        # Never write over the current pi, which may be owned by the caller
+        un_pi = self.buffer("un_pi", self.pi.shape)
+        if un_pi is self.pi:
+            un_pi = self.buffer("un_pi_previous", self.pi.shape)
+        np.add(self.pi, alpha, out=un_pi)
+        np.multiply(un_pi, QH, out=un_pi)
+        np.add(un_pi, pseudocounts, out=un_pi)
+        denom = np.sum(un_pi, axis=2, keepdims=True, out=self.buffer("pi_denominator", (E0, E1, 1)))
+        not_mask = denom[:, :, 0] == 0
+        np.divide(un_pi, denom, out=un_pi, where=denom != 0)
+        un_pi[not_mask] = 1.0/Z
+        self.pi = un_pi
         return self.pi
 
+    def window_sums_ending_at(self, a):
+        '''
+        Sums of the E1 x E2 x Z array a over the windows that end at each location rather than start there,
+        i.e. over the windows of compute_h that contain it. Negative sums from cancellation are set to 0.
+        Returns a float64 scratch buffer.
+        '''
+        E0, E1, Z = a.shape
+        w0, w1 = self.window
+        if self.compiled:
+            return FusedKernels.toroidal_window_sums(a, w0, w1, 1 - w0, 1 - w1, self.buffer("window_sums", (E0, E1, Z), np.float64), False)
+        # Same summed area table as compute_h, except that the padding is at the start
+        QH = self.buffer("summed_area_table", (E0 + w0 + 1, E1 + w1 + 1, Z), np.float64)
+        QH[0] = 0
+        QH[:, 0] = 0
+        toroidal_fill(QH[1:, 1:], a, shift=(w0, w1))
+        np.cumsum(QH, axis=0, out=QH)
+        np.cumsum(QH, axis=1, out=QH)
+        QH = window_sums_in_place(QH, w0, w1, E0, E1, first=1)
+        return np.maximum(QH, 0, out=QH)
+
     def get_indices_for_window_indexed_by_k(self, k, z):
         indices = [[]]*len(self.extent)
         for j, v in enumerate(indices):
@@ -408,18 +942,130 @@ class CountingGridModel():
     def get_h(self):
         return self.h
 
-    def q_update(self, data):
+    def q_update(self, data, log_h=None):
+        '''
+        The E-step. log_h may be given when log(self.h) has already been computed.
+        '''
         L = np.prod(self.extent)
-        lql = np.dot(np.log(self.h).reshape(
-            (L, data.shape[1])), np.transpose(data))
-        lqlmax = np.amax(lql, axis=0)
+        T, Z = data.shape
+        if log_h is None:
+            log_h = np.log(self.h, out=self.buffer("scratch", self.h.shape))
+        log_h = log_h.reshape((L, Z))
+        # lql becomes q in place
+        lql = dot_data_transpose(log_h, data, out=self.buffer("q", (L, T)))
         min_prob = 1.0/(10*L)
-        Lq = ((lql-lqlmax)-np.log(np.sum(np.exp(lql-lqlmax), axis=0))
-              ).reshape(tuple(list(self.extent) + [data.shape[0]]))
-        q = np.exp(Lq)
-        q[q < min_prob] = min_prob
-        q = q / np.sum(np.sum(q, axis=0), axis=0)
-        return np.moveaxis(q, 2, 0)
+        if self.compiled:
+            self.log_likelihood = FusedKernels.normalize_posterior(lql, min_prob) - T*np.log(L)
+            return np.moveaxis(lql.reshape(tuple(list(self.extent) + [T])), 2, 0)
+        lqlmax = np.amax(lql, axis=0, out=self.buffer("lqlmax", (T,)))
+        q = np.exp(np.subtract(lql, lqlmax, out=lql), out=lql)
+        normalizer = np.sum(q, axis=0, out=self.buffer("q_denominator", (T,)))
+        # log p(document) under a uniform prior over locations reuses the normalizer of q
+        self.log_likelihood = np.sum(lqlmax, dtype=np.float64) + np.sum(np.log(normalizer), dtype=np.float64) - T*np.log(L)
+        np.divide(q, normalizer, out=q)
+        np.maximum(q, min_prob, out=q)
+        np.divide(q, np.sum(q, axis=0, out=normalizer), out=q)
+        return np.moveaxis(q.reshape(tuple(list(self.extent) + [T])), 2, 0)
+
+    @classmethod
+    def from_file(cls, file_name, window, dtype=np.float64):
+        '''
+        Loads a trained model from the pi saved in CGData.mat or CountingGridDataMatrices.mat.
+        The window is not saved with pi, so it has to be given.
+        '''
+        MAT = scipy.io.loadmat(file_name, variable_names=["pi"])
+        if "pi" not in MAT:
+            raise ValueError("{} does not contain a learned pi.".format(file_name))
+        pi = MAT["pi"]
+        model = cls(np.array(pi.shape[:2]), np.array(window), dtype=dtype)
+        model.pi = pi.astype(model.dtype)
+        model.h = model.compute_h(model.pi, model.window)
+        return model
+
+    def transform(self, data, batch_size=10000):
+        '''
+        Fold-in: maps new documents onto the trained grid without retraining.
+        data is a T x Z numpy array or scipy.sparse matrix over the training vocabulary.
+        Returns q( location | document ), T x E1 x E2, computed batch_size documents at a time with pi held fixed.
+        '''
+        if getattr(self, "h", None) is None:
+            self.h = self.compute_h(self.pi, self.window)
+        if scipy.sparse.issparse(data):
+            data = scipy.sparse.csr_matrix(data, dtype=self.dtype)
+        else:
+            data = np.asarray(data, dtype=self.dtype)
+        T = data.shape[0]
+        q = np.empty(tuple([T] + list(self.extent)), dtype=self.dtype)
+        log_h = np.log(self.h)
+        workspace, self.workspace = self.workspace, {}
+        try:
+            for start in range(0, T, batch_size):
+                q[start:start + batch_size] = self.q_update(data[start:start + batch_size], log_h=log_h)
+        finally:
+            self.workspace = workspace
+        return q
+
+    def predict_log_likelihoods(self, data, batch_size=10000):
+        '''
+        Log-likelihood maps for many documents at once.
+        data is a T x Z numpy array or scipy.sparse matrix of word counts.
+        Returns a T x E1 x E2 array whose [t, i, j] entry is log p( document t | window at (i, j) ),
+        the same quantity as log(predict_probabilities(data[t], [i, j])) except that windows wrap around the grid.
+        Documents are scored batch_size at a time with one matmul against log(h), like q_update.
+        '''
+        if getattr(self, "h", None) is None:
+            self.h = self.compute_h(self.pi, self.window)
+        T, Z = data.shape
+        P = np.prod(self.extent)
+        log_h = np.log(self.h).reshape((P, Z))
+        log_likelihoods = np.empty((T, P), dtype=self.dtype)
+        for start in range(0, T, batch_size):
+            log_likelihoods[start:start + batch_size] = np.transpose(
+                dot_data_transpose(log_h, data[start:start + batch_size])
+            )
+        return log_likelihoods.reshape(tuple([T] + list(self.extent)))
+
+    def score(self, data, pi_la=None, batch_size=10000):
+        '''
+        Held-out log-likelihood: the sum over the documents in data of log p( document ), with pi held fixed and
+        a uniform prior over the locations. If pi_la (E1 x E2 x Z x L, from cg_layers) is given, the documents are
+        scored under the layered model instead, with a uniform prior over the locations of every layer.
+        '''
+        P = np.prod(self.extent)
+        Z = data.shape[1]
+        pis = [self.pi] if pi_la is None else [pi_la[:, :, :, layer] for layer in range(pi_la.shape[3])]
+        log_hs = [np.log(self.compute_h(np.asarray(pi, dtype=self.dtype), self.window)).reshape((P, Z)) for pi in pis]
+        log_likelihood = 0.0
+        for start in range(0, data.shape[0], batch_size):
+            batch = data[start:start + batch_size]
+            log_likelihoods = np.concatenate([dot_data_transpose(log_h, batch) for log_h in log_hs], axis=0)
+            log_likelihood += np.sum(scipy.special.logsumexp(log_likelihoods, axis=0), dtype=np.float64)
+        return float(log_likelihood - data.shape[0] * np.log(P * len(pis)))
+
+    def e_step(self, data, top_k=None, batch_size=10000, log_h=None):
+        '''
+        q_update, or q_update_top_k when top_k is given.
+        '''
+        if top_k is None:
+            return self.q_update(data, log_h=log_h)
+        return self.q_update_top_k(data, top_k, batch_size, log_h=log_h)
+
+    def q_update_top_k(self, data, k, batch_size=10000, log_h=None):
+        '''
+        The E-step keeping only the k most likely locations of each document.
+        Documents are processed batch_size at a time, so the dense posterior never exceeds P x batch_size.
+        Returns a sparse T x P matrix. self.log_likelihood is still computed over all locations.
+        '''
+        if log_h is None:
+            log_h = np.log(self.h)
+        T = data.shape[0]
+        log_likelihood = 0.0
+        q = []
+        for start in range(0, T, batch_size):
+            q.append(top_k_posterior(self.q_update(data[start:start + batch_size], log_h=log_h), k))
+            log_likelihood += self.log_likelihood
+        self.log_likelihood = log_likelihood
+        return scipy.sparse.vstack(q, format="csr")
 
     # Assumes: bagofwordcounts are integers
     def predict_probabilities(self, bagofwordcounts, k):
@@ -3,25 +3,51 @@
 
 import torch
 import scipy
+import scipy.sparse
 import os
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 from tqdm import tqdm
-from CountingGridsPy.models import CountingGridModel
+from CountingGridsPy.models import CountingGridModel, FusedKernels
+
+
+def toroidal_pad(x, pad):
+    '''
+    Pads the first two dimensions of the tensor x circularly, like np.pad(x, pad + [(0, 0)], 'wrap').
+    pad is [(before0, after0), (before1, after1)], each at most the size of its dimension.
+    The padding is done with torch.cat, so x never leaves its device.
+    '''
+    for dim, (before, after) in enumerate(pad):
+        n = x.shape[dim]
+        x = torch.cat([x.narrow(dim, n - int(before), int(before)), x, x.narrow(dim, 0, int(after))], dim=dim)
+    return x
 
 
 class CountingGridModelWithGPU(CountingGridModel):
-    def __init__(self, extent, window):
+    def __init__(self, extent, window, device=None):
         '''
         Assumes:
         extent is a 1-D numpy array of size D.
         window is a 1-D numpy array of size D.
+        device is the torch device the model is trained on, e.g. "cpu" or "cuda:0".
+        None picks the first GPU when there is one, and the CPU otherwise.
 
         D is often 2, since it makes the model easily visualizable.
         '''
         self.extent = np.array(extent)
         self.window = np.array(window)
+        self.dtype = np.dtype(np.float64)
+        self.workspace = None
+        # Used by initializePi and by the numpy cg_layers
+        self.seed = None
+        self.rng = np.random
+        self.compiled = FusedKernels.AVAILABLE
+        if self.compiled:
+            FusedKernels.use_fork_safe_threading_layer()
+        if device is None:
+            device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
    
     def compute_h_noLoopFull(self, PI, w0, w1):
         '''
@@ -40,9 +66,7 @@ class CountingGridModelWithGPU(CountingGridModel):
         '''
         Compute the histogram.
         '''
-        # optimization is to do this without moving any data back to the cpu to do the padding
-        PI = np.pad(pi.cpu().numpy(), [(0,W[0]),(0,W[1]),(0,0)], 'wrap')
-        PI = torch.from_numpy(np.pad(PI,[(1,0),(1,0),(0,0)],'constant')).cumsum(0).cumsum(1).cuda()
+        PI = F.pad(toroidal_pad(pi, [(0, W[0]), (0, W[1])]), (0, 0, 1, 0, 1, 0)).cumsum(0).cumsum(1)
         cumsum_output = self.compute_h_noLoopFull(PI,W[0],W[1])
         return (
                     (cumsum_output[:-1,:-1,:]).permute((2,0,1)) / cumsum_output[:-1,:-1,:].sum(dim=2)
@@ -54,9 +78,11 @@ class CountingGridModelWithGPU(CountingGridModel):
         '''
         L = np.prod(self.extent)
         reshapedHistogram = torch.log(self.h).reshape((L, data.shape[1]))
-        transposedDataMatrix = torch.transpose(data, 1, 0)
 
-        lql = torch.matmul(reshapedHistogram,transposedDataMatrix) 
+        if data.is_sparse:
+            lql = torch.sparse.mm(data, reshapedHistogram.t()).t()
+        else:
+            lql = torch.matmul(reshapedHistogram, torch.transpose(data, 1, 0))
         lqlmax = torch.max(lql, 0)[0]
         min_prob = 1.0/(10 * L)
         Lq = (
@@ -71,25 +97,22 @@ class CountingGridModelWithGPU(CountingGridModel):
     def pi_update(self, data, pseudocounts, alpha):
         T, Z = data.shape
         W = self.window
-        device = torch.device("cuda:0")
         # QdotC is called nrm in matlab engine, but padding is done beforehand in matlab
        
         # permute([1,2,0])
         # [x,y,z] => [y,z,x]
         L = np.prod(self.extent)
-        QdotC = torch.matmul(
-            self.q.permute([1, 2, 0]).reshape((L, T)),
-            data
-        ).reshape(self.extent[0], self.extent[1], Z)
+        reshapedQ = self.q.permute([1, 2, 0]).reshape((L, T))
+        if data.is_sparse:
+            QdotC = torch.sparse.mm(data.t(), reshapedQ.t()).t()
+        else:
+            QdotC = torch.matmul(reshapedQ, data)
+        QdotC = QdotC.reshape(self.extent[0], self.extent[1], Z)
         
-        # PyTorch only implements circular padding for 1 dimension at a time.
-        # We will pass the data back to the CPU, do the padding, and bring it back to the GPU.
-        QH = np.pad(
-            (QdotC/(self.h + np.prod(self.window)*alpha)).cpu().numpy(),
-            [(W[0], 0), (W[1], 0), (0, 0)],
-            'wrap'
-        ).cumsum(axis=0).cumsum(axis=1)
-        QH = torch.tensor(QH, device=device, dtype=torch.double)
+        QH = toroidal_pad(
+            QdotC/(self.h + np.prod(self.window)*alpha),
+            [(W[0], 0), (W[1], 0)]
+        ).cumsum(0).cumsum(1)
         
         w0 = W[0]; w1 = W[1]
         QH = self.compute_h_noLoopFull(QH, w0, w1)
@@ -101,42 +124,59 @@ class CountingGridModelWithGPU(CountingGridModel):
         denom = torch.sum(un_pi, 2)
         
         updated_pi = torch.transpose((torch.transpose(mask, 0, 1) * torch.transpose(un_pi, 0, 2)) / torch.transpose(denom, 0, 1), 0, 2) + \
-            (1.0 / Z) * torch.transpose(torch.ones([Z, self.extent[1], self.extent[0]], device=device, dtype=torch.double) * torch.transpose(not_mask, 0, 1), 0, 2)
+            (1.0 / Z) * torch.transpose(torch.ones([Z, self.extent[1], self.extent[0]], device=self.device, dtype=torch.double) * torch.transpose(not_mask, 0, 1), 0, 2)
         return updated_pi
 
-    def fit(self, data_cpu, max_iter=100, noise=.000001, learn_pi=True, pi=None, layers=1, output_directory="./", heartBeaters=None, writeOutput=True):
+    def fit(
+        self, data_cpu, max_iter=100, noise=.000001, learn_pi=True, pi=None, layers=1, output_directory="./", heartBeaters=None,
+        writeOutput=True, layer_iterations=2, threads=None
+    ):
         '''
-        Fits the model, using GPU.
+        Fits the model with torch on self.device. Every EM iteration stays on the device.
 
         Assumes:
-        1. pi is a torch tensor on the GPU
+        1. data_cpu is a numpy array or a scipy.sparse matrix. Sparse data stays sparse on the device.
+        2. pi, if given, is a torch tensor or a numpy array
+        If threads is given, it sets the number of threads torch uses for its CPU kernels.
         '''
     
         if not os.path.exists(str(output_directory)):
             raise Exception("output_directory does not exist for counting grids trainer.")
 
-        if not torch.cuda.is_available():
+        if self.device.type == "cuda" and not torch.cuda.is_available():
             raise Exception("No GPU available for training.")
-        device = torch.device("cuda:0")
+        if threads is not None:
+            torch.set_num_threads(threads)
+        device = self.device
         alpha = 1e-10
-        data = torch.tensor(data_cpu, device=device, dtype=torch.double)
+        if scipy.sparse.issparse(data_cpu):
+            data_cpu = data_cpu.tocsr().astype(np.float64)
+            coo = data_cpu.tocoo()
+            data = torch.sparse_coo_tensor(
+                np.vstack([coo.row, coo.col]), coo.data, coo.shape, device=device, dtype=torch.double
+            ).coalesce()
+            row_sums = np.asarray(data_cpu.sum(axis=1)).flatten()
+        else:
+            data_cpu = np.asarray(data_cpu, dtype=np.float64)
+            data = torch.tensor(data_cpu, device=device, dtype=torch.double)
+            row_sums = np.sum(data_cpu, axis=1)
 
         if pi is None:
             self.initializePi(data) # potentially optimize by initializing data in GPU 
             self.pi = torch.tensor(self.pi, device=device, dtype=torch.double)
         else:
-            self.pi = pi
+            self.pi = torch.as_tensor(pi, device=device, dtype=torch.double)
 
         self.h = self.compute_h(self.pi, self.window)
         P = np.prod(self.extent)
         T, Z = data.size()
         
-        pseudocounts = torch.mean(data.sum(1) / P) / 2.5
+        pseudocounts = float(np.mean(row_sums / P)) / 2.5
         # q is an m x dim(extent) structure
-        qshape = [len(data)]
+        qshape = [T]
         for v in self.extent:
             qshape.append(v)
-        self.q = torch.zeros(tuple(qshape))
+        self.q = torch.zeros(tuple(qshape), device=device, dtype=torch.double)
     
         for i in tqdm(range(max_iter)):    
             # E-Step 
@@ -149,17 +189,17 @@ class CountingGridModelWithGPU(CountingGridModel):
                 [(h.makeProgress(int(100*i/max_iter)) if h is not None else False)
                 for h in heartBeaters] if heartBeaters is not None else False
 
+        self.pi = self.pi.cpu().numpy()
+        self.q = self.q.cpu().numpy()
         if layers > 1:
-            self.pi = self.pi.cpu().numpy()
-            self.q = self.q.cpu().numpy()
-            data = data.cpu().numpy()
-            self.layercgdata = self.cg_layers(data, L=layers, noise=noise)
-            self.pi = torch.tensor(self.pi, device=device, dtype=torch.double)
-            self.q = torch.tensor(self.q, device=device, dtype=torch.double)
+            self.layercgdata = self.cg_layers(data_cpu, L=layers, noise=noise, nmax=layer_iterations)
+        else:
+            self.layercgdata = self.single_layer(data_cpu)
 
         if writeOutput:
-            if layers > 1:
-                scipy.io.savemat(str(output_directory) + "/CountingGridDataMatrices.mat", self.layercgdata)
-            else:
+            if layers == 1:
                 scipy.io.savemat(str(output_directory) + "/CGData.mat", {"pi": self.pi, "q": self.q})
+            scipy.io.savemat(str(output_directory) + "/CountingGridDataMatrices.mat", self.layercgdata)
+        self.pi = torch.tensor(self.pi, device=device, dtype=torch.double)
+        self.q = torch.tensor(self.q, device=device, dtype=torch.double)
         return self.pi
@@ -0,0 +1,192 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import multiprocessing
+import multiprocessing.connection
+import time
+import traceback
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import FusedKernels
+
+# A transport connects the coordinator to its workers. It has a connections() method returning one connection per worker,
+# each with the send(obj) and recv() methods of multiprocessing.connection.Connection, and a close() method.
+
+
+def serve_shard(connection, shard=None, rank=0):
+    '''
+    Runs a worker that owns one shard of the documents, until the coordinator on the other end of connection closes it.
+    If shard is None, the coordinator sends it. rank orders the shards of workers that bring their own.
+    On "e_step", computes q for the shard from the broadcast h and sends back the shard's QdotConH and log-likelihood.
+    '''
+    # Imported here to avoid a circular import: CountingGridModel imports this module.
+    from CountingGridsPy.models.CountingGridModel import CountingGridModel
+
+    try:
+        setup = connection.recv()
+        shard = setup["shard"] if shard is None else shard
+        model = CountingGridModel(setup["extent"], setup["window"], dtype=setup["dtype"])
+        model.workspace = {}
+        if scipy.sparse.issparse(shard):
+            shard = scipy.sparse.csr_matrix(shard, dtype=model.dtype)
+        else:
+            shard = np.asarray(shard, dtype=model.dtype)
+        connection.send((rank, shard.shape, float(shard.sum())))
+        q = None
+        while True:
+            command, h = connection.recv()
+            if command == "e_step":
+                q = model.e_step(shard, setup["top_k"], setup["batch_size"], log_h=np.log(h))
+                connection.send((model.q_dot_data(q, shard), model.log_likelihood))
+            elif command == "q":
+                connection.send(q)
+            elif command == "close":
+                break
+    except (EOFError, OSError):
+        # The coordinator is gone
+        pass
+    except Exception:
+        connection.send(RuntimeError(traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+def run_worker(address, authkey=None, shard=None, rank=0, retry_seconds=None):
+    '''
+    Connects to the SocketTransport of a coordinator at address and serves it a shard, see serve_shard.
+    If retry_seconds is given, keeps trying to connect every retry_seconds until the coordinator listens.
+    '''
+    while True:
+        try:
+            connection = multiprocessing.connection.Client(address, authkey=authkey)
+            break
+        except ConnectionRefusedError:
+            if retry_seconds is None:
+                raise
+            time.sleep(retry_seconds)
+    serve_shard(connection, shard, rank)
+
+
+class PipeTransport():
+    def __init__(self, processes):
+        '''
+        Local transport: one worker process per shard on this machine, connected by pipes.
+        '''
+        FusedKernels.use_fork_safe_threading_layer()
+        self.pipes = []
+        self.workers = []
+        for _ in range(processes):
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=serve_shard, args=(worker_connection,), daemon=True)
+            worker.start()
+            worker_connection.close()
+            self.pipes.append(connection)
+            self.workers.append(worker)
+
+    def connections(self):
+        return self.pipes
+
+    def close(self):
+        for connection, worker in zip(self.pipes, self.workers):
+            worker.join()
+            connection.close()
+        self.pipes = []
+        self.workers = []
+
+
+class SocketTransport():
+    def __init__(self, workers, address=("", 6001), authkey=None):
+        '''
+        Listens on address for workers that connect with run_worker, from this or any other machine.
+        address=(host, 0) picks a free port, which is then in self.address.
+        '''
+        self.workers = workers
+        self.listener = multiprocessing.connection.Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.accepted = None
+
+    def connections(self):
+        '''
+        Waits until all the workers have connected.
+        '''
+        if self.accepted is None:
+            self.accepted = [self.listener.accept() for _ in range(self.workers)]
+        return self.accepted
+
+    def close(self):
+        for connection in self.accepted or []:
+            connection.close()
+        self.listener.close()
+
+
+class DistributedEStep():
+    def __init__(self, transport, extent, window, dtype, top_k=None, batch_size=10000, data=None):
+        '''
+        Coordinates a data-parallel E-step over the workers of transport, which each own a shard of the documents.
+        If data is given, it is split into contiguous shards that are sent to the workers. Otherwise the workers
+        bring their own shards, which are ordered by rank.
+        self.shape is the T x Z shape of all the documents and self.total_counts the sum of all their word counts.
+        '''
+        self.transport = transport
+        self.connections = list(transport.connections())
+        bounds = np.linspace(0, 0 if data is None else data.shape[0], len(self.connections) + 1).astype(int)
+        for k, connection in enumerate(self.connections):
+            connection.send({
+                "extent": np.array(extent), "window": np.array(window), "dtype": np.dtype(dtype), "top_k": top_k, "batch_size": batch_size,
+                "shard": None if data is None else data[bounds[k]:bounds[k + 1]]
+            })
+        shards = [self.receive(connection) for connection in self.connections]
+        if data is None:
+            order = np.argsort([rank for rank, _, _ in shards], kind="stable")
+            self.connections = [self.connections[k] for k in order]
+            shards = [shards[k] for k in order]
+        if len(set(shape[1] for _, shape, _ in shards)) != 1:
+            raise ValueError("The shards of the workers have different vocabularies.")
+        self.shape = (sum(shape[0] for _, shape, _ in shards), shards[0][1][1])
+        self.total_counts = sum(total_counts for _, _, total_counts in shards)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def receive(self, connection):
+        message = connection.recv()
+        if isinstance(message, Exception):
+            raise message
+        return message
+
+    def e_step(self, h, out=None):
+        '''
+        Broadcasts h and runs the E-step on every shard.
+        Returns the QdotConH numerator reduced over the shards and the log-likelihood of all the documents.
+        '''
+        for connection in self.connections:
+            connection.send(("e_step", h))
+        partials = [self.receive(connection) for connection in self.connections]
+        QdotConH = np.empty_like(partials[0][0]) if out is None else out
+        np.copyto(QdotConH, partials[0][0])
+        for partial, _ in partials[1:]:
+            QdotConH += partial
+        return (QdotConH, sum([log_likelihood for _, log_likelihood in partials]))
+
+    def gather_q(self):
+        '''
+        q from the last E-step, T x E1 x E2, or sparse T x P with top_k.
+        '''
+        for connection in self.connections:
+            connection.send(("q", None))
+        q = [self.receive(connection) for connection in self.connections]
+        if scipy.sparse.issparse(q[0]):
+            return scipy.sparse.vstack(q, format="csr")
+        return np.concatenate(q, axis=0)
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(("close", None))
+            except (BrokenPipeError, OSError):
+                pass
+        self.connections = []
+        self.transport.close()
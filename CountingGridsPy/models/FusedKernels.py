@@ -0,0 +1,197 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+import warnings
+import numpy as np
+
+# Compiled kernels for the two hot spots of EM, used by CountingGridModel when numba is installed.
+# Each one makes fewer, parallel sweeps over memory than the numpy code it replaces.
+try:
+    import numba
+    from numba import njit, prange
+    AVAILABLE = True
+except ImportError:
+    AVAILABLE = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+
+def use_fork_safe_threading_layer():
+    '''
+    Selects numba's workqueue threading layer for the process, since the tbb and GNU OpenMP layers hang in processes
+    forked after their threads have started. Every compiled CountingGridModel calls it when it is created, before its
+    first kernel runs, and so do the process pools of this package before they fork. Importing this module changes nothing.
+    Does nothing if NUMBA_THREADING_LAYER is set, and warns if numba's threads have already started with another layer.
+    '''
+    if not AVAILABLE or "NUMBA_THREADING_LAYER" in os.environ:
+        return
+    try:
+        layer = numba.threading_layer()
+    except ValueError:
+        # No parallel kernel has run yet
+        numba.config.THREADING_LAYER = "workqueue"
+        return
+    if layer != "workqueue":
+        warnings.warn(
+            "numba's {} threading layer may hang the worker processes forked by CountingGridsPy. Set NUMBA_THREADING_LAYER=workqueue, "
+            "or call FusedKernels.use_fork_safe_threading_layer() before any counting grid is fit.".format(layer)
+        )
+
+
+# Documents per parallel task when the locations are the rows
+COLUMN_BLOCK = 256
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def subtract_row_maxima(lq):
+    '''
+    Subtracts from each row of lq its maximum, in place, and returns the maxima.
+    '''
+    T, P = lq.shape
+    maxima = np.empty(T)
+    for t in prange(T):
+        row = lq[t]
+        row_max = row[0]
+        for p in range(1, P):
+            row_max = max(row_max, row[p])
+        for p in range(P):
+            row[p] -= row_max
+        maxima[t] = row_max
+    return maxima
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def normalize_rows(q, min_prob):
+    '''
+    Normalizes each row of q in place, clamps it below at min_prob and renormalizes it. Returns the first normalizers.
+    '''
+    T, P = q.shape
+    totals = np.empty(T)
+    for t in prange(T):
+        row = q[t]
+        total = 0.0
+        for p in range(P):
+            total += row[p]
+        clamped_total = 0.0
+        for p in range(P):
+            row[p] = max(row[p] / total, min_prob)
+            clamped_total += row[p]
+        for p in range(P):
+            row[p] /= clamped_total
+        totals[t] = total
+    return totals
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def subtract_column_maxima(lq):
+    '''
+    subtract_row_maxima for the columns. Every task takes COLUMN_BLOCK columns, so the inner loops run along contiguous rows.
+    '''
+    P, T = lq.shape
+    maxima = np.empty(T)
+    for block in prange((T + COLUMN_BLOCK - 1) // COLUMN_BLOCK):
+        start = block * COLUMN_BLOCK
+        stop = min(start + COLUMN_BLOCK, T)
+        column_max = lq[0, start:stop].copy()
+        for p in range(1, P):
+            row = lq[p, start:stop]
+            for t in range(stop - start):
+                column_max[t] = max(column_max[t], row[t])
+        for p in range(P):
+            row = lq[p, start:stop]
+            for t in range(stop - start):
+                row[t] -= column_max[t]
+        maxima[start:stop] = column_max
+    return maxima
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def normalize_columns(q, min_prob):
+    '''
+    normalize_rows for the columns, COLUMN_BLOCK columns per task.
+    '''
+    P, T = q.shape
+    totals = np.empty(T)
+    for block in prange((T + COLUMN_BLOCK - 1) // COLUMN_BLOCK):
+        start = block * COLUMN_BLOCK
+        stop = min(start + COLUMN_BLOCK, T)
+        total = np.zeros(stop - start)
+        for p in range(P):
+            row = q[p, start:stop]
+            for t in range(stop - start):
+                total[t] += row[t]
+        clamped_total = np.zeros(stop - start)
+        for p in range(P):
+            row = q[p, start:stop]
+            for t in range(stop - start):
+                row[t] = max(row[t] / total[t], min_prob)
+                clamped_total[t] += row[t]
+        for p in range(P):
+            row = q[p, start:stop]
+            for t in range(stop - start):
+                row[t] /= clamped_total[t]
+        totals[start:stop] = total
+    return totals
+
+
+def normalize_posterior(lq, min_prob):
+    '''
+    The log-sum-exp normalization of q_update, in place on the P x T log-likelihoods lq, in either memory order.
+    The exponential is left to numpy, whose vectorized exp is faster than numba's; the passes around it are fused.
+    Returns the log-likelihood of the documents, up to the T * log(P) of the uniform prior.
+    '''
+    if lq.flags.c_contiguous:
+        maxima = subtract_column_maxima(lq)
+        np.exp(lq, out=lq)
+        totals = normalize_columns(lq, min_prob)
+    else:
+        maxima = subtract_row_maxima(np.transpose(lq))
+        np.exp(lq, out=lq)
+        totals = normalize_rows(np.transpose(lq), min_prob)
+    return np.sum(maxima, dtype=np.float64) + np.sum(np.log(totals), dtype=np.float64)
+
+
+@njit(parallel=True, cache=True)
+def toroidal_window_sums(a, w0, w1, o0, o1, out, normalize):
+    '''
+    out[i, j] = the sum of a over the w0 x w1 window whose first corner is (i + o0, j + o1), wrapping around the torus.
+    The sums are sliding: each window adds the row (or column) entering it and subtracts the one leaving it, in float64,
+    so there is no padded copy and no summed area table. Negative sums from cancellation are set to 0.
+    If normalize is True, every out[i, j] is divided by its sum over the last axis.
+    '''
+    E0, E1, Z = a.shape
+    rows = np.empty((E0, E1, Z))
+    for j in prange(E1):
+        total = np.zeros(Z)
+        for d in range(w0):
+            i0 = ((d + o0) % E0 + E0) % E0
+            for z in range(Z):
+                total[z] += a[i0, j, z]
+        for i in range(E0):
+            entering = ((i + w0 + o0) % E0 + E0) % E0
+            leaving = ((i + o0) % E0 + E0) % E0
+            for z in range(Z):
+                rows[i, j, z] = total[z]
+                total[z] += a[entering, j, z] - a[leaving, j, z]
+    for i in prange(E0):
+        total = np.zeros(Z)
+        for d in range(w1):
+            j0 = ((d + o1) % E1 + E1) % E1
+            for z in range(Z):
+                total[z] += rows[i, j0, z]
+        for j in range(E1):
+            entering = ((j + w1 + o1) % E1 + E1) % E1
+            leaving = ((j + o1) % E1 + E1) % E1
+            scale = 1.0
+            if normalize:
+                denominator = 0.0
+                for z in range(Z):
+                    denominator += max(total[z], 0.0)
+                scale = 1.0 / denominator
+            for z in range(Z):
+                out[i, j, z] = max(total[z], 0.0) * scale
+                total[z] += rows[i, entering, z] - rows[i, leaving, z]
+    return out
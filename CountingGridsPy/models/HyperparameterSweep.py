@@ -0,0 +1,83 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import multiprocessing
+import numpy as np
+from CountingGridsPy.models import FusedKernels
+from CountingGridsPy.models.RandomRestarts import share_data, attach_data
+
+# Set in each worker process by sweep_initializer
+sweep_context = {}
+
+
+def sweep_initializer(shared_training_data, shared_held_out_data, dtype):
+    sweep_context.update({"training_data": attach_data(shared_training_data), "held_out_data": attach_data(shared_held_out_data), "dtype": dtype})
+
+
+def sweep_worker(extent, window, layers, seed, max_iter, fit_kwargs):
+    '''
+    Fits one configuration to the training documents in a worker process and scores it on the held-out ones.
+    Returns its pi, its layered pi_la (None when layers is 1) and its held-out log-likelihood.
+    '''
+    # Imported here to avoid a circular import: CountingGridModel imports RandomRestarts.
+    from CountingGridsPy.models.CountingGridModel import CountingGridModel
+
+    model = CountingGridModel(extent, window, dtype=sweep_context["dtype"], seed=seed)
+    model.fit(sweep_context["training_data"], max_iter=max_iter, layers=layers, writeOutput=False, **fit_kwargs)
+    pi_la = model.layercgdata["pi_la"] if layers > 1 else None
+    return (model.pi, pi_la, model.score(sweep_context["held_out_data"], pi_la))
+
+
+class HyperparameterSweep():
+    def __init__(self, data, held_out=0.1, dtype=np.float64, processes=None, seed=0):
+        '''
+        Holds out a random held_out fraction of the T x Z documents, and starts a pool of processes that all read
+        the training and held-out documents from shared memory. processes=None uses one process per CPU.
+        '''
+        self.dtype = np.dtype(dtype)
+        self.seed = np.random.SeedSequence(seed)
+        T = data.shape[0]
+        order = np.random.default_rng(self.seed).permutation(T)
+        split = T - max(1, int(round(held_out * T)))
+        if split < 1:
+            raise ValueError("There are too few documents to hold out {} of them.".format(held_out))
+        FusedKernels.use_fork_safe_threading_layer()
+        self.pool = multiprocessing.Pool(
+            processes, initializer=sweep_initializer,
+            initargs=(share_data(data[np.sort(order[:split])]), share_data(data[np.sort(order[split:])]), self.dtype)
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def run(self, configurations, max_iter=100, **fit_kwargs):
+        '''
+        Fits every (extent, window, layers) configuration concurrently. extent and window are ints for square grids, or pairs.
+        Returns one dict per configuration, in order, with its extent, window, layers, pi, pi_la and held-out log-likelihood "score".
+        '''
+        configurations = [
+            (np.broadcast_to(np.asarray(extent, dtype=int), (2,)), np.broadcast_to(np.asarray(window, dtype=int), (2,)), int(layers))
+            for extent, window, layers in configurations
+        ]
+        results = self.pool.starmap(sweep_worker, [
+            (extent, window, layers, seed, max_iter, fit_kwargs)
+            for (extent, window, layers), seed in zip(configurations, self.seed.spawn(len(configurations)))
+        ])
+        return [
+            {"extent": extent, "window": window, "layers": layers, "pi": pi, "pi_la": pi_la, "score": score}
+            for (extent, window, layers), (pi, pi_la, score) in zip(configurations, results)
+        ]
+
+    @staticmethod
+    def best(results):
+        '''
+        The result of run with the highest held-out log-likelihood.
+        '''
+        return max(results, key=lambda result: result["score"])
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
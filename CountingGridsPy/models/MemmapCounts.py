@@ -0,0 +1,33 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+import numpy as np
+import scipy.sparse
+
+# A T x Z count matrix on disk: the three CSR arrays and the shape, one .npy file each
+FILE_NAMES = ["data", "indices", "indptr", "shape"]
+
+
+def save_counts(X, directory, dtype=np.float64):
+    '''
+    Writes the T x Z count matrix X to directory in CSR form, with the counts in dtype.
+    Saving them in the dtype of the model that reads them means fit never has to copy them.
+    '''
+    X = scipy.sparse.csr_matrix(X)
+    arrays = {"data": X.data.astype(dtype, copy=False), "indices": X.indices, "indptr": X.indptr, "shape": np.array(X.shape)}
+    for name in FILE_NAMES:
+        np.save(os.path.join(str(directory), name + ".npy"), arrays[name])
+
+
+def load_counts(directory):
+    '''
+    Opens the count matrix written by save_counts as a CSR matrix over memory-mapped arrays.
+    Nothing is read until it is used: a slice of rows only reads the pages of those rows, so fit(chunk_size=...)
+    streams over the file a block of documents at a time instead of holding it in memory.
+    '''
+    data, indices, indptr = [
+        np.load(os.path.join(str(directory), name + ".npy"), mmap_mode="r") for name in FILE_NAMES[:3]
+    ]
+    shape = tuple(int(n) for n in np.load(os.path.join(str(directory), "shape.npy")))
+    return scipy.sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
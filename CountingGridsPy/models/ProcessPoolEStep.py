@@ -0,0 +1,124 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import multiprocessing
+import traceback
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import FusedKernels
+
+TYPECODES = {np.dtype(np.float32): 'f', np.dtype(np.float64): 'd'}
+
+
+def shard_worker(connection, shard, extent, window, dtype, shared_log_h, shared_QdotConH, slot, top_k=None, batch_size=10000):
+    '''
+    Runs in a worker process that owns one shard of the documents.
+    On "e_step", computes q for the shard from the shared log(h) and writes the shard's QdotConH into its slot.
+    '''
+    # Imported here to avoid a circular import: CountingGridModel imports this module.
+    from CountingGridsPy.models.CountingGridModel import CountingGridModel
+
+    try:
+        model = CountingGridModel(extent, window, dtype=dtype)
+        model.workspace = {}
+        E0, E1 = extent
+        Z = shard.shape[1]
+        log_h = np.frombuffer(shared_log_h, dtype=dtype).reshape((E0, E1, Z))
+        QdotConH = np.frombuffer(shared_QdotConH, dtype=dtype).reshape((-1, E0, E1, Z))[slot]
+        q = None
+        while True:
+            command = connection.recv()
+            if command == "e_step":
+                q = model.e_step(shard, top_k, batch_size, log_h=log_h)
+                np.copyto(QdotConH, model.q_dot_data(q, shard))
+                connection.send(model.log_likelihood)
+            elif command == "q":
+                connection.send(q.copy())
+            elif command == "close":
+                break
+    except Exception:
+        connection.send(RuntimeError(traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+class ProcessPoolEStep():
+    def __init__(self, data, extent, window, dtype, processes, top_k=None, batch_size=10000):
+        '''
+        Splits the T x Z data into contiguous document shards, one per worker process.
+        log(h) and the per-shard QdotConH numerators live in shared memory, so each E-step only sends
+        a command and a log-likelihood through the pipes.
+        '''
+        FusedKernels.use_fork_safe_threading_layer()
+        T, Z = data.shape
+        E0, E1 = extent
+        processes = max(1, min(processes, T))
+        dtype = np.dtype(dtype)
+        shared_log_h = multiprocessing.RawArray(TYPECODES[dtype], int(E0 * E1 * Z))
+        shared_QdotConH = multiprocessing.RawArray(TYPECODES[dtype], int(processes * E0 * E1 * Z))
+        self.log_h = np.frombuffer(shared_log_h, dtype=dtype).reshape((E0, E1, Z))
+        self.QdotConH = np.frombuffer(shared_QdotConH, dtype=dtype).reshape((processes, E0, E1, Z))
+
+        bounds = np.linspace(0, T, processes + 1).astype(int)
+        self.connections = []
+        self.workers = []
+        for slot in range(processes):
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=shard_worker,
+                args=(
+                    worker_connection, data[bounds[slot]:bounds[slot + 1]], np.array(extent), np.array(window),
+                    dtype, shared_log_h, shared_QdotConH, slot, top_k, batch_size
+                ),
+                daemon=True
+            )
+            worker.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def receive(self, connection):
+        message = connection.recv()
+        if isinstance(message, Exception):
+            raise message
+        return message
+
+    def e_step(self, h, out=None):
+        '''
+        Runs the E-step on every shard in parallel.
+        Returns the QdotConH numerator reduced over the shards and the log-likelihood of all the documents.
+        '''
+        np.log(h, out=self.log_h)
+        for connection in self.connections:
+            connection.send("e_step")
+        log_likelihood = sum([self.receive(connection) for connection in self.connections])
+        return (np.sum(self.QdotConH, axis=0, out=out), log_likelihood)
+
+    def gather_q(self):
+        '''
+        q from the last E-step, T x E1 x E2, or sparse T x P with top_k.
+        '''
+        for connection in self.connections:
+            connection.send("q")
+        q = [self.receive(connection) for connection in self.connections]
+        if scipy.sparse.issparse(q[0]):
+            return scipy.sparse.vstack(q, format="csr")
+        return np.concatenate(q, axis=0)
+
+    def close(self):
+        for connection, worker in zip(self.connections, self.workers):
+            if worker.is_alive():
+                try:
+                    connection.send("close")
+                except (BrokenPipeError, OSError):
+                    pass
+            worker.join()
+            connection.close()
+        self.connections = []
+        self.workers = []
@@ -0,0 +1,132 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import FusedKernels
+
+# Set in each worker process by restart_initializer
+restart_context = {}
+
+
+def share_array(a):
+    '''
+    Copies a into shared memory. Returns what attach_array needs to view it, also from another process.
+    '''
+    a = np.ascontiguousarray(a)
+    shared = multiprocessing.RawArray('b', max(1, a.nbytes))
+    np.frombuffer(shared, dtype=a.dtype, count=a.size).reshape(a.shape)[...] = a
+    return (shared, a.dtype.str, a.shape)
+
+
+def attach_array(shared_array):
+    shared, dtype, shape = shared_array
+    return np.frombuffer(shared, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def share_data(data):
+    '''
+    Copies a T x Z numpy array or scipy.sparse matrix into shared memory, see share_array.
+    '''
+    if scipy.sparse.issparse(data):
+        data = scipy.sparse.csr_matrix(data)
+        return {
+            "data": share_array(data.data), "indices": share_array(data.indices), "indptr": share_array(data.indptr),
+            "shape": data.shape
+        }
+    return share_array(data)
+
+
+def attach_data(shared_data):
+    if isinstance(shared_data, dict):
+        return scipy.sparse.csr_matrix(
+            (attach_array(shared_data["data"]), attach_array(shared_data["indices"]), attach_array(shared_data["indptr"])),
+            shape=shared_data["shape"], copy=False
+        )
+    return attach_array(shared_data)
+
+
+def restart_initializer(shared_data, extent, window, dtype):
+    restart_context.update({"data": attach_data(shared_data), "extent": extent, "window": window, "dtype": dtype})
+
+
+def restart_worker(seed, max_iter, checkpoint_every, checkpoint_directory, resume, fit_kwargs, deadline=None):
+    '''
+    Fits one restart in a worker process, seeded with its own np.random.Generator, until max_iter or the time.time()
+    deadline. Returns its pi, log-likelihoods and generator, and whether it ran out of time.
+    '''
+    # Imported here to avoid a circular import: CountingGridModel imports this module.
+    from CountingGridsPy.models.CountingGridModel import CountingGridModel
+
+    model = CountingGridModel(restart_context["extent"], restart_context["window"], dtype=restart_context["dtype"], seed=seed)
+    model.fit(
+        restart_context["data"], max_iter=max_iter, writeOutput=False, checkpoint_directory=checkpoint_directory,
+        checkpoint_every=checkpoint_every, resume=resume, time_budget=None if deadline is None else max(0.0, deadline - time.time()),
+        **fit_kwargs
+    )
+    return (model.pi, model.log_likelihoods, model.rng, model.out_of_time)
+
+
+class RandomRestarts():
+    def __init__(self, data, extent, window, dtype, processes=None):
+        '''
+        Starts a pool of processes that all read the T x Z data from shared memory.
+        processes=None uses one process per CPU.
+        '''
+        FusedKernels.use_fork_safe_threading_layer()
+        self.pool = multiprocessing.Pool(
+            processes, initializer=restart_initializer, initargs=(share_data(data), np.array(extent), np.array(window), np.dtype(dtype))
+        )
+        # Restarts that survive pruning continue from checkpoints in here
+        self.directory = tempfile.mkdtemp()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def best(self, seeds, max_iter, restart_iterations=5, restart_tolerance=0.01, deadline=None, **fit_kwargs):
+        '''
+        Fits one model per seed and returns (pi, log_likelihoods, rng) of the one with the highest final log-likelihood.
+        Every restart first runs restart_iterations iterations. The ones whose log-likelihood is then more than
+        restart_tolerance (relative) below the best are dropped, and the others continue to max_iter.
+        If the time.time() deadline passes, every restart stops after its current iteration, and self.out_of_time is set.
+        '''
+        restart_iterations = min(restart_iterations, max_iter)
+        directories = []
+        for k in range(len(seeds)):
+            directories.append(os.path.join(self.directory, str(k)))
+            os.mkdir(directories[-1])
+
+        early = self.pool.starmap(restart_worker, [
+            (seed, restart_iterations, restart_iterations, directory, False, dict(fit_kwargs, tol=None), deadline)
+            for seed, directory in zip(seeds, directories)
+        ])
+        self.out_of_time = any(out_of_time for _, _, _, out_of_time in early)
+        self.early_log_likelihoods = [log_likelihoods[-1] for _, log_likelihoods, _, _ in early]
+        best_early = max(self.early_log_likelihoods)
+        self.survivors = [
+            k for k, log_likelihood in enumerate(self.early_log_likelihoods)
+            if log_likelihood >= best_early - restart_tolerance * abs(best_early)
+        ]
+
+        if restart_iterations < max_iter and not self.out_of_time:
+            results = self.pool.starmap(restart_worker, [
+                (seeds[k], max_iter, max_iter, directories[k], True, fit_kwargs, deadline) for k in self.survivors
+            ])
+            self.out_of_time = any(out_of_time for _, _, _, out_of_time in results)
+        else:
+            results = [early[k] for k in self.survivors]
+        pi, log_likelihoods, rng, _ = max(results, key=lambda result: result[1][-1])
+        return (pi, log_likelihoods, rng)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        shutil.rmtree(self.directory, ignore_errors=True)
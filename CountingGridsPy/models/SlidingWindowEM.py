@@ -0,0 +1,131 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+import numpy as np
+import scipy.sparse
+
+
+class SlidingWindowEM():
+    '''
+    Incremental EM for a counting grid over a window of documents that slides forward through data.
+    The QdotConH statistics of the window are kept as a sum of per-document terms q( location | document ) x counts,
+    and the q of every document in the window is kept with them. When the window moves, the documents that leave it
+    are subtracted from the statistics with the q they were added with, and only the documents that enter it get
+    E-steps, so a step costs O(s) E-steps for s entering documents, whatever the size of the window.
+    The q of the documents already in the window are not refreshed, as in incremental EM.
+    '''
+
+    def __init__(self, model, data, capacity):
+        '''
+        model is a CountingGridModel whose pi the first window starts from. data holds all the T x Z documents,
+        sorted, and capacity is the largest number of documents a window will hold.
+        '''
+        self.model = model
+        if scipy.sparse.issparse(data):
+            data = scipy.sparse.csr_matrix(data, dtype=model.dtype)
+        else:
+            data = np.asarray(data, dtype=model.dtype)
+        self.data = data
+        self.capacity = capacity
+        E0, E1 = model.extent
+        self.P = E0 * E1
+        if getattr(model, "h", None) is None:
+            model.h = model.compute_h(model.pi, model.window)
+        # The q of document t is row t % capacity
+        self.q_rows = np.zeros((capacity, self.P), dtype=model.dtype)
+        self.QdotConH = np.zeros(model.pi.shape, dtype=model.dtype)
+        self.total_counts = 0.0
+        self.first = 0
+        self.last = 0
+
+    def rows(self, first, last):
+        return np.arange(first, last) % self.capacity
+
+    def window_q(self):
+        '''
+        q of the documents of the window, in order, as a T x E1 x E2 array.
+        '''
+        return np.reshape(self.q_rows[self.rows(self.first, self.last)], tuple([self.last - self.first] + list(self.model.extent)))
+
+    def add(self, first, last, sign):
+        rows = self.q_rows[self.rows(first, last)]
+        q = np.reshape(rows, tuple([last - first] + list(self.model.extent)))
+        if sign > 0:
+            self.QdotConH += self.model.q_dot_data(q, self.data[first:last])
+        else:
+            self.QdotConH -= self.model.q_dot_data(q, self.data[first:last])
+            # Cancellation may leave tiny negative sums
+            np.maximum(self.QdotConH, 0, out=self.QdotConH)
+
+    def slide(self, first, last, iterations=3):
+        '''
+        Moves the window to the documents first to last - 1, then runs iterations EM iterations in which only
+        the documents that entered the window get an E-step. Updates model.pi and model.h.
+        A window that does not overlap the previous one starts over from empty statistics.
+        Returns False, and does nothing, if the window holds the same documents as before.
+        '''
+        if first < self.first or last < self.last or last <= first or last - first > self.capacity:
+            raise ValueError("Windows only move forward and hold between 1 and {} documents.".format(self.capacity))
+        if first == self.first and last == self.last:
+            return False
+        model = self.model
+        alpha = 1e-10
+        if first >= self.last:
+            self.QdotConH[...] = 0
+            self.total_counts = 0.0
+            self.first = self.last = first
+        if first > self.first:
+            self.add(self.first, first, -1)
+            self.total_counts -= float(self.data[self.first:first].sum())
+        incoming = self.data[self.last:last]
+        self.total_counts += float(incoming.sum())
+        pseudocounts = self.total_counts / (last - first) / self.P / 2.5
+        entering = self.last
+        self.first, self.last = first, last
+
+        # With no entering documents, one M-step accounts for the leaving ones
+        iterations = max(1, iterations) if last > entering else 1
+        for iteration in range(iterations):
+            if last > entering:
+                if iteration > 0:
+                    self.add(entering, last, -1)
+                q = model.q_update(incoming)
+                self.q_rows[self.rows(entering, last)] = np.reshape(q, (last - entering, self.P))
+                self.add(entering, last, 1)
+            model.pi = model.pi_update_from_statistics(self.QdotConH, pseudocounts, alpha)
+            model.h = model.compute_h(model.pi, model.window)
+        return True
+
+    def save(self, file_name, **arrays):
+        '''
+        Saves pi, the statistics of the window and the q of its documents to file_name, along with arrays.
+        Like CountingGridModel.save_checkpoint, the file is written under a temporary name and then renamed.
+        '''
+        arrays.update({
+            "pi": self.model.pi, "QdotConH": self.QdotConH, "q": self.q_rows[self.rows(self.first, self.last)],
+            "total_counts": self.total_counts, "first": self.first, "last": self.last
+        })
+        with open(file_name + ".tmp", "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(file_name + ".tmp", file_name)
+
+    def resume(self, file_name):
+        '''
+        Restores the window and the pi of the model from a file written by save, and returns the other arrays saved in it.
+        The documents of the window must still be the same rows of data.
+        '''
+        with np.load(file_name) as f:
+            state = {key: f[key] for key in f.files}
+        if state["pi"].shape != self.model.pi.shape:
+            raise ValueError("The state in {} belongs to a different grid or vocabulary.".format(file_name))
+        first, last = int(state.pop("first")), int(state.pop("last"))
+        if last - first > self.capacity or last > self.data.shape[0]:
+            raise ValueError("The window saved in {} does not fit in these documents.".format(file_name))
+        self.model.pi = state.pop("pi").astype(self.model.dtype)
+        self.model.h = self.model.compute_h(self.model.pi, self.model.window)
+        self.QdotConH = state.pop("QdotConH").astype(self.model.dtype)
+        self.q_rows[self.rows(first, last)] = state.pop("q")
+        self.total_counts = float(state.pop("total_counts"))
+        self.first, self.last = first, last
+        return state
@@ -1,4 +1,5 @@
 from .CountingGridModel import CountingGridModel
 from .CountingGridModelWithGPU import CountingGridModelWithGPU
+from .SlidingWindowEM import SlidingWindowEM
 
-__all__ = ['CountingGridModel', 'CountingGridModelWithGPU']
+__all__ = ['CountingGridModel', 'CountingGridModelWithGPU', 'SlidingWindowEM']
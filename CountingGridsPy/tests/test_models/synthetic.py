@@ -0,0 +1,16 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import numpy as np
+from CountingGridsPy.models import CountingGridModel
+
+
+def make_documents(T, Z, extent, window, words):
+    '''
+    T documents of words words each over a vocabulary of Z words, drawn from the windows of a random grid of the given
+    extent and window whose locations each favour a few words. Uses np.random, so seed it first.
+    '''
+    generator = CountingGridModel(extent, window)
+    h = generator.compute_h(np.random.dirichlet(np.ones(Z) * 0.05, size=tuple(extent)), window)
+    locations = np.random.randint(extent, size=(T, 2))
+    return np.array([np.random.multinomial(words, h[k[0], k[1]]) for k in locations])
@@ -0,0 +1,75 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import unittest
+import shutil
+import tempfile
+import numpy as np
+from CountingGridsPy.models import CountingGridModel
+from synthetic import make_documents
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        T, Z = [500, 50]
+        self.extent = np.array([8, 8])
+        self.window = np.array([3, 3])
+        self.data = make_documents(T, Z, self.extent, self.window, 15)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fit(self, max_iter, **kwargs):
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(self.data, max_iter=max_iter, writeOutput=False, checkpoint_directory=self.directory, **kwargs)
+        return model
+
+    def assert_resume_matches_uninterrupted_fit(self, **kwargs):
+        np.random.seed(1)
+        uninterrupted = CountingGridModel(self.extent, self.window)
+        uninterrupted.fit(self.data, max_iter=8, writeOutput=False, **kwargs)
+
+        # The RNG is restored from the checkpoint, so the seed of the resumed run doesn't matter
+        np.random.seed(1)
+        self.fit(5, **kwargs)
+        np.random.seed(2)
+        resumed = self.fit(8, resume=True, **kwargs)
+
+        assert(np.allclose(resumed.pi, uninterrupted.pi))
+        assert(np.allclose(resumed.q, uninterrupted.q))
+        assert(np.allclose(resumed.log_likelihoods, uninterrupted.log_likelihoods))
+
+    def test_resume_batch(self):
+        self.assert_resume_matches_uninterrupted_fit()
+
+    def test_resume_online(self):
+        self.assert_resume_matches_uninterrupted_fit(mode="online", batch_size=100)
+
+    def test_checkpoint_every(self):
+        checkpoints = []
+        self.fit(7, checkpoint_every=3, on_checkpoint=checkpoints.append)
+        assert(len(checkpoints) == 2)
+        assert(CountingGridModel.load_checkpoint(checkpoints[-1])["iteration"] == 6)
+
+    def test_resume_finished_fit(self):
+        finished = self.fit(4)
+        resumed = self.fit(4, resume=True)
+        assert(np.allclose(resumed.pi, finished.pi))
+        assert(np.allclose(np.sum(resumed.q, axis=(1, 2)), 1))
+        assert(len(resumed.log_likelihoods) == 4)
+
+    def test_resume_after_time_budget(self):
+        np.random.seed(1)
+        uninterrupted = CountingGridModel(self.extent, self.window)
+        uninterrupted.fit(self.data, max_iter=6, writeOutput=False)
+
+        np.random.seed(1)
+        stopped = self.fit(6, checkpoint_every=100, time_budget=0)
+        assert(stopped.out_of_time)
+        assert(len(stopped.log_likelihoods) == 1)
+        resumed = self.fit(6, resume=True)
+        assert(not resumed.out_of_time)
+        assert(np.allclose(resumed.pi, uninterrupted.pi))
+        assert(np.allclose(resumed.log_likelihoods, uninterrupted.log_likelihoods))
@@ -0,0 +1,38 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import unittest
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import CountingGridModel
+from CountingGridsPy.models.CountingGridModel import toroidal_upsample
+from synthetic import make_documents
+
+
+class TestCoarseToFine(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        T, Z = [1500, 100]
+        self.extent = np.array([16, 16])
+        self.window = np.array([4, 4])
+        self.data = scipy.sparse.csr_matrix(make_documents(T, Z, self.extent, self.window, 20))
+
+    def test_toroidal_upsample(self):
+        a = np.random.random((4, 6, 3))
+        assert(np.allclose(toroidal_upsample(a, [4, 6]), a))
+        assert(np.allclose(toroidal_upsample(np.ones((4, 6, 3)), [8, 12]), 1))
+        # Shifting around the torus commutes with upsampling
+        shifted = np.roll(a, (1, 2), axis=(0, 1))
+        assert(np.allclose(toroidal_upsample(shifted, [8, 12]), np.roll(toroidal_upsample(a, [8, 12]), (2, 4), axis=(0, 1))))
+
+    def test_coarse_to_fine_fit(self):
+        numIters = 5
+        randomModel = CountingGridModel(self.extent, self.window, seed=0)
+        randomModel.fit(self.data, max_iter=numIters, writeOutput=False)
+
+        model = CountingGridModel(self.extent, self.window, seed=0)
+        model.fit(self.data, max_iter=numIters, writeOutput=False, coarse_levels=2, coarse_max_iter=10)
+        assert(model.pi.shape == randomModel.pi.shape)
+        assert(np.allclose(np.sum(model.pi, axis=2), 1))
+        assert(len(model.log_likelihoods) == numIters)
+        assert(model.log_likelihoods[-1] > randomModel.log_likelihoods[-1])
@@ -0,0 +1,102 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import unittest
+import numpy as np
+from CountingGridsPy.models import CountingGridModel
+
+
+class TestEarlyStopping(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        M, N = [200, 50]
+        self.data = np.round(np.random.random((M, N)) * 3) * (np.random.random((M, N)) > 0.6)
+        self.extent = np.array([8, 8])
+        self.window = np.array([3, 3])
+        self.pi_init = np.random.random([8, 8, N])
+
+    def test_log_likelihood_increases(self):
+        model = CountingGridModel(self.extent, self.window)
+        pi, log_likelihoods = model.fit(
+            self.data, max_iter=30, pi=np.copy(self.pi_init),
+            writeOutput=False, returnLogLikelihoods=True
+        )
+        assert(len(log_likelihoods) == 30)
+        assert(np.all(np.diff(log_likelihoods) > -1e-8 * abs(log_likelihoods[0])))
+
+    def test_stops_early_and_matches_full_run(self):
+        maxIters = 500
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(
+            self.data, max_iter=maxIters, pi=np.copy(self.pi_init),
+            writeOutput=False, tol=1e-5, patience=2
+        )
+        numIters = len(model.log_likelihoods)
+        assert(numIters < maxIters)
+
+        referenceModel = CountingGridModel(self.extent, self.window)
+        referenceModel.fit(
+            self.data, max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False
+        )
+        assert(np.all(np.isclose(model.pi, referenceModel.pi)))
+        assert(np.all(np.isclose(model.log_likelihoods, referenceModel.log_likelihoods)))
+
+    def test_time_budget(self):
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(self.data, max_iter=500, pi=np.copy(self.pi_init), writeOutput=False, time_budget=0)
+        assert(model.out_of_time)
+        assert(len(model.log_likelihoods) == 1)
+        assert(model.q.shape == (self.data.shape[0], 8, 8))
+
+        model.fit(self.data, max_iter=5, pi=np.copy(self.pi_init), writeOutput=False, time_budget=3600)
+        assert(not model.out_of_time)
+        assert(len(model.log_likelihoods) == 5)
+
+    def test_time_budget_covers_restarts_and_coarse_levels(self):
+        model = CountingGridModel(self.extent, self.window, seed=0)
+        model.fit(self.data, max_iter=50, writeOutput=False, restarts=2, restart_iterations=5, processes=2, time_budget=0)
+        assert(model.out_of_time)
+        assert(len(model.log_likelihoods) == 1)
+
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(self.data, max_iter=50, writeOutput=False, coarse_levels=1, time_budget=0)
+        assert(model.out_of_time)
+        assert(len(model.coarse_log_likelihoods) == 1)
+        assert(len(model.log_likelihoods) == 1)
+
+    def test_preview(self):
+        class Previewer():
+            def __init__(self):
+                self.progress = []
+                self.previews = []
+                self.q_is_current = []
+
+            def makeProgress(self, progress):
+                self.progress.append(progress)
+
+            def preview(self, model, iteration):
+                self.previews.append((iteration, np.copy(model.pi)))
+                self.q_is_current.append(model.q_is_current)
+
+        previewer = Previewer()
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(self.data, max_iter=5, pi=np.copy(self.pi_init), writeOutput=False, heartBeaters=[previewer, None])
+        assert(previewer.progress == [20, 40, 60, 80, 100])
+        assert([iteration for iteration, _ in previewer.previews] == [1, 2, 3, 4, 5])
+        assert(np.allclose(previewer.previews[-1][1], model.pi))
+        assert(all(previewer.q_is_current))
+
+        # The docmap of a preview needs q, which these E-steps don't keep
+        for kwargs in [{"mode": "online"}, {"processes": 2}, {"chunk_size": 50}]:
+            previewer = Previewer()
+            model = CountingGridModel(self.extent, self.window)
+            model.fit(self.data, max_iter=3, pi=np.copy(self.pi_init), writeOutput=False, heartBeaters=[previewer], **kwargs)
+            assert(len(previewer.previews) == 3)
+            assert(not any(previewer.q_is_current))
+
+        # SQUAREM skips iterations
+        previewer = Previewer()
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(self.data, max_iter=10, pi=np.copy(self.pi_init), writeOutput=False, heartBeaters=[previewer], accelerate=True)
+        iterations = [iteration for iteration, _ in previewer.previews]
+        assert(iterations[-1] == 10 and any(b - a > 1 for a, b in zip(iterations, iterations[1:])))
@@ -0,0 +1,54 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import multiprocessing
+import unittest
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import CountingGridModel
+from CountingGridsPy.models.DistributedEStep import PipeTransport, SocketTransport, run_worker
+
+
+class TestDistributedEStep(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        M, N = [301, 40]
+        self.data = scipy.sparse.csr_matrix(np.round(np.random.random((M, N)) * 3) * (np.random.random((M, N)) > 0.6))
+        self.extent = np.array([6, 6])
+        self.window = np.array([2, 3])
+        self.pi_init = np.random.random([6, 6, N])
+        self.serialModel = CountingGridModel(self.extent, self.window, seed=0)
+        self.serialModel.fit(self.data, max_iter=5, pi=np.copy(self.pi_init), writeOutput=False)
+
+    def test_fit_over_pipes_matches_serial_fit(self):
+        model = CountingGridModel(self.extent, self.window, seed=0)
+        model.fit(self.data, max_iter=5, pi=np.copy(self.pi_init), writeOutput=False, transport=PipeTransport(3))
+        assert(np.allclose(model.pi, self.serialModel.pi))
+        assert(np.allclose(model.log_likelihoods, self.serialModel.log_likelihoods))
+        assert(np.allclose(model.q, self.serialModel.q))
+
+        # The layered model runs here, on the q gathered from the workers
+        layeredModel = CountingGridModel(self.extent, self.window, seed=0)
+        layeredModel.fit(self.data, max_iter=5, pi=np.copy(self.pi_init), writeOutput=False, layers=2, transport=PipeTransport(3))
+        serialLayeredModel = CountingGridModel(self.extent, self.window, seed=0)
+        serialLayeredModel.fit(self.data, max_iter=5, pi=np.copy(self.pi_init), writeOutput=False, layers=2)
+        assert(np.allclose(layeredModel.layercgdata["ql2"], serialLayeredModel.layercgdata["ql2"]))
+
+    def test_workers_with_their_own_shards(self):
+        transport = SocketTransport(2, ("localhost", 0), authkey=b"test")
+        shards = [self.data[:100], self.data[100:]]
+        # Connecting in the opposite order of their ranks
+        workers = [multiprocessing.Process(target=run_worker, args=(transport.address, b"test", shards[rank], rank)) for rank in [1, 0]]
+        for worker in workers:
+            worker.start()
+
+        model = CountingGridModel(self.extent, self.window, seed=0)
+        model.fit(None, max_iter=5, pi=np.copy(self.pi_init), writeOutput=False, transport=transport)
+        for worker in workers:
+            worker.join()
+        assert(np.allclose(model.pi, self.serialModel.pi))
+        assert(np.allclose(model.q, self.serialModel.q))
+
+    def test_online_fits_are_not_distributed(self):
+        model = CountingGridModel(self.extent, self.window, seed=0)
+        self.assertRaises(ValueError, model.fit, None, mode="online", writeOutput=False, transport=object())
@@ -0,0 +1,43 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import unittest
+import numpy as np
+from CountingGridsPy.models import CountingGridModel
+
+
+class TestFloat32VsFloat64(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        M, N = [200, 50]
+        self.data = np.round(np.random.random((M, N)) * 3) * (np.random.random((M, N)) > 0.6)
+        self.extent = np.array([8, 8])
+        self.window = np.array([3, 3])
+        self.pi_init = np.random.random([8, 8, N])
+        self.model64 = CountingGridModel(self.extent, self.window)
+        self.model32 = CountingGridModel(self.extent, self.window, dtype=np.float32)
+
+    def test_invalid_dtype(self):
+        self.assertRaises(ValueError, CountingGridModel, self.extent, self.window, np.int32)
+
+    def test_fitted_model_no_layers(self):
+        numIters = 20
+        for model in [self.model64, self.model32]:
+            model.fit(self.data, max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False)
+
+        assert(self.model32.pi.dtype == np.float32)
+        assert(self.model32.q.dtype == np.float32)
+        assert(self.model32.h.dtype == np.float32)
+        assert(np.allclose(self.model64.pi, self.model32.pi, rtol=1e-3, atol=1e-5))
+        assert(np.allclose(self.model64.q, self.model32.q, rtol=1e-2, atol=1e-4))
+        assert(np.allclose(self.model64.log_likelihoods, self.model32.log_likelihoods, rtol=1e-5))
+
+    def test_fitted_model_with_layers(self):
+        numIters = 10
+        for model in [self.model64, self.model32]:
+            np.random.seed(1)
+            model.fit(self.data, max_iter=numIters, pi=np.copy(self.pi_init), layers=2, writeOutput=False)
+
+        assert(self.model32.layercgdata["pi_la_idf"].dtype == np.float32)
+        assert(self.model32.layercgdata["pi2_idf"].dtype == np.float32)
+        assert(np.allclose(self.model64.layercgdata["pi2_idf"], self.model32.layercgdata["pi2_idf"], rtol=1e-2, atol=1e-4))
@@ -0,0 +1,37 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import CountingGridModel
+
+
+class TestFoldIn(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        M, N = [120, 30]
+        self.data = np.round(np.random.random((M, N)) * 3) * (np.random.random((M, N)) > 0.6)
+        self.extent = np.array([6, 6])
+        self.window = np.array([3, 3])
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_transform_trained_grid_from_file(self):
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(self.data, max_iter=10, output_directory=self.directory)
+        expected_q = model.q_update(self.data.astype(np.float64))
+
+        loaded = CountingGridModel.from_file(os.path.join(self.directory, "CGData.mat"), self.window)
+        assert(np.all(loaded.extent == self.extent))
+        assert(np.allclose(loaded.pi, model.pi))
+
+        q = loaded.transform(scipy.sparse.csr_matrix(self.data), batch_size=50)
+        assert(q.shape == (120, 6, 6))
+        assert(np.allclose(q, expected_q))
+        assert(np.allclose(loaded.pi, model.pi))
@@ -0,0 +1,63 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+import subprocess
+import sys
+import unittest
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import CountingGridModel
+from CountingGridsPy.models import FusedKernels
+
+
+class TestFusedKernels(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        T, Z = [500, 40]
+        self.extent = np.array([9, 7])
+        self.window = np.array([4, 3])
+        self.data = np.random.randint(0, 5, size=(T, Z)).astype(np.float64)
+        self.pi_init = np.random.random([9, 7, Z])
+
+    @unittest.skipUnless(FusedKernels.AVAILABLE, "numba is not installed")
+    def test_compiled_fit_matches_numpy_fit(self):
+        numIters = 10
+        for data in [self.data, scipy.sparse.csr_matrix(self.data)]:
+            numpyModel = CountingGridModel(self.extent, self.window, compiled=False)
+            numpyModel.fit(data, max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False)
+            compiledModel = CountingGridModel(self.extent, self.window, compiled=True)
+            compiledModel.fit(data, max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False)
+            assert(np.allclose(compiledModel.pi, numpyModel.pi))
+            assert(np.allclose(compiledModel.q, numpyModel.q))
+            assert(np.allclose(compiledModel.log_likelihoods, numpyModel.log_likelihoods))
+
+    @unittest.skipIf(FusedKernels.AVAILABLE, "numba is installed")
+    def test_compiled_needs_numba(self):
+        with self.assertRaises(ImportError):
+            CountingGridModel(self.extent, self.window, compiled=True)
+        assert(not CountingGridModel(self.extent, self.window).compiled)
+
+    @unittest.skipUnless(FusedKernels.AVAILABLE, "numba is not installed")
+    def test_import_leaves_the_threading_layer_alone(self):
+        # In a fresh process, since this one may have selected the layer already
+        check = (
+            "import numba; layer = numba.config.THREADING_LAYER; from CountingGridsPy.models import FusedKernels; "
+            "assert numba.config.THREADING_LAYER == layer; FusedKernels.use_fork_safe_threading_layer(); "
+            "assert numba.config.THREADING_LAYER == 'workqueue'"
+        )
+        environment = {key: value for key, value in os.environ.items() if key != "NUMBA_THREADING_LAYER"}
+        subprocess.run([sys.executable, "-c", check], check=True, env=environment)
+
+    @unittest.skipUnless(FusedKernels.AVAILABLE, "numba is not installed")
+    def test_process_pool_after_a_compiled_fit(self):
+        # In a fresh process with numba's default threading layer, which hangs forked workers if it starts first
+        check = (
+            "import numpy as np; from CountingGridsPy.models import CountingGridModel; "
+            "data = np.random.randint(0, 5, size=(200, 30)).astype(np.float64); "
+            "CountingGridModel(np.array([6, 6]), np.array([2, 2])).fit(data, max_iter=2, writeOutput=False); "
+            "CountingGridModel(np.array([6, 6]), np.array([2, 2])).fit(data, max_iter=2, writeOutput=False, processes=2); "
+            "CountingGridModel(np.array([6, 6]), np.array([2, 2]), seed=0).fit(data, max_iter=2, writeOutput=False, restarts=2, processes=2)"
+        )
+        environment = {key: value for key, value in os.environ.items() if key != "NUMBA_THREADING_LAYER"}
+        subprocess.run([sys.executable, "-W", "error", "-c", check], check=True, env=environment, timeout=300)
@@ -0,0 +1,93 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import unittest
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import CountingGridModel
+from synthetic import make_documents
+
+
+class TestLayers(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        T, Z = [300, 50]
+        self.extent = np.array([8, 8])
+        self.window = np.array([3, 3])
+        self.data = make_documents(T, Z, self.extent, self.window, 15).astype(np.float64)
+        self.pi_init = np.random.random([8, 8, Z])
+
+    def fit_layers(self, data, layers, layer_iterations=2):
+        np.random.seed(0)
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(data, max_iter=5, pi=np.copy(self.pi_init), layers=layers, layer_iterations=layer_iterations, writeOutput=False)
+        return model.layercgdata
+
+    def test_layer_outputs(self):
+        T, Z = self.data.shape
+        L = 3
+        result = self.fit_layers(self.data, L)
+        assert(result["pi_la"].shape == (8, 8, Z, L))
+        assert(result["pi_la_idf"].shape == (8, 8, Z, L))
+        assert(result["pi2_idf"].shape == (8, 8, Z))
+        assert(result["ql2"].shape == (T, 8, 8))
+        assert(np.allclose(np.sum(result["pi_la"], axis=2), 1))
+        assert(np.allclose(np.sum(result["pi2_idf"], axis=2), 1))
+        assert(np.allclose(np.sum(result["ql2"], axis=(1, 2)), 1))
+        assert(np.all(np.isin(result["id_layer"][0], np.arange(1, L + 1))))
+
+    def test_sparse_matches_dense(self):
+        dense = self.fit_layers(self.data, 2)
+        sparse = self.fit_layers(scipy.sparse.csr_matrix(self.data), 2)
+        for key in ["pi2_idf", "pi_la", "ql2"]:
+            assert(np.allclose(dense[key], sparse[key]))
+        assert(np.all(dense["id_layer"][0] == sparse["id_layer"][0]))
+
+    def test_layer_iterations(self):
+        # q is only refined from the second layered iteration on
+        np.random.seed(0)
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(self.data, max_iter=5, pi=np.copy(self.pi_init), writeOutput=False)
+        q = np.copy(model.q)
+        result = model.cg_layers(self.data, L=2, nmax=1)
+        assert(np.allclose(result["ql2"], q))
+        result = self.fit_layers(self.data, 2, layer_iterations=4)
+        assert(not np.allclose(result["ql2"], q))
+
+    def test_single_layer(self):
+        T, Z = self.data.shape
+        np.random.seed(0)
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(self.data, max_iter=5, pi=np.copy(self.pi_init), writeOutput=False)
+        result = model.layercgdata
+        assert(result["pi_la_idf"].shape == (8, 8, Z, 1))
+        assert(result["ql2"] is model.q)
+        assert(np.all(result["id_layer"][0] == 1))
+        # Without layered iterations, cg_layers only adds noise to pi
+        layered = model.cg_layers(self.data, L=1, nmax=0)
+        assert(np.allclose(result["pi2_idf"], layered["pi2_idf"]))
+        assert(np.allclose(result["pi_la_idf"], layered["pi_la_idf"]))
+
+    def test_outputs_share_memory(self):
+        np.random.seed(0)
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(self.data, max_iter=5, pi=np.copy(self.pi_init), writeOutput=False)
+        result = model.cg_layers(self.data, L=2)
+        assert(np.shares_memory(result["counts_to_show"], self.data))
+        assert(result["ql2"] is model.q)
+        assert(not np.shares_memory(result["pi_la"], result["pi_la_idf"]))
+
+    def test_fixed_layers(self):
+        np.random.seed(0)
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(self.data, max_iter=5, pi=np.copy(self.pi_init), writeOutput=False)
+        q = np.copy(model.q)
+        model.q = q[:200]
+        learned = model.cg_layers(self.data[:200], L=2)
+        pi_la = np.copy(learned["pi_la"])
+        model.q = q
+        placed = model.cg_layers(self.data, L=2, pi_la=pi_la)
+        assert(np.array_equal(placed["pi_la"], pi_la))
+        assert(placed["ql2"].shape == (self.data.shape[0], 8, 8))
+        assert(len(placed["id_layer"][0]) == self.data.shape[0])
+        self.assertRaises(ValueError, model.cg_layers, self.data, 3, pi_la=pi_la)
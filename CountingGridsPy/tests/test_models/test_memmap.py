@@ -0,0 +1,51 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import CountingGridModel
+from CountingGridsPy.models.MemmapCounts import save_counts, load_counts
+
+
+class TestMemmap(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        T, Z = [500, 40]
+        self.extent = np.array([6, 6])
+        self.window = np.array([2, 2])
+        self.data = scipy.sparse.random(T, Z, density=0.2, format="csr", random_state=0) * 10
+        self.pi_init = np.random.random([6, 6, Z])
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_counts_round_trip(self):
+        save_counts(self.data, self.directory)
+        counts = load_counts(self.directory)
+        assert(counts.shape == self.data.shape)
+        # Views of the read-only mapped files, not copies
+        assert(not counts.data.flags.writeable and not counts.indices.flags.writeable)
+        assert(np.array_equal(counts.toarray(), self.data.toarray()))
+
+    def test_fit_streams_over_memory_mapped_counts(self):
+        numIters = 5
+        inMemoryModel = CountingGridModel(self.extent, self.window)
+        inMemoryModel.fit(self.data, max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False, layers=2)
+
+        save_counts(self.data, self.directory)
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(load_counts(self.directory), max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False, layers=2, chunk_size=64)
+        assert(np.allclose(model.pi, inMemoryModel.pi))
+        assert(np.allclose(model.log_likelihoods, inMemoryModel.log_likelihoods))
+
+    def test_memory_mapped_fit_keeps_q_sparse(self):
+        save_counts(self.data, self.directory)
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(load_counts(self.directory), max_iter=3, pi=np.copy(self.pi_init), writeOutput=False, chunk_size=64, top_k=4)
+        assert(scipy.sparse.issparse(model.q))
+        assert(model.q.shape == (self.data.shape[0], 36))
+        assert(model.layercgdata["ql2"] is model.q)
@@ -0,0 +1,41 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import unittest
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import CountingGridModel
+from synthetic import make_documents
+
+
+class TestOnlineEM(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        T, Z = [2000, 100]
+        self.extent = np.array([8, 8])
+        self.window = np.array([3, 3])
+        # documents drawn from the windows of a known grid
+        self.data = make_documents(T, Z, self.extent, self.window, 15)
+        self.pi_init = np.random.random([8, 8, Z])
+
+    def test_invalid_mode(self):
+        model = CountingGridModel(self.extent, self.window)
+        self.assertRaises(ValueError, model.fit, self.data, mode="minibatch", writeOutput=False)
+
+    def test_online_beats_batch_for_same_number_of_passes(self):
+        numPasses = 3
+        batchModel = CountingGridModel(self.extent, self.window)
+        batchModel.fit(self.data, max_iter=numPasses, pi=np.copy(self.pi_init), writeOutput=False)
+        batchModel.q_update(self.data)
+
+        onlineModel = CountingGridModel(self.extent, self.window)
+        onlineModel.fit(
+            scipy.sparse.csr_matrix(self.data), max_iter=numPasses, pi=np.copy(self.pi_init),
+            writeOutput=False, mode="online", batch_size=200
+        )
+        assert(onlineModel.q.shape == (2000, 8, 8))
+        assert(np.all(np.isclose(np.sum(onlineModel.q, axis=(1, 2)), 1)))
+        assert(np.all(np.isclose(np.sum(onlineModel.pi, axis=2), 1)))
+        assert(len(onlineModel.log_likelihoods) == numPasses)
+        onlineModel.q_update(self.data)
+        assert(onlineModel.log_likelihood > batchModel.log_likelihood)
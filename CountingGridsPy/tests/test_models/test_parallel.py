@@ -0,0 +1,32 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import unittest
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import CountingGridModel
+
+
+class TestProcessPoolEStep(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        M, N = [301, 40]
+        self.data = np.round(np.random.random((M, N)) * 3) * (np.random.random((M, N)) > 0.6)
+        self.extent = np.array([6, 6])
+        self.window = np.array([2, 3])
+        self.pi_init = np.random.random([6, 6, N])
+
+    def test_sharded_fit_matches_serial_fit(self):
+        numIters = 10
+        serialModel = CountingGridModel(self.extent, self.window)
+        serialModel.fit(self.data, max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False)
+
+        parallelModel = CountingGridModel(self.extent, self.window)
+        parallelModel.fit(
+            scipy.sparse.csr_matrix(self.data), max_iter=numIters, pi=np.copy(self.pi_init),
+            writeOutput=False, processes=3
+        )
+        assert(parallelModel.q.shape == serialModel.q.shape)
+        assert(np.all(np.isclose(serialModel.q, parallelModel.q)))
+        assert(np.all(np.isclose(serialModel.pi, parallelModel.pi)))
+        assert(np.all(np.isclose(serialModel.log_likelihoods, parallelModel.log_likelihoods)))
@@ -0,0 +1,51 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import unittest
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import CountingGridModel
+from synthetic import make_documents
+
+
+class TestRandomRestarts(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        T, Z = [400, 50]
+        self.extent = np.array([8, 8])
+        self.window = np.array([3, 3])
+        self.data = scipy.sparse.csr_matrix(make_documents(T, Z, self.extent, self.window, 15))
+
+    def test_seeded_models_are_reproducible(self):
+        first = CountingGridModel(self.extent, self.window, seed=7)
+        first.fit(self.data, max_iter=3, writeOutput=False)
+        second = CountingGridModel(self.extent, self.window, seed=7)
+        second.fit(self.data, max_iter=3, writeOutput=False)
+        third = CountingGridModel(self.extent, self.window, seed=8)
+        third.fit(self.data, max_iter=3, writeOutput=False)
+        assert(np.allclose(first.pi, second.pi))
+        assert(not np.allclose(first.pi, third.pi))
+
+    def test_best_of_restarts(self):
+        numIters = 8
+        restarts = 4
+        model = CountingGridModel(self.extent, self.window, seed=1)
+        model.fit(self.data, max_iter=numIters, writeOutput=False, restarts=restarts, restart_iterations=3, restart_tolerance=1, processes=2)
+        assert(len(model.restart_log_likelihoods) == restarts)
+        assert(len(model.log_likelihoods) == numIters)
+        assert(np.allclose(np.sum(model.q, axis=(1, 2)), 1))
+
+        # Without pruning, every restart is a full fit from a child of the model's seed
+        for seed in np.random.SeedSequence(1).spawn(restarts):
+            single = CountingGridModel(self.extent, self.window, seed=seed)
+            single.fit(self.data, max_iter=numIters, writeOutput=False)
+            assert(single.log_likelihoods[-1] <= model.log_likelihoods[-1] + 1e-8 * abs(model.log_likelihoods[-1]))
+
+    def test_pruning_keeps_the_best_early_restart(self):
+        model = CountingGridModel(self.extent, self.window, seed=1)
+        model.fit(self.data, max_iter=6, writeOutput=False, restarts=3, restart_iterations=2, restart_tolerance=0, processes=2)
+        best = int(np.argmax(model.restart_log_likelihoods))
+        single = CountingGridModel(self.extent, self.window, seed=np.random.SeedSequence(1).spawn(3)[best])
+        single.fit(self.data, max_iter=6, writeOutput=False)
+        assert(np.allclose(single.pi, model.pi))
+        assert(np.allclose(single.log_likelihoods, model.log_likelihoods))
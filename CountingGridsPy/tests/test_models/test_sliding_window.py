@@ -0,0 +1,166 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import os
+import tempfile
+import unittest
+import numpy as np
+import scipy.sparse
+from unittest import mock
+from CountingGridsPy.models import CountingGridModel, SlidingWindowEM
+from CountingGridsPy.EngineToBrowseCloudPipeline import SlidingWindowTrainer, NLPCleaner
+
+
+class TestSlidingWindowEM(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        T, Z = [300, 40]
+        self.extent = np.array([6, 6])
+        self.window = np.array([2, 2])
+        self.data = scipy.sparse.random(T, Z, density=0.3, format="csr", random_state=0) * 10
+        self.model = CountingGridModel(self.extent, self.window)
+        self.model.fit(self.data[:100], max_iter=20, writeOutput=False)
+
+    def test_statistics_match_the_window(self):
+        sliding = SlidingWindowEM(self.model, self.data, 100)
+        for first, last in [(0, 100), (10, 110), (60, 160), (200, 300)]:
+            assert(sliding.slide(first, last))
+            expected = self.model.q_dot_data(sliding.window_q(), self.data[first:last])
+            assert(np.allclose(sliding.QdotConH, expected))
+            assert(np.allclose(np.sum(self.model.pi, axis=2), 1))
+        assert(not sliding.slide(200, 300))
+
+    def test_only_entering_documents_get_e_steps(self):
+        sliding = SlidingWindowEM(self.model, self.data, 100)
+        sliding.slide(0, 100)
+        q_update = self.model.q_update
+        sizes = []
+        self.model.q_update = lambda data: sizes.append(data.shape[0]) or q_update(data)
+        sliding.slide(5, 105, iterations=2)
+        assert(sizes == [5, 5])
+
+    def test_windows_only_move_forward(self):
+        sliding = SlidingWindowEM(self.model, self.data, 100)
+        sliding.slide(50, 150)
+        self.assertRaises(ValueError, sliding.slide, 40, 150)
+        self.assertRaises(ValueError, sliding.slide, 50, 200)
+
+    def test_resume_continues_the_window(self):
+        sliding = SlidingWindowEM(self.model, self.data, 100)
+        sliding.slide(0, 100)
+        sliding.slide(20, 120)
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "state.npz")
+            sliding.save(file_name, window=3)
+            model = CountingGridModel(self.extent, self.window)
+            model.initializePi(self.data)
+            resumed = SlidingWindowEM(model, self.data, 100)
+            assert(int(resumed.resume(file_name)["window"]) == 3)
+        assert(np.allclose(model.pi, self.model.pi))
+        assert(not resumed.slide(20, 120))
+        sliding.slide(40, 140)
+        resumed.slide(40, 140)
+        assert(np.allclose(model.pi, self.model.pi))
+        assert(np.allclose(resumed.window_q(), sliding.window_q()))
+
+    def test_sliding_is_close_to_refitting(self):
+        sliding = SlidingWindowEM(self.model, self.data, 100)
+        for first in range(0, 101, 10):
+            sliding.slide(first, first + 100)
+        window_data = self.data[100:200]
+        self.model.q_update(window_data)
+        sliding_likelihood = self.model.log_likelihood
+
+        refit = CountingGridModel(self.extent, self.window)
+        refit.fit(window_data, max_iter=20, writeOutput=False)
+        refit.q_update(window_data)
+        refit_likelihood = refit.log_likelihood
+        assert(abs(sliding_likelihood - refit_likelihood) < 0.02 * abs(refit_likelihood))
+
+
+class TestTimeWindows(unittest.TestCase):
+    def test_integer_times(self):
+        k, first, last = SlidingWindowTrainer.time_windows([0, 0, 1, 3, 3, 4, 7], 2, 1)
+        # [5, 7) holds no documents
+        assert(np.array_equal(k, [0, 1, 2, 3, 4, 6]))
+        assert(np.array_equal(first, [0, 2, 3, 3, 5, 6]))
+        assert(np.array_equal(last, [3, 3, 5, 6, 6, 7]))
+
+        # [1, 5) holds the same documents as [0, 4)
+        k, first, last = SlidingWindowTrainer.time_windows([1, 5], 4, 1, origin=0)
+        assert(np.array_equal(k, [0, 2]))
+        assert(np.array_equal(first, [0, 1]))
+        assert(np.array_equal(last, [1, 2]))
+
+    def test_datetime_times(self):
+        times = np.datetime64("2020-01-01T00:00:00") + np.array([0, 0, 1, 3, 3, 4, 7]) * np.timedelta64(1, "D")
+        times[2] += np.timedelta64(23, "h")
+        k, first, last = SlidingWindowTrainer.time_windows(times, np.timedelta64(2, "D"), np.timedelta64(1, "D"))
+        assert(np.array_equal(k, [0, 1, 2, 3, 4, 6]))
+        assert(np.array_equal(first, [0, 2, 3, 3, 5, 6]))
+        assert(np.array_equal(last, [3, 3, 5, 6, 6, 7]))
+
+    def test_unsorted_times(self):
+        self.assertRaises(ValueError, SlidingWindowTrainer.time_windows, [0, 2, 1], 2, 1)
+
+
+class TestTimeSlidingTrainer(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.extent = np.array([5, 5])
+        self.window = np.array([2, 2])
+        # 20 documents a day for 10 days
+        self.times = np.repeat(np.arange(10), 20)
+        self.data = scipy.sparse.random(len(self.times), 30, density=0.3, format="csr", random_state=0) * 10
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        # TimeSlidingTrainer writes the windows to ./<output_directory>/iter<k>
+        os.chdir(self.directory.name)
+        os.mkdir("out")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def train(self, T, span=3, step=1):
+        written = []
+        write_window = SlidingWindowTrainer.write_window
+
+        def record(model, window, layers, directory):
+            written.append(os.path.basename(directory))
+            write_window(model, window, layers, directory)
+        with mock.patch.object(SlidingWindowTrainer, "write_window", side_effect=record):
+            SlidingWindowTrainer.TimeSlidingTrainer(
+                self.times[:T], span, step, CountingGridModel(self.extent, self.window), self.data[:T], "out",
+                initial_max_iter=5, runInitialTrain=False
+            )
+        return written
+
+    def test_rerun_only_trains_new_windows(self):
+        # Days 0 to 5, and then 5 more documents of day 5 and days 6 to 9
+        assert(self.train(115) == ["iter0", "iter1", "iter2", "iter3"])
+        assert(self.train(200) == ["iter3", "iter4", "iter5", "iter6", "iter7"])
+        assert(self.train(200) == [])
+        for k in range(8):
+            assert(os.path.exists("out/iter" + str(k) + "/CountingGridDataMatrices.mat"))
+
+    def test_windows_must_match_the_saved_ones(self):
+        self.train(100)
+        self.assertRaises(ValueError, self.train, 200, span=4)
+        self.assertRaises(ValueError, self.train, 200, step=2)
+
+
+class TestCachedCorrespondences(unittest.TestCase):
+    def test_cached_rows(self):
+        cleaner = NLPCleaner()
+        cleaner.corrispondences = {"run": ",running,ran", "walk": ",walked"}
+        with tempfile.TemporaryDirectory() as directory:
+            cleaner.write_cached_correspondences(directory, "/correspondences.tsv")
+            assert(cleaner.cached_rows(directory, "/correspondences.tsv") is None)
+            cleaner.write_cached_correspondences(directory, "/correspondences.tsv", rows=120)
+            assert(cleaner.cached_rows(directory, "/correspondences.tsv") == 120)
+            assert(cleaner.read_cached_correspondences(directory, "/correspondences.tsv") == cleaner.corrispondences)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -29,3 +29,16 @@ class TestCorrectnessOfNontrivialDesignMatrix(unittest.TestCase):
                        returnSumSquareDifferencesOfPi=False, pi=np.copy(self.pi_init))
         assert(np.all(np.isclose(self.model.q, .04)))
 
+    def test_predict_log_likelihoods(self):
+        np.random.seed(0)
+        pi = np.random.random([5, 5, self.N])
+        self.model.fit(self.data, max_iter=3, pi=pi, writeOutput=False)
+        log_likelihoods = self.model.predict_log_likelihoods(self.data, batch_size=2)
+        assert(log_likelihoods.shape == (5, 5, 5))
+        # windows that do not wrap around the grid agree with predict_probabilities
+        for t in range(self.data.shape[0]):
+            for k in [[0, 0], [1, 2], [3, 2]]:
+                assert(np.isclose(
+                    log_likelihoods[t, k[0], k[1]],
+                    np.log(self.model.predict_probabilities(self.data[t], k))
+                ))
@@ -0,0 +1,63 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import unittest
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import CountingGridModel
+
+
+class TestSparseVsDense(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        M, N = [60, 40]
+        extentSize = 6
+        self.data = np.round(np.random.random((M, N)) * 3) * (np.random.random((M, N)) > 0.7)
+        self.extent = np.array([extentSize, extentSize])
+        self.window = np.array([2, 2])
+        self.pi_init = np.random.random([extentSize] * 2 + [N])
+        self.denseModel = CountingGridModel(self.extent, self.window)
+        self.sparseModel = CountingGridModel(self.extent, self.window)
+
+    def test_fitted_model_no_layers(self):
+        numIters = 10
+        self.denseModel.fit(
+            self.data,
+            max_iter=numIters,
+            pi=np.copy(self.pi_init),
+            layers=1,
+            writeOutput=False
+        )
+        self.sparseModel.fit(
+            scipy.sparse.csr_matrix(self.data),
+            max_iter=numIters,
+            pi=np.copy(self.pi_init),
+            layers=1,
+            writeOutput=False
+        )
+        assert(np.all(np.isclose(self.denseModel.q, self.sparseModel.q)))
+        assert(np.all(np.isclose(self.denseModel.pi, self.sparseModel.pi)))
+
+    def test_fitted_model_with_layers(self):
+        numIters = 5
+        np.random.seed(1)
+        self.denseModel.fit(
+            self.data,
+            max_iter=numIters,
+            pi=np.copy(self.pi_init),
+            layers=2,
+            writeOutput=False
+        )
+        np.random.seed(1)
+        self.sparseModel.fit(
+            scipy.sparse.csc_matrix(self.data),
+            max_iter=numIters,
+            pi=np.copy(self.pi_init),
+            layers=2,
+            writeOutput=False
+        )
+        denseLayers = self.denseModel.layercgdata
+        sparseLayers = self.sparseModel.layercgdata
+        assert(np.all(np.isclose(denseLayers["pi2_idf"], sparseLayers["pi2_idf"])))
+        assert(np.all(np.isclose(denseLayers["ql2"], sparseLayers["ql2"])))
+        assert(np.all(denseLayers["id_layer"][0] == sparseLayers["id_layer"][0]))
@@ -0,0 +1,42 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import unittest
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import CountingGridModel
+from synthetic import make_documents
+
+
+class TestSquarem(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        T, Z = [1000, 100]
+        self.extent = np.array([10, 10])
+        self.window = np.array([3, 3])
+        self.data = scipy.sparse.csr_matrix(make_documents(T, Z, self.extent, self.window, 20))
+        self.pi_init = np.random.random([10, 10, Z])
+
+    def test_accelerated_fit_saves_iterations(self):
+        numIters = 60
+        plainModel = CountingGridModel(self.extent, self.window)
+        plainModel.fit(self.data, max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False)
+
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(self.data, max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False, accelerate=True)
+        assert(len(model.log_likelihoods) == numIters)
+        assert(np.allclose(np.sum(model.pi, axis=2), 1))
+        assert(np.all(model.pi > 0))
+        assert(max(model.log_likelihoods) >= plainModel.log_likelihoods[-1])
+        assert(CountingGridModel.iterations_saved(plainModel.log_likelihoods, model.log_likelihoods) > 0)
+        assert(model.squarem_iterations_saved > 0)
+
+    def test_accelerated_fit_counts_em_steps(self):
+        for numIters in range(3, 12):
+            model = CountingGridModel(self.extent, self.window)
+            model.fit(self.data, max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False, accelerate=True)
+            assert(len(model.log_likelihoods) == numIters)
+
+    def test_online_is_not_accelerated(self):
+        model = CountingGridModel(self.extent, self.window)
+        self.assertRaises(ValueError, model.fit, self.data, mode="online", accelerate=True, writeOutput=False)
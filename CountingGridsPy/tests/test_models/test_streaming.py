@@ -0,0 +1,52 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import tracemalloc
+import unittest
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import CountingGridModel
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        T, Z = [1000, 50]
+        self.extent = np.array([8, 8])
+        self.window = np.array([3, 3])
+        self.data = scipy.sparse.random(T, Z, density=0.2, format="csr", random_state=0) * 10
+        self.pi_init = np.random.random([8, 8, Z])
+
+    def test_streaming_fit_matches_batch_fit(self):
+        numIters = 10
+        batchModel = CountingGridModel(self.extent, self.window)
+        batchModel.fit(self.data, max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False)
+
+        for workspace in [False, True]:
+            model = CountingGridModel(self.extent, self.window)
+            model.fit(self.data, max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False, chunk_size=64, workspace=workspace)
+            assert(np.allclose(model.pi, batchModel.pi))
+            assert(np.allclose(model.log_likelihoods, batchModel.log_likelihoods))
+            assert(np.allclose(model.q, batchModel.transform(self.data)))
+
+    def test_q_is_only_materialized_on_request(self):
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(self.data, max_iter=3, pi=np.copy(self.pi_init), writeOutput=False, chunk_size=64, materialize_q=False)
+        assert(model.q is None)
+
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(self.data, max_iter=3, pi=np.copy(self.pi_init), writeOutput=False, chunk_size=64, materialize_q=False, top_k=5)
+        assert(model.q is None)
+
+    def test_memory_depends_on_chunk_size(self):
+        data = scipy.sparse.vstack([self.data] * 20, format="csr")
+        T = data.shape[0]
+        model = CountingGridModel(self.extent, self.window)
+        # Compiling or loading the numba kernels, once per process, is not part of the footprint
+        model.fit(data[:100], max_iter=1, pi=np.copy(self.pi_init), writeOutput=False, chunk_size=100, materialize_q=False)
+        tracemalloc.start()
+        model.fit(data, max_iter=2, pi=np.copy(self.pi_init), writeOutput=False, chunk_size=100, materialize_q=False, workspace=True)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # The full q alone would take T x P floats
+        assert(peak < T * np.prod(self.extent) * 8 / 4)
@@ -0,0 +1,36 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import unittest
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import CountingGridModel
+from CountingGridsPy.models.HyperparameterSweep import HyperparameterSweep
+from synthetic import make_documents
+
+
+class TestHyperparameterSweep(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        T, Z = [600, 60]
+        self.data = scipy.sparse.csr_matrix(make_documents(T, Z, np.array([8, 8]), np.array([3, 3]), 30))
+
+    def test_score_is_the_log_likelihood_of_the_e_step(self):
+        model = CountingGridModel(np.array([6, 6]), np.array([2, 2]))
+        model.fit(self.data, max_iter=3, writeOutput=False)
+        model.transform(self.data)
+        assert(np.isclose(model.score(self.data), model.log_likelihood))
+
+    def test_sweep_scores_every_configuration(self):
+        configurations = [(4, 2, 1), (8, 3, 1), (8, 3, 2)]
+        with HyperparameterSweep(self.data, held_out=0.2, processes=3) as sweep:
+            results = sweep.run(configurations, max_iter=20)
+        assert(len(results) == len(configurations))
+        for (extent, window, layers), result in zip(configurations, results):
+            assert(np.all(result["extent"] == extent) and np.all(result["window"] == window) and result["layers"] == layers)
+            assert(result["pi"].shape == (extent, extent, 60))
+            assert(np.isfinite(result["score"]))
+        assert(results[0]["pi_la"] is None and results[2]["pi_la"].shape == (8, 8, 60, 2))
+        # The grid the documents came from explains the held-out ones better than a smaller one
+        assert(results[1]["score"] > results[0]["score"])
+        assert(HyperparameterSweep.best(results)["score"] == max(result["score"] for result in results))
@@ -0,0 +1,41 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import unittest
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import CountingGridModel
+from CountingGridsPy.models.CountingGridModel import top_k_posterior
+from synthetic import make_documents
+
+
+class TestTopKPosterior(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        T, Z = [1000, 100]
+        self.extent = np.array([10, 10])
+        self.window = np.array([3, 3])
+        self.data = scipy.sparse.csr_matrix(make_documents(T, Z, self.extent, self.window, 15))
+        self.pi_init = np.random.random([10, 10, Z])
+
+    def test_top_k_posterior(self):
+        q = np.random.random((4, 3, 3))
+        sparse_q = top_k_posterior(q, 2)
+        assert(sparse_q.shape == (4, 9))
+        assert(np.all(sparse_q.getnnz(axis=1) == 2))
+        assert(np.allclose(np.asarray(sparse_q.sum(axis=1)).flatten(), 1))
+        for t in range(4):
+            assert(set(sparse_q[t].indices) == set(np.argsort(q[t].flatten())[-2:]))
+
+    def test_fit_with_top_k(self):
+        numIters = 10
+        denseModel = CountingGridModel(self.extent, self.window)
+        denseModel.fit(self.data, max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False)
+
+        sparseModel = CountingGridModel(self.extent, self.window)
+        sparseModel.fit(
+            self.data, max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False, top_k=20, batch_size=300
+        )
+        assert(scipy.sparse.issparse(sparseModel.q))
+        assert(sparseModel.q.nnz == 1000 * 20)
+        assert(np.allclose(sparseModel.log_likelihoods, denseModel.log_likelihoods, rtol=1e-2))
@@ -0,0 +1,38 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import unittest
+import numpy as np
+import scipy.sparse
+import torch
+from CountingGridsPy.models import CountingGridModel, CountingGridModelWithGPU
+
+
+class TestTorchOnCPU(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        M, N = [300, 100]
+        self.data = np.round(np.random.random((M, N)) * 3) * (np.random.random((M, N)) < 0.2)
+        self.extent = np.array([12, 12])
+        self.window = np.array([3, 3])
+        self.pi_init = np.random.random([12, 12, N])
+        self.cpuModel = CountingGridModel(self.extent, self.window)
+        self.torchModel = CountingGridModelWithGPU(self.extent, self.window, device="cpu")
+
+    def test_fitted_model_no_layers(self):
+        numIters = 20
+        self.cpuModel.fit(self.data, max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False)
+        self.torchModel.fit(self.data, max_iter=numIters, pi=torch.tensor(self.pi_init), writeOutput=False)
+
+        assert(self.torchModel.pi.device.type == "cpu")
+        assert(np.allclose(self.cpuModel.pi, self.torchModel.pi.numpy()))
+        assert(np.allclose(self.cpuModel.q, self.torchModel.q.numpy()))
+
+    def test_sparse_data(self):
+        numIters = 20
+        self.torchModel.fit(self.data, max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False)
+        sparseModel = CountingGridModelWithGPU(self.extent, self.window, device="cpu")
+        sparseModel.fit(scipy.sparse.csr_matrix(self.data), max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False)
+
+        assert(np.allclose(self.torchModel.pi.numpy(), sparseModel.pi.numpy()))
+        assert(np.allclose(self.torchModel.q.numpy(), sparseModel.q.numpy()))
@@ -0,0 +1,48 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+import unittest
+import numpy as np
+import scipy.sparse
+from CountingGridsPy.models import CountingGridModel
+
+
+class TestWorkspace(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        M, N = [150, 40]
+        self.data = np.round(np.random.random((M, N)) * 3) * (np.random.random((M, N)) > 0.6)
+        self.extent = np.array([7, 9])
+        self.window = np.array([2, 4])
+        self.pi_init = np.random.random([7, 9, N])
+
+    def test_workspace_matches_default(self):
+        numIters = 15
+        for data in [self.data, scipy.sparse.csr_matrix(self.data)]:
+            model = CountingGridModel(self.extent, self.window)
+            model.fit(data, max_iter=numIters, pi=np.copy(self.pi_init), writeOutput=False)
+            workspaceModel = CountingGridModel(self.extent, self.window)
+            pi = np.copy(self.pi_init)
+            workspaceModel.fit(data, max_iter=numIters, pi=pi, writeOutput=False, workspace=True)
+
+            assert(workspaceModel.workspace is None)
+            assert(np.all(pi == self.pi_init))
+            assert(np.all(np.isclose(model.pi, workspaceModel.pi)))
+            assert(np.all(np.isclose(model.q, workspaceModel.q)))
+            assert(np.all(np.isclose(model.h, workspaceModel.h)))
+
+    def test_process_pool_reuses_the_statistics_buffer(self):
+        class BufferRecorder():
+            def __init__(self):
+                self.buffers = []
+
+            def makeProgress(self, progress):
+                pass
+
+            def preview(self, model, iteration):
+                self.buffers.append(model.workspace["QdotConH"])
+
+        recorder = BufferRecorder()
+        model = CountingGridModel(self.extent, self.window)
+        model.fit(self.data, max_iter=4, pi=np.copy(self.pi_init), writeOutput=False, workspace=True, processes=2, heartBeaters=[recorder])
+        assert(all(buffer is recorder.buffers[0] for buffer in recorder.buffers))